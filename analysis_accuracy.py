@@ -2,7 +2,7 @@
 
 INVOCATION
   python analyze_accuracy.py test_train_output_location start_predictions stop_predictions upstream_version feature_version
-   [--debug] [--test] [--trace]
+   [--debug] [--test] [--trace] [--walk-workers {n}]
 where
  test_train_location is {midpredictor, dev} tells where to find the output of the test_train program
   'dev'  --> its in .../Dropbox/data/7chord/7chord-01/working/test_train/
@@ -16,6 +16,13 @@ where
    and logging.error()
  --test means to set control.test, so that test code is executed
  --trace means to invoke pdb.set_trace() early in execution
+ --walk-workers {n} means to walk the test_train output directories of the issuers using n threads
+   The default is 8. The walk records the directories it lists in a manifest next to the test_train
+   output location, which is shared with the other analysis programs. See seven/WalkTestTrainOutputDirectories.py.
+
+The squared errors computed from each signal.csv file are cached in a binary file in the cache
+directory. The cached squared errors are reused as long as the path, size, and mtime of the signal.csv
+file are unchanged, so that a daily run parses only the signal.csv files written since the prior run.
 
 EXAMPLES OF INVOCATION
   python anayze_accuracy.py dev 2016-01-01 2017-12-31 1 1 --debug
@@ -31,13 +38,14 @@ import copy
 import csv
 import collections
 import datetime
-import math
+import hashlib
+import numpy as np
 import os
 import pdb
 from pprint import pprint
 import random
 import sys
-from typing import Dict, List
+from typing import Dict
 
 import seven.accumulators
 import seven.arg_type
@@ -96,6 +104,7 @@ class Control(object):
         parser.add_argument('--debug', action='store_true')
         parser.add_argument('--test', action='store_true')
         parser.add_argument('--trace', action='store_true')
+        parser.add_argument('--walk-workers', type=seven.arg_type.positive_int, default=8)
 
         arg = parser.parse_args(argv[1:])
 
@@ -121,6 +130,7 @@ class Control(object):
             trace=arg.trace,
         )
         seven.dirutility.assure_exists(paths['dir_out'])
+        seven.dirutility.assure_exists(paths['dir_cache'])
 
         timer = seven.Timer.Timer()
 
@@ -227,11 +237,82 @@ class SignalRow:
         return self._row[self._column_name(field_name, rtt)]
 
 
+class SquaredErrorCache:
+    'the squared errors and counts from each signal.csv file, each in an .npz file keyed on (path, size, mtime)'
+    def __init__(self, dir_cache):
+        self._dir_cache = dir_cache
+
+    def __repr__(self):
+        return 'SquaredErrorCache(%s)' % self._dir_cache
+
+    def get(self, path, invocation_parameters):
+        'return (Dict[key, SquaredError], Counter) or (None, None) if the file at path is not cached'
+        stat = os.stat(path)
+        try:
+            with np.load(self._cache_path(path)) as npz:
+                if (str(npz['source_path']) != path or
+                        int(npz['source_size']) != stat.st_size or
+                        int(npz['source_mtime_ns']) != stat.st_mtime_ns):
+                    return None, None
+                columns = {name: npz[name].tolist() for name in npz.files}
+        except (OSError, ValueError, KeyError):
+            return None, None
+        squared_errors = {}
+        for ensemble, naive, rtt, trade_datetime, timedelta, event_source_identifier in zip(
+                columns['ensemble'],
+                columns['naive'],
+                columns['rtt'],
+                columns['trade_datetime'],
+                columns['timedelta'],
+                columns['event_source_identifier'],
+        ):
+            squared_error = SquaredError(
+                ensemble=ensemble,
+                naive=naive,
+                cusip=invocation_parameters['cusip'],
+                issuer=invocation_parameters['issuer'],
+                rtt=rtt,
+                trade_datetime=trade_datetime,
+                timedelta=timedelta,
+            )
+            squared_errors[(trade_datetime, squared_error.cusip, event_source_identifier)] = squared_error
+        counts = collections.Counter(dict(zip(columns['count_names'], columns['count_values'])))
+        return squared_errors, counts
+
+    def put(self, path, squared_errors, counts):
+        'write the cache file for the signal.csv file at path atomically'
+        stat = os.stat(path)
+        keys = list(squared_errors.keys())
+        values = [squared_errors[key] for key in keys]
+        cache_path = self._cache_path(path)
+        temp_path = cache_path + '.%d.temp' % os.getpid()
+        with open(temp_path, 'wb') as f:
+            np.savez(
+                f,
+                source_path=np.array(path),
+                source_size=np.array(stat.st_size, dtype=np.int64),
+                source_mtime_ns=np.array(stat.st_mtime_ns, dtype=np.int64),
+                ensemble=np.array([v.ensemble for v in values], dtype=np.float64),
+                naive=np.array([v.naive for v in values], dtype=np.float64),
+                rtt=np.array([v.rtt for v in values], dtype='U1'),
+                trade_datetime=np.array([v.trade_datetime for v in values], dtype='datetime64[us]'),
+                timedelta=np.array([v.timedelta for v in values], dtype='timedelta64[us]'),
+                event_source_identifier=np.array([key[2] for key in keys], dtype=str),
+                count_names=np.array(list(counts.keys()), dtype=str),
+                count_values=np.array(list(counts.values()), dtype=np.int64),
+            )
+        os.replace(temp_path, cache_path)
+
+    def _cache_path(self, path):
+        return os.path.join(self._dir_cache, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.npz')
+
+
 class Signals:
     'pull information out of signal.csv files'
-    def __init__(self, start_predictions, stop_predictions):
+    def __init__(self, start_predictions, stop_predictions, squared_error_cache=None):
         self.start_predictions = start_predictions
         self.stop_predictions = stop_predictions
+        self.squared_error_cache = squared_error_cache
 
         self.squared_errors = {}  # Dict[key, SquaredError]
         self.counter = collections.Counter()
@@ -256,10 +337,21 @@ class Signals:
         self.cusip_to_issuer[invocation_parameters['cusip']] = invocation_parameters['issuer']
         if os.path.isfile(path):
             self._count('files examined')
-            file_squared_errors = self._visit_signal_file(
-                path,
-                invocation_parameters,
+            file_squared_errors, file_counts = (
+                (None, None) if self.squared_error_cache is None else
+                self.squared_error_cache.get(path, invocation_parameters)
             )
+            if file_squared_errors is None:
+                counter_before = collections.Counter(self.counter)
+                file_squared_errors = self._visit_signal_file(
+                    path,
+                    invocation_parameters,
+                )
+                if self.squared_error_cache is not None:
+                    self.squared_error_cache.put(path, file_squared_errors, self.counter - counter_before)
+            else:
+                self._count('files read from the cache')
+                self.counter.update(file_counts)
             for k, v in file_squared_errors.items():
                 if k in self.squared_errors:
                     print('duplicate squared error result', k)
@@ -371,87 +463,83 @@ class Signals:
             return result
 
 
-def make_rmses(squared_errors: List[SquaredError]):
-    def rmse(v):
-        return math.sqrt(sum(v) / len(v))
+class SquaredErrorColumns:
+    'the squared errors as parallel np.arrays, with one element per squared error'
+    def __init__(self, squared_errors, cusip_to_issuer):
+        squared_errors = list(squared_errors)
+        self.ensemble = np.array([x.ensemble for x in squared_errors], dtype=np.float64)
+        self.naive = np.array([x.naive for x in squared_errors], dtype=np.float64)
+        self.cusip = np.array([x.cusip for x in squared_errors], dtype=str)
+        self.issuer = np.array([cusip_to_issuer[x.cusip] for x in squared_errors], dtype=str)
+        self.rtt = np.array([x.rtt for x in squared_errors], dtype=str)
+        self.trade_datetime = np.array([x.trade_datetime for x in squared_errors], dtype='datetime64[us]')
+        self.timedelta = np.array([x.timedelta for x in squared_errors], dtype='timedelta64[us]')
 
-    ensemble = []
-    naive = []
-    for squared_error in squared_errors:
-        ensemble.append(squared_error.ensemble)
-        naive.append(squared_error.naive)
-    return rmse(ensemble), rmse(naive)
+    def __len__(self):
+        return len(self.ensemble)
 
+    def __repr__(self):
+        return 'SquaredErrorColumns(%d squared errors)' % len(self)
+
+
+def write_groups(path, key_names, keys, columns):
+    'write the count and rmses of the squared errors with each distinct key, in sorted order of the keys'
+    # keys: List[np.array], one array for each key name, with one element per squared error
+    # code each key as the index of its value in the sorted distinct values, so that the sort order
+    # of the combined codes is the sort order of the tuples of key values
+    codes = np.zeros(len(columns), dtype=np.int64)
+    distinct_values = []
+    for key in keys:
+        values, indices = np.unique(key, return_inverse=True)
+        codes = codes * len(values) + indices.reshape(-1)
+        distinct_values.append(values)
+    group_codes, group_indices = np.unique(codes, return_inverse=True)
+    group_indices = group_indices.reshape(-1)
+    n_groups = len(group_codes)
+
+    # np.bincount adds the weights in the order of the squared errors, giving the same sums as sum()
+    counts = np.bincount(group_indices, minlength=n_groups)
+    rmse_ensemble = np.sqrt(np.bincount(group_indices, weights=columns.ensemble, minlength=n_groups) / counts)
+    rmse_naive = np.sqrt(np.bincount(group_indices, weights=columns.naive, minlength=n_groups) / counts)
+
+    group_keys = []  # List[List[key value]], parallel to key_names
+    remaining_codes = group_codes
+    for values in reversed(distinct_values):
+        if n_groups > 0:
+            group_keys.insert(0, values[remaining_codes % len(values)].tolist())
+            remaining_codes = remaining_codes // len(values)
+        else:
+            group_keys.insert(0, [])
 
-def write_by_cusip(squared_errors, cusip_to_issuer, path):
     with open(path, 'w') as f:
         writer = csv.DictWriter(
             f,
-            ['issuer', 'cusip', 'count', 'rmse_ensemble', 'rmse_naive'],
+            list(key_names) + ['count', 'rmse_ensemble', 'rmse_naive'],
             lineterminator='\n',
         )
         writer.writeheader()
-        # sort by issuer, then by cusip
-        squared_errors_by_issuer_cusip = collections.defaultdict(list)
-        for squared_error in squared_errors:
-            cusip = squared_error.cusip
-            issuer = cusip_to_issuer[cusip]
-            squared_errors_by_issuer_cusip[(issuer, cusip)].append(squared_error)
-        for k in sorted(squared_errors_by_issuer_cusip.keys()):
-            v = squared_errors_by_issuer_cusip[k]
-            ensemble, naive = make_rmses(v)
-            writer.writerow({
-                'issuer': k[0],
-                'cusip': k[1],
-                'count': len(v),
+        for i, (count, ensemble, naive) in enumerate(zip(counts.tolist(), rmse_ensemble.tolist(), rmse_naive.tolist())):
+            row = {
+                'count': count,
                 'rmse_ensemble': ensemble,
                 'rmse_naive': naive,
-            })
+            }
+            for key_name, values in zip(key_names, group_keys):
+                row[key_name] = values[i]
+            writer.writerow(row)
 
 
-def write_by_date(squared_errors, cusip_to_issuer, path):
-    with open(path, 'w') as f:
-        writer = csv.DictWriter(
-            f,
-            ['date', 'count', 'rmse_ensemble', 'rmse_naive'],
-            lineterminator='\n',
-        )
-        writer.writeheader()
-        squared_errors_by_date = collections.defaultdict(list)
-        for squared_error in squared_errors:
-            squared_errors_by_date[squared_error.trade_datetime.date()].append(squared_error)
-        for k in sorted(squared_errors_by_date.keys()):
-            v = squared_errors_by_date[k]
-            ensemble, naive = make_rmses(v)
-            writer.writerow({
-                'date': k,
-                'count': len(v),
-                'rmse_ensemble': ensemble,
-                'rmse_naive': naive,
-            })
+def write_by_cusip(columns, path):
+    # sort by issuer, then by cusip
+    write_groups(path, ['issuer', 'cusip'], [columns.issuer, columns.cusip], columns)
 
 
-def write_by_issuer(squared_errors, cusip_to_issuer, path):
-    with open(path, 'w') as f:
-        writer = csv.DictWriter(
-            f,
-            ['issuer', 'count', 'rmse_ensemble', 'rmse_naive'],
-            lineterminator='\n',
-        )
-        writer.writeheader()
-        squared_errors_by_issuer = collections.defaultdict(list)
-        for squared_error in squared_errors:
-            issuer = cusip_to_issuer[squared_error.cusip]
-            squared_errors_by_issuer[issuer].append(squared_error)
-        for issuer in sorted(squared_errors_by_issuer.keys()):
-            v = squared_errors_by_issuer[issuer]
-            ensemble, naive = make_rmses(v)
-            writer.writerow({
-                'issuer': issuer,
-                'count': len(v),
-                'rmse_ensemble': ensemble,
-                'rmse_naive': naive,
-            })
+def write_by_date(columns, path):
+    write_groups(path, ['date'], [columns.trade_datetime.astype('datetime64[D]')], columns)
+
+
+def write_by_issuer(columns, path):
+    write_groups(path, ['issuer'], [columns.issuer], columns)
 
 
 def write_by_n_trades(by_n_trades, issuer_dict, path):
@@ -470,96 +558,29 @@ def write_by_n_trades(by_n_trades, issuer_dict, path):
             })
 
 
-def write_by_rtt(squared_errors, cusip_to_issuer, path):
-    with open(path, 'w') as f:
-        writer = csv.DictWriter(
-            f,
-            ['reclassified_trade_type', 'count', 'rmse_ensemble', 'rmse_naive'],
-            lineterminator='\n',
-        )
-        writer.writeheader()
-        squared_errors_by_rtt = collections.defaultdict(list)
-        for squared_error in squared_errors:
-            rtt = squared_error.rtt
-            squared_errors_by_rtt[rtt].append(squared_error)
-        for rtt in sorted(squared_errors_by_rtt.keys()):
-            v = squared_errors_by_rtt[rtt]
-            ensemble, naive = make_rmses(v)
-            writer.writerow({
-                'reclassified_trade_type': rtt,
-                'count': len(v),
-                'rmse_ensemble': ensemble,
-                'rmse_naive': naive,
-            })
+def write_by_rtt(columns, path):
+    write_groups(path, ['reclassified_trade_type'], [columns.rtt], columns)
 
 
-def write_by_timedelta_hours(squared_errors, cusip_to_issuer, path):
-    with open(path, 'w') as f:
-        writer = csv.DictWriter(
-            f,
-            ['timedelta_hours', 'count', 'rmse_ensemble', 'rmse_naive'],
-            lineterminator='\n',
-        )
-        writer.writeheader()
-        squared_errors_by_timedelta_hours = collections.defaultdict(list)
-        for squared_error in squared_errors:
-            hours = int(squared_error.timedelta.total_seconds() / 60 / 60)
-            squared_errors_by_timedelta_hours[hours].append(squared_error)
-        for hours in sorted(squared_errors_by_timedelta_hours.keys()):
-            v = squared_errors_by_timedelta_hours[hours]
-            ensemble, naive = make_rmses(v)
-            writer.writerow({
-                'timedelta_hours': hours,
-                'count': len(v),
-                'rmse_ensemble': ensemble,
-                'rmse_naive': naive,
-            })
+def _timedelta_seconds(columns):
+    'return np.array of float, the total_seconds() of each timedelta'
+    return columns.timedelta.astype(np.int64) / 1e6
 
 
-def write_by_timedelta_minutes(squared_errors, cusip_to_issuer, path):
-    with open(path, 'w') as f:
-        writer = csv.DictWriter(
-            f,
-            ['timedelta_minutes', 'count', 'rmse_ensemble', 'rmse_naive'],
-            lineterminator='\n',
-        )
-        writer.writeheader()
-        squared_errors_by_timedelta_minutes = collections.defaultdict(list)
-        for squared_error in squared_errors:
-            minutes = int(squared_error.timedelta.total_seconds() / 60)
-            squared_errors_by_timedelta_minutes[minutes].append(squared_error)
-        for minutes in sorted(squared_errors_by_timedelta_minutes.keys()):
-            v = squared_errors_by_timedelta_minutes[minutes]
-            ensemble, naive = make_rmses(v)
-            writer.writerow({
-                'timedelta_minutes': minutes,
-                'count': len(v),
-                'rmse_ensemble': ensemble,
-                'rmse_naive': naive,
-            })
+def write_by_timedelta_hours(columns, path):
+    hours = np.trunc(_timedelta_seconds(columns) / 60 / 60).astype(np.int64)
+    write_groups(path, ['timedelta_hours'], [hours], columns)
 
 
-def write_by_trade_hour(squared_errors, cusip_to_issuer, path):
-    with open(path, 'w') as f:
-        writer = csv.DictWriter(
-            f,
-            ['trade_hour', 'count', 'rmse_ensemble', 'rmse_naive'],
-            lineterminator='\n',
-        )
-        writer.writeheader()
-        squared_errors_by_trade_hour = collections.defaultdict(list)
-        for squared_error in squared_errors:
-            trade_hour = squared_error.trade_datetime.hour
-            squared_errors_by_trade_hour[trade_hour].append(squared_error)
-        for trade_hour in sorted(squared_errors_by_trade_hour.keys()):
-            v = squared_errors_by_trade_hour[trade_hour]
-            ensemble, naive = make_rmses(v)
-            writer.writerow({
-                'trade_hour': trade_hour,
-                'count': len(v),
-                'rmse_ensemble': ensemble,
-                'rmse_naive': naive,
-            })
+def write_by_timedelta_minutes(columns, path):
+    minutes = np.trunc(_timedelta_seconds(columns) / 60).astype(np.int64)
+    write_groups(path, ['timedelta_minutes'], [minutes], columns)
+
+
+def write_by_trade_hour(columns, path):
+    trade_datetime = columns.trade_datetime
+    trade_hour = (trade_datetime - trade_datetime.astype('datetime64[D]')) // np.timedelta64(1, 'h')
+    write_groups(path, ['trade_hour'], [trade_hour.astype(np.int64)], columns)
 
 
 def write_invocation(arg, path):
@@ -610,32 +631,26 @@ def write_squared_errors(squared_errors, cusip_to_issuer, path):
             })
 
 
-def write_overall(squared_errors, cusip_to_issuer, path):
-    with open(path, 'w') as f:
-        writer = csv.DictWriter(
-            f,
-            ['count', 'rmse_ensemble', 'rmse_naive'],
-            lineterminator='\n',
-        )
-        writer.writeheader()
-        ensemble, naive = make_rmses(squared_errors)
-        writer.writerow({
-            'count': len(squared_errors),
-            'rmse_ensemble': ensemble,
-            'rmse_naive': naive,
-        })
+def write_overall(columns, path):
+    write_groups(path, [], [], columns)
 
 
 def do_work(control):
     # applied_data_science.lower_priority.lower_priority()
     write_invocation(control.arg, control.path['out_invocation'])
-    signals = Signals(control.arg.start_predictions, control.arg.stop_predictions)
+    signals = Signals(
+        control.arg.start_predictions,
+        control.arg.stop_predictions,
+        SquaredErrorCache(control.path['dir_cache']),
+    )
 
     # visit each expert.csv file and extract its content
     walker = seven.WalkTestTrainOutputDirectories.WalkTestTrainOutputDirectories(
         control.path['dir_in'],
         control.arg.upstream_version,
         control.arg.feature_version,
+        manifest_path=control.path['walk_manifest'],
+        n_workers=control.arg.walk_workers,
     )
     walker.walk_prediction_dates_between(
         visit=signals.visit_test_train_output_directory,
@@ -657,8 +672,10 @@ def do_work(control):
 
     # NOTE: This analysis is flawed in that it only considers actuals on the same date as the prediction
 
+    columns = SquaredErrorColumns(signals.squared_errors.values(), signals.cusip_to_issuer)
+
     def write(f, path):
-        f(signals.squared_errors.values(), signals.cusip_to_issuer, control.path[path])
+        f(columns, control.path[path])
 
     write(write_by_cusip, 'out_rmse_by_cusip')
     write(write_by_date, 'out_rmse_by_date')
@@ -667,7 +684,7 @@ def do_work(control):
     write(write_by_timedelta_minutes, 'out_rmse_by_timedelta_minutes')
     write(write_by_timedelta_hours, 'out_rmse_by_timedelta_hours')
     write(write_by_trade_hour, 'out_rmse_by_trade_hour')
-    write(write_squared_errors, 'out_squared_errors')
+    write_squared_errors(signals.squared_errors.values(), signals.cusip_to_issuer, control.path['out_squared_errors'])
     write(write_overall, 'out_rmse_overall')
 
     return None
@@ -2,7 +2,7 @@
 
 INVOCATION
   python analyze_experts.py {test_train_output_location} start_predictions stop_predictions upstream_version feature_version
-  [--debug] [--test] [--trace]
+  [--debug] [--test] [--trace] [--walk-workers {n}]
 where
  test_train_location is {midpredictor, dev} tells where to find the output of the test_train program
   'dev'  --> its in .../Dropbox/data/7chord/7chord-01/working/test_train/
@@ -21,6 +21,9 @@ where
    and logging.error()
  --test means to set control.test, so that test code is executed
  --trace means to invoke pdb.set_trace() early in execution
+ --walk-workers {n} means to walk the test_train output directories of the issuers using n threads
+   The default is 8. The walk records the directories it lists in a manifest next to the test_train
+   output location, which is shared with the other analysis programs. See seven/WalkTestTrainOutputDirectories.py.
 
 EXAMPLES OF INVOCATION
   python anayze_experts.py dev 2016-01-01 2017-12-31--debug
@@ -58,6 +61,7 @@ import seven.Logger
 import seven.logging
 import seven.lower_priority
 import seven.make_event_attributes
+import seven.MeanAccumulator
 import seven.models2
 import seven.read_csv
 import seven.pickle_utilities
@@ -102,6 +106,7 @@ class Control(object):
         parser.add_argument('--debug', action='store_true')
         parser.add_argument('--test', action='store_true')
         parser.add_argument('--trace', action='store_true')
+        parser.add_argument('--walk-workers', type=seven.arg_type.positive_int, default=8)
 
         arg = parser.parse_args(argv[1:])
 
@@ -145,7 +150,12 @@ class Experts(object):
         self._security_master = security_master
 
         # the main output of visit_...
-        self._expert_rows = []  # List[ExpertRow] from all the input files
+        # the weights are accumulated as the rows are read, so that memory does not grow with the number of rows
+        self._n_expert_rows = 0
+        self._weights = seven.MeanAccumulator.MeanAccumulator()                  # key = (expert,)
+        self._weights_by_date = seven.MeanAccumulator.MeanAccumulator()          # key = (date, expert)
+        self._weights_by_issuer = seven.MeanAccumulator.MeanAccumulator()        # key = (issuer, expert)
+        self._weights_by_issuer_cusip = seven.MeanAccumulator.MeanAccumulator()  # key = (issuer, cusip, expert)
 
         # these are for reporting only
         self._no_content = []
@@ -153,7 +163,7 @@ class Experts(object):
         self._visit_counter = collections.Counter()
 
     def __repr__(self):
-        return 'Experts(%d expert rows)' % len(self._expert_rows)
+        return 'Experts(%d expert rows)' % self._n_expert_rows
 
     def report_files(self):
         print('\n******************\nreport on visiting experts.csv files\n')
@@ -173,7 +183,7 @@ class Experts(object):
         print('# directories without an experts.csv file', len(self._no_files))
         print('# experts.csv files without any rows', len(self._no_content))
 
-        print('\ntotal number of expert accuracies found: %d' % len(self._expert_rows))
+        print('\ntotal number of expert accuracies found: %d' % self._n_expert_rows)
 
     def report_mean_weights(self, path):
         mean_weights = sorted(
@@ -318,7 +328,7 @@ class Experts(object):
                         writer_top_k.writerow(row)
 
     def visit_test_train_output_directory(self, directory_path, invocation_parameters, verbose=True):
-        'update self._experts_rows with info in {directory_path}/experts.csv'
+        'accumulate the weights in {directory_path}/experts.csv'
         self._visit_counter['directories visited'] += 1
         print('visiting', directory_path)
         path = os.path.join(directory_path, 'experts.csv')
@@ -330,7 +340,7 @@ class Experts(object):
                 for row in csv_reader:
                     n_rows += 1
                     expert_row = ExpertRow(row, self._security_master)
-                    self._expert_rows.append(expert_row)
+                    self._accumulate(expert_row)
                     self._visit_counter['rows saved'] += 1
                 if n_rows == 0:
                     self._no_content.append(path)
@@ -339,71 +349,31 @@ class Experts(object):
             self._no_files.append(directory_path)
             self._visit_counter['directories without an expert.csv file'] += 1
 
+    def _accumulate(self, expert_row):
+        issuer = expert_row.issuer()
+        expert = expert_row.expert()
+        weight = expert_row.weight()
+        self._n_expert_rows += 1
+        self._weights.add((expert,), weight)
+        self._weights_by_date.add((expert_row.date(), expert), weight)
+        self._weights_by_issuer.add((issuer, expert), weight)
+        self._weights_by_issuer_cusip.add((issuer, expert_row.cusip(), expert), weight)
+
     def _mean_weights(self):
         'return List[expert, mean weight]'
-        total_weights = collections.defaultdict(float)  # Dict[expert, float]
-        counts = collections.defaultdict(int)           # Dict[expert, int]
-        for expert_row in self._expert_rows:
-            expert = expert_row.expert()
-            total_weights[expert] += expert_row.weight()
-            counts[expert] += 1
-        result = []
-        for expert, total_weight in total_weights.items():
-            result.append((expert, total_weight / counts[expert]))
-        return result
+        return self._weights.means()
 
     def _mean_weights_by_date(self):
         'return List[Tuple[date, expert, mean weight]]'
-        total_weights = collections.defaultdict(lambda: collections.defaultdict(float))
-        counts = collections.defaultdict(lambda: collections.defaultdict(int))
-        for expert_row in self._expert_rows:
-            date = expert_row.date()
-            expert = expert_row.expert()
-            weight = expert_row.weight()
-            total_weights[date][expert] += weight
-            counts[date][expert] += 1
-        result = []
-        for date, experts_totalweights in total_weights.items():
-            for expert, total_weight in experts_totalweights.items():
-                mean_weight = total_weight / counts[date][expert]
-                result.append((date, expert, mean_weight))
-        return result
+        return self._weights_by_date.means()
 
     def _mean_weights_by_issuer(self):
         'return List[Tuple[issuer, expert, mean weight]]'
-        total_weights = collections.defaultdict(lambda: collections.defaultdict(float))
-        counts = collections.defaultdict(lambda: collections.defaultdict(int))
-        for expert_row in self._expert_rows:
-            issuer = expert_row.issuer()
-            expert = expert_row.expert()
-            weight = expert_row.weight()
-            total_weights[issuer][expert] += weight
-            counts[issuer][expert] += 1
-        result = []
-        for issuer, experts_totalweights in total_weights.items():
-            for expert, total_weight in experts_totalweights.items():
-                mean_weight = total_weight / counts[issuer][expert]
-                result.append((issuer, expert, mean_weight))
-        return result
+        return self._weights_by_issuer.means()
 
     def _mean_weights_by_issuer_cusip(self):
         'return List[Tuple[issuer, cusip, expert, mean weight]]'
-        total_weights = collections.defaultdict(lambda: collections.defaultdict(lambda: collections.defaultdict(float)))
-        counts = collections.defaultdict(lambda: collections.defaultdict(lambda: collections.defaultdict(int)))
-        for expert_row in self._expert_rows:
-            issuer = expert_row.issuer()
-            cusip = expert_row.cusip()
-            expert = expert_row.expert()
-            weight = expert_row.weight()
-            total_weights[issuer][cusip][expert] += weight
-            counts[issuer][cusip][expert] += 1
-        result = []
-        for issuer, d1 in total_weights.items():
-            for cusip, d2 in d1.items():
-                for expert, total_weight in d2.items():
-                    mean_weight = total_weight / counts[issuer][cusip][expert]
-                    result.append((issuer, cusip, expert, mean_weight))
-        return result
+        return self._weights_by_issuer_cusip.means()
 
     def _sort_dict_by_valueOLD(self, d, reverse=False):
         'return List[tuples(key, value)]'
@@ -500,6 +470,8 @@ def do_work(control):
         control.path['dir_in'],
         control.arg.upstream_version,
         control.arg.feature_version,
+        manifest_path=control.path['walk_manifest'],
+        n_workers=control.arg.walk_workers,
         )
     walker.walk_prediction_dates_between(
         visit=experts.visit_test_train_output_directory,
@@ -1,7 +1,8 @@
 '''analyze the importances using the normalized weights from forming an ensemble model
 
 INVOCATION
-  python analyze_importances.py {test_train_output_location} upstream_version feature_version [--debug] [--test] [--trace]
+  python analyze_importances.py {test_train_output_location} upstream_version feature_version [--debug] [--test] [--trace] [--walk-workers {n}]
+    [--read-workers {n}]
 where
  test_train_location is {midpredictor, dev} tells where to find the output of the test_train program
   dev  --> its in .../Dropbox/data/7chord/7chord-01/working/test_train/
@@ -19,6 +20,14 @@ where
    and logging.error()
  --test means to set control.test, so that test code is executed
  --trace means to invoke pdb.set_trace() early in execution
+ --walk-workers {n} means to walk the test_train output directories of the issuers using n threads
+   The default is 8. The walk records the directories it lists in a manifest next to the test_train
+   output location, which is shared with the other analysis programs. See seven/WalkTestTrainOutputDirectories.py.
+ --read-workers {n} means to read the importances.csv files using a pool of n processes
+   Each process reads a shard of the directories and returns the total and count of the absolute
+   importances for each key, which are merged in the main process. The default is 1, which reads
+   the files in the main process. Because the totals of the shards are added, the means may differ
+   in their last digits from those found with one worker.
 
 EXAMPLES OF INVOCATION
   python anayze_importances.py 2016-01-01 2017-12-31 --debug
@@ -33,6 +42,7 @@ import argparse
 import copy
 import csv
 import collections
+import concurrent.futures
 import datetime
 import math
 import os
@@ -53,6 +63,7 @@ import seven.HpGrids
 import seven.logging
 import seven.lower_priority
 import seven.make_event_attributes
+import seven.MeanAccumulator
 import seven.Logger
 import seven.models2
 import seven.read_csv
@@ -98,6 +109,8 @@ class Control(object):
         parser.add_argument('--debug', action='store_true')
         parser.add_argument('--test', action='store_true')
         parser.add_argument('--trace', action='store_true')
+        parser.add_argument('--read-workers', type=seven.arg_type.n_processes, default=1)
+        parser.add_argument('--walk-workers', type=seven.arg_type.positive_int, default=8)
 
         arg = parser.parse_args(argv[1:])
 
@@ -141,7 +154,12 @@ class Importances(object):
         self._security_master = security_master
 
         # the main output of visit_...
-        self._importance_rows = []  # List[ImportanceRow] from all the input files
+        self._directory_paths = []  # List[str], the directories to be read by read_files()
+
+        # the main output of read_files()
+        self._n_importance_rows = 0
+        self._importances = seven.MeanAccumulator.MeanAccumulator()          # key = (model_family, feature_name)
+        self._importances_by_date = seven.MeanAccumulator.MeanAccumulator()  # key = (date, model_family, feature_name)
 
         # these are for reporting only
         self._no_content = []
@@ -149,7 +167,7 @@ class Importances(object):
         self._visit_counter = collections.Counter()
 
     def __repr__(self):
-        return 'Importances(%d importance rows)' % len(self._expert_rows)
+        return 'Importances(%d importance rows)' % self._n_importance_rows
 
     def report_files(self):
         print('\n******************\nreport on importances.csv files')
@@ -166,7 +184,7 @@ class Importances(object):
         print('# directories without an importances.csv file', len(self._no_files))
         print('# importances.csv files without any rows', len(self._no_content))
 
-        print('\ntotal number of importances found: %d' % len(self._importance_rows))
+        print('\ntotal number of importances found: %d' % self._n_importance_rows)
 
     def report_mean_importance(self, path):
         importances = sorted(
@@ -349,66 +367,40 @@ class Importances(object):
                     if lines_since_new_cusip <= k:
                         writer_top_k.writerow(row)
 
+    def read_files(self, n_workers=1):
+        'read the importances.csv file in each visited directory, using n_workers processes'
+        if n_workers == 1:
+            shard_results = [read_importances_files(self._directory_paths)]
+        else:
+            # several shards per worker, so that the workers finish at about the same time
+            shard_size = max(1, len(self._directory_paths) // (4 * n_workers))
+            shards = [
+                self._directory_paths[start:start + shard_size]
+                for start in range(0, len(self._directory_paths), shard_size)
+            ]
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+                shard_results = list(executor.map(read_importances_files, shards))
+        for shard_result in shard_results:
+            self._n_importance_rows += shard_result.n_importance_rows
+            self._importances.merge(shard_result.importances)
+            self._importances_by_date.merge(shard_result.importances_by_date)
+            self._no_content.extend(shard_result.no_content)
+            self._no_files.extend(shard_result.no_files)
+            self._visit_counter.update(shard_result.counter)
+
     def visit_test_train_output_directory(self, directory_path, invocation_parameters, verbose=True):
-        'update self._importances_rows with info in {directory_path}/importances.csv'
+        'remember the directory, so that read_files() will read its importances.csv file'
         self._visit_counter['directories visited'] += 1
         print('visiting', directory_path)
-        path = os.path.join(directory_path, 'importances.csv')
-        if os.path.isfile(path):
-            self._visit_counter['files examined'] += 1
-            with open(path) as f:
-                csv_reader = csv.DictReader(f)
-                n_rows = 0
-                for row in csv_reader:
-                    n_rows += 1
-                    self._importance_rows.append(ImportanceRow(row, self._security_master))
-                    self._visit_counter['rows saved'] += 1
-                if n_rows == 0:
-                    self._no_content.append(path)
-                    self._visit_counter['importances.csv files without data rows'] += 1
-        else:
-            self._no_files.append(dir)
-            self._visit_counter['directories without an expert.csv file']
+        self._directory_paths.append(directory_path)
 
     def _mean_importance(self):
         'return List[Tuple[model_family, feature_name, mean_absolute_importance]]'
-        dd = collections.defaultdict
-        total_importance = dd(lambda: collections.defaultdict(float))
-        count = dd(lambda: collections.defaultdict(int))
-        for row in self._importance_rows:
-            total_importance[row.model_family()][row.feature_name()] += abs(row.importance())
-            count[row.model_family()][row.feature_name()] += 1
-        result = []
-        for model_family, d in total_importance.items():
-            for feature_name, importance in d.items():
-                item = (
-                    model_family,
-                    feature_name,
-                    total_importance[model_family][feature_name] / count[model_family][feature_name],
-                )
-                result.append(item)
-        return result
+        return self._importances.means()
 
     def _mean_importance_by_date(self):
         'return List[Tuple[date, model_family, feature_name, mean_absolute_importance]]'
-        dd = collections.defaultdict
-        total_importance = dd(lambda: dd(lambda: dd(float)))
-        count = dd(lambda: dd(lambda: dd(int)))
-        for row in self._importance_rows:
-            total_importance[row.date()][row.model_family()][row.feature_name()] += abs(row.importance())
-            count[row.date()][row.model_family()][row.feature_name()] += 1
-        result = []
-        for date, d1 in total_importance.items():
-            for model_family, d2 in d1.items():
-                for feature_name, importance in d2.items():
-                    item = (
-                        date,
-                        model_family,
-                        feature_name,
-                        total_importance[date][model_family][feature_name] / count[date][model_family][feature_name],
-                    )
-                    result.append(item)
-        return result
+        return self._importances_by_date.means()
 
     def _mean_weights_by_date(self):
         'return List[Tuple[date, expert, mean weight]]'
@@ -477,6 +469,53 @@ class Importances(object):
         return result
 
 
+ShardResult = collections.namedtuple(
+    'ShardResult',
+    'n_importance_rows importances importances_by_date no_content no_files counter',
+)
+
+
+def read_importances_files(directory_paths):
+    'return ShardResult with the partial aggregates of the importances.csv files in the directories'
+    # runs in a worker process when --read-workers is more than 1
+    importances = seven.MeanAccumulator.MeanAccumulator()
+    importances_by_date = seven.MeanAccumulator.MeanAccumulator()
+    n_importance_rows = 0
+    no_content = []
+    no_files = []
+    counter = collections.Counter()
+    for directory_path in directory_paths:
+        path = os.path.join(directory_path, 'importances.csv')
+        if os.path.isfile(path):
+            counter['files examined'] += 1
+            with open(path) as f:
+                csv_reader = csv.DictReader(f)
+                n_rows = 0
+                for row in csv_reader:
+                    n_rows += 1
+                    importance_row = ImportanceRow(row, None)
+                    absolute_importance = abs(importance_row.importance())
+                    key = (importance_row.model_family(), importance_row.feature_name())
+                    importances.add(key, absolute_importance)
+                    importances_by_date.add((importance_row.date(),) + key, absolute_importance)
+                    counter['rows saved'] += 1
+                n_importance_rows += n_rows
+                if n_rows == 0:
+                    no_content.append(path)
+                    counter['importances.csv files without data rows'] += 1
+        else:
+            no_files.append(directory_path)
+            counter['directories without an importances.csv file'] += 1
+    return ShardResult(
+        n_importance_rows=n_importance_rows,
+        importances=importances,
+        importances_by_date=importances_by_date,
+        no_content=no_content,
+        no_files=no_files,
+        counter=counter,
+    )
+
+
 class ImportanceRow(object):
     def __init__(self, row, security_master):
         # Note: in order by column in the csv file
@@ -567,12 +606,15 @@ def do_work(control):
         control.path['dir_in'],
         control.arg.upstream_version,
         control.arg.feature_version,
+        manifest_path=control.path['walk_manifest'],
+        n_workers=control.arg.walk_workers,
         )
     walker.walk_prediction_dates_between(
         visit=importances.visit_test_train_output_directory,
         start_date=control.arg.start_predictions,
         stop_date=control.arg.stop_predictions,
     )
+    importances.read_files(control.arg.read_workers)
 
     importances.report_files()
     importances.report_mean_importance(control.path['out_mean_importance'])
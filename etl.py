@@ -6,6 +6,7 @@
 #     in_secmaster_path              : str, path to secmaster
 #     in_trace_template              : str, template to generate paths to trace print files
 #     in_liq_flow_on_the_run_template: str, tempalte to generate paths to liq flow files
+#     message_codec: optional str   : codec for TracePrint messages, "json" (default) or "binary.1"
 #     out_events: optional str       : if supplied, events are written to specified file
 #                                      if not supplied, events are written to "queue,{cusip}"
 #     output_start: iso-date str     : OutputStart message is sent first thing on this simulated date
@@ -29,6 +30,9 @@ import shared_queue
 
 
 class Event:
+    # the sort key is computed once, as the EventQueue heap compares events repeatedly
+    __slots__ = ('datetime', 'source', 'source_identifier', 'payload', 'sort_key')
+
     def __init__(
             self,
             datetime: datetime.datetime,
@@ -40,6 +44,14 @@ class Event:
         self.source = source
         self.source_identifier = source_identifier
         self.payload = payload
+        self.sort_key = (
+            # microseconds since 0001-01-01
+            ((datetime.toordinal() - 1) * 86400 + (datetime.hour * 60 + datetime.minute) * 60 + datetime.second) *
+            1000000 + datetime.microsecond,
+            source,
+            source_identifier,
+            len(payload),
+        )
 
     def __repr__(self):
         return 'Event(%s, %s, %s, %s)' % (
@@ -49,30 +61,27 @@ class Event:
             self.payload,
             )
 
-    def _as_tuple(self):
-        return (self.datetime, self.source, self.source_identifier, len(self.payload))
-
     def __eq__(self, other):
         # ref: http://portingguide.readthedocs.io/en/latest/comparisons.html
-        return self._as_tuple() == other._as_tuple()
+        return self.sort_key == other.sort_key
 
     def __ge__(self, other):
-        return self._as_tuple() >= other._as_tuple()
+        return self.sort_key >= other.sort_key
 
     def __gt__(self, other):
-        return self._as_tuple() > other._as_tuple()
+        return self.sort_key > other.sort_key
 
     def __le__(self, other):
-        return self._as_tuple() <= other._as_tuple()
+        return self.sort_key <= other.sort_key
 
     def __lt__(self, other):
-        return self._as_tuple() < other._as_tuple()
+        return self.sort_key < other.sort_key
 
     def __ne__(self, other):
-        return self._as_tuple() != other._as_tuple()
+        return self.sort_key != other.sort_key
 
     def __hash__(self):
-        return hash(self._as_tuple())
+        return hash(self.sort_key)
 
 
 class EventReader(abc.ABC):
@@ -224,16 +233,17 @@ class EventReaderSetVersionETL(EventReaderOnce):
         
 class EventQueue:
     'maintain datetime-ordered queue of events'
+    # the heap items are (event.sort_key, reader_index, event, event_reader)
     def __init__(self, event_readers, config):
         self._config = copy.copy(config)
         self._event_readers = copy.copy(event_readers)
 
         self._event_queue = []  # will be a python heapq
-        for event_reader in event_readers:
+        for reader_index, event_reader in enumerate(event_readers):
             try:
                 event = next(event_reader)
                 print('\ninitial event', event)
-                heapq.heappush(self._event_queue, (event, event_reader))
+                heapq.heappush(self._event_queue, (event.sort_key, reader_index, event, event_reader))
             except StopIteration:
                 print('event queue is initially empty', event_reader)
                 pdb.set_trace()
@@ -241,14 +251,14 @@ class EventQueue:
     def __next__(self):
         'return Event or raise StopIteration'
         try:
-            oldest_event, event_reader = heapq.heappop(self._event_queue)
+            sort_key, reader_index, oldest_event, event_reader = heapq.heappop(self._event_queue)
         except IndexError:
             raise StopIteration
 
         # replace the oldest event with the next event from the same event reader
         try:
             new_event = next(event_reader)
-            heapq.heappush(self._event_queue, (new_event, event_reader))
+            heapq.heappush(self._event_queue, (new_event.sort_key, reader_index, new_event, event_reader))
         except StopIteration:
             # there is no new event available from the event reader
             event_reader.close()
@@ -349,6 +359,7 @@ def do_work(config, verbose=True):
         paths_for_output=ExchangeRoutingPathMaker(config.get('out_events_base')).make_paths_for_output,
         )
     channel = connection.channel()
+    message_codec = config.get('message_codec', 'json')
 
     secmaster = SecMaster(
         path=config.get('in_secmaster_path'),
@@ -360,6 +371,18 @@ def do_work(config, verbose=True):
     routing_key = 'events.%s' % primary_cusip
     exchange = 'dummy_exchange'
 
+    if message_codec != 'json':
+        # announce the codec before sending any message that uses it
+        channel.publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=str(shared_message.make_set_codec(
+                source='etl.py',
+                identifier=str(datetime.datetime.now()),
+                codec=message_codec,
+            )),
+            )
+
     event_queue = make_event_queue(config, issuer)
     otr_cusip = {}  # key: cusip, value: int (>= 1)
     while True:
@@ -377,7 +400,7 @@ def do_work(config, verbose=True):
                 channel.publish(
                     exchange=exchange,
                     routing_key=routing_key,
-                    body=str(shared_message.TracePrint(
+                    body=shared_message.to_string(shared_message.TracePrint(
                         source='trace_%s.csv' % issuer,
                         identifier=event.source_identifier,
                         cusip=event.payload['cusip'],
@@ -387,7 +410,9 @@ def do_work(config, verbose=True):
                         trade_type=event.payload['trade_type'],
                         reclassified_trade_type=event.payload['reclassified_trade_type'],
                         cancellation_probability=0.0,  # for now
-                    )),
+                        ),
+                        codec=message_codec,
+                    ),
                     )
             else:
                 vp('trace print for neither primary nor OTR cusip')
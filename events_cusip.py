@@ -12,6 +12,17 @@ The configuration file specifies the input source, which is either
 - a file in the file system (used for development and some testing), or
 - a queue in RabbitMQ (used for some testing and production).
 
+In service mode, one instance of the program serves every primary cusip in the configuration
+value service_primary_cusips (a list of str). The queues are read and written by asyncio tasks
+in one event loop. For each primary cusip, the messages read are placed in a bounded queue with
+max_queued_messages (default 1000) entries, so that reading waits when the feature vector
+construction falls behind. The output messages for an input message are published in order before
+the next input message is handled; publishing appends to buffered files, so it does not wait on
+the consumers. Other configuration values used in service mode:
+- poll_interval: seconds to wait before reading an input queue that was at end of file (default 0.1)
+- inactivity_timeout: stop reading an input queue when it has had no message for this many
+  seconds (default None, which stops at end of file)
+
 The program reads the input until end of file. The messages in the input cause the_date
 program to take the actions indicated below.
 
@@ -49,7 +60,7 @@ program to take the actions indicated below.
 
 - TracePrintCancel
     This message cancels a trace print message by naming its issuepriceid. Any
-    feature vectors
+    feature vectors created after the cancellation are built without it.
 
 - (other events that create features)
     For now, only trace prints create features. Later, other events, like equity tickers
@@ -102,8 +113,11 @@ Follow these steps to add a feature (such as equity ticker prices)
 4. Run test cases (back tests) to assess the extent to which the new feature
    improves prediction accuracy.
 '''
+import asyncio
+import collections
 import copy
 import datetime
+import itertools
 import pdb
 from pprint import pprint as pp
 import sys
@@ -187,15 +201,69 @@ class OldFeatureVectorMaker(object):
 
         
 class TracePrintSequence:
-    def __init__(self):
-        self._msgs = []
+    'the trace prints that may be needed to build the feature vectors for the most recent primary cusip trades'
+    # Each (cusip, reclassified_trade_type) has a deque of its trace prints in order of arrival.
+    # The triggers are the most recent max_n_trades_back trace prints (counting tombstones) for the
+    # primary cusip and each reclassified trade type. The horizon is the sequence number of the
+    # oldest trigger. A trace print older than the horizon is discarded once its deque holds 2 newer
+    # live trace prints that are also older than the horizon, as these are all that any trigger
+    # needs from that deque. Hence a busy OTR cusip keeps every trace print that the oldest trigger
+    # needs. When the primary cusip has no triggers, each deque keeps its 2 most recent live prints.
+    #
+    # Each retained trace print is in an entry [sequence number, issuepriceid, msg], which is indexed
+    # by the issuepriceid. A replacement message overwrites the msg in its entry. A cancellation sets the
+    # msg to None, leaving a tombstone that is skipped when building features and is discarded
+    # with the other old entries. The feature vectors are cached and the cache entries that used
+    # a replaced or cancelled trace print are invalidated.
+    def __init__(self, primary_cusip, max_n_trades_back=None):
+        if max_n_trades_back is None:
+            max_n_trades_back = max(HpGrids.HpGrid5().n_trades_back_choices)
+        assert max_n_trades_back >= 1
+        self._primary_cusip = primary_cusip
+        self._max_n_trades_back = max_n_trades_back
+        self._n_accumulated = 0  # sequence number of the next trace print
+        self._prints = {}  # key = (cusip, rtt), value = deque[entry]
+        self._entries = {}  # key = issuepriceid of a retained msg, value = ((cusip, rtt), entry)
+        self._cached_feature_vectors = {}  # key = (trigger sequence number, cusips), value = FeatureVector
+        self._dependents = collections.defaultdict(set)  # key = issuepriceid, value = Set[cache key]
+
+    def __len__(self):
+        'number of retained trace prints, not counting tombstones'
+        return sum(1 for key, entry in self._entries.values() if entry[2] is not None)
 
     def accumulate(self, msg):
-        assert isinstance(msg, message.TracePrint)
-        print('todo: handle replacement messages')
-        # a replacement message has the same issuepriceid
-        self._msgs.append(msg)
-        # for now, save everything; later, discard msg that we will never use
+        assert isinstance(msg, shared_message.TracePrint)
+        if msg.issuepriceid in self._entries:
+            # a replacement message has the same issuepriceid
+            self._replace(msg)
+            return
+        key = (msg.cusip, msg.reclassified_trade_type)
+        if key not in self._prints:
+            self._prints[key] = collections.deque()
+        entry = [self._n_accumulated, msg.issuepriceid, msg]
+        self._prints[key].append(entry)
+        self._entries[msg.issuepriceid] = (key, entry)
+        self._n_accumulated += 1
+        horizon = self._horizon()
+        if msg.cusip == self._primary_cusip:
+            # the horizon may have moved, which allows discarding from every deque
+            for prints in self._prints.values():
+                self._discard_before(prints, horizon)
+        else:
+            self._discard_before(self._prints[key], horizon)
+
+    def cancel(self, issuepriceid: str):
+        'tombstone the trace print; return True if it was retained'
+        if issuepriceid not in self._entries:
+            return False  # never seen or already discarded
+        key, entry = self._entries[issuepriceid]
+        entry[2] = None
+        self._invalidate(issuepriceid)
+        return True
+
+    def most_recent(self, cusip: str, reclassified_trade_type: str, k: int):
+        'return List[msg] with the up to k most recent trace prints, the most recent first'
+        return [msg for sequence_number, msg in itertools.islice(self._live(cusip, reclassified_trade_type), k)]
 
     def feature_vectors(self,
                         cusips: typing.List[str],  # primary, otr1, otr2, ...
@@ -203,193 +271,150 @@ class TracePrintSequence:
                         required_reclassified_trade_type: str,
                         trace=False,
                         ):
-        'return List[feature_vectors] with length up to n_feature_vectors'
+        'return List[feature_vectors] with length up to n_feature_vectors, the most recent last'
+        # the i-th most recent trace print for the primary cusip and required trade type triggers
+        # a feature vector built from the trace prints at or before it
+        assert n_feature_vectors >= 0
         set_trace = machine_learning.make_set_trace(trace)
-        
-        def find_cusip(msgs, cusip):
-            'return first message with the specified cusip'
-            if False and trace:
-                pdb.set_trace()
-            for msg in msgs:
-                if msg.cusip == cusip:
-                    return msg
-            pdb.set_trace()
-            raise exception.NoMessageWithCusip(
-                cusip=cusip,
-                msgs=msgs,
+        cusips = tuple(cusips)
+        assert cusips[0] == self._primary_cusip
+        triggers = itertools.islice(
+            self._live(cusips[0], required_reclassified_trade_type),
+            min(n_feature_vectors, self._max_n_trades_back),
             )
-            
-        def find_cusip_rtt(msgs, cusip, rtt):
-            'return first msg with cusip and remaining messages'
-            if False and trace:
-                pdb.set_trace()
-            for i, msg in enumerate(msgs):
-                if msg.cusip == cusip and msg.reclassified_trade_type == rtt:
-                    return msg, msgs[i + 1:]
-            pdb.set_trace()
-            raise exception.NoPriorEventWithCusipAndRtt(
-                cusip=cusip,
-                rtt=rtt,
-                msgs=msgs,
+        result = []
+        for trigger_sequence_number, trigger in triggers:
+            set_trace()
+            cache_key = (trigger_sequence_number, cusips)
+            if cache_key not in self._cached_feature_vectors:
+                try:
+                    feature_vector, used = self._make_feature_vector(cusips, trigger_sequence_number, trigger)
+                except exception.NoFeatures:
+                    break  # older triggers have even fewer prior trace prints
+                self._cached_feature_vectors[cache_key] = feature_vector
+                for issuepriceid in used:
+                    self._dependents[issuepriceid].add(cache_key)
+            result.append(self._cached_feature_vectors[cache_key])
+        return list(reversed(result))
+
+    def _discard_before(self, prints, horizon):
+        'discard the oldest entries in the deque that no trigger at or after the horizon can use'
+        while len(prints) > 0 and prints[0][0] < horizon:
+            # the oldest entry is needed unless 2 newer live entries are also older than the horizon
+            n_newer_live = 0
+            for sequence_number, issuepriceid, msg in itertools.islice(prints, 1, None):
+                if sequence_number >= horizon or n_newer_live == 2:
+                    break
+                if msg is not None:
+                    n_newer_live += 1
+            if n_newer_live < 2:
+                return
+            self._evict(prints.popleft())
+
+    def _evict(self, entry):
+        'forget the entry, which was discarded from its deque'
+        sequence_number, issuepriceid, msg = entry
+        if issuepriceid in self._entries and self._entries[issuepriceid][1] is entry:
+            del self._entries[issuepriceid]
+            self._invalidate(issuepriceid)
+
+    def _horizon(self):
+        'return the sequence number of the oldest trigger, or a number past every entry if there are none'
+        horizon = None
+        for rtt in ('B', 'S'):
+            prints = self._prints.get((self._primary_cusip, rtt))
+            if prints is None or len(prints) == 0:
+                continue
+            oldest_trigger = prints[max(0, len(prints) - self._max_n_trades_back)]
+            if horizon is None or oldest_trigger[0] < horizon:
+                horizon = oldest_trigger[0]
+        return self._n_accumulated if horizon is None else horizon
+
+    def _invalidate(self, issuepriceid):
+        'discard the cached feature vectors that used the trace print'
+        for cache_key in self._dependents.pop(issuepriceid, ()):
+            self._cached_feature_vectors.pop(cache_key, None)
+
+    def _live(self, cusip, rtt):
+        'yield (sequence number, msg) for the trace prints that are not tombstones, the most recent first'
+        for sequence_number, issuepriceid, msg in reversed(self._prints.get((cusip, rtt), ())):
+            if msg is not None:
+                yield sequence_number, msg
+
+    def _make_feature_vector(self, cusips, trigger_sequence_number, trigger):
+        'return (FeatureVector, Set[issuepriceid] of the trace prints used) or raise NoFeatures'
+        feature_creators = (
+            ('trace_print', features.trace_print),
             )
-        
-        def cusip_features(msgs, cusip):
-            'return dict, unused_msgs'
-            if False and trace:
-                pdb.set_trace()
-            result_dict = {}
-            result_unused_messages = msgs
-            for rtt in ('B', 'S'):
-                first_msg, first_other_messages = find_cusip_rtt(msgs, cusip, rtt)
-                second_msg, second_other_messages = find_cusip_rtt(first_other_messages, cusip, rtt)
-                result_dict['id_first_%s_message_source' % rtt] = first_msg.source
-                result_dict['id_first_%s_message_identifier' % rtt] = first_msg.identifier
-                result_dict['id_second_%s_message_source' % rtt] = second_msg.source
-                result_dict['id_second_%s_message_identifier' % rtt] = second_msg.identifier
-                result_dict['trace_%s_oasspread' % rtt] = first_msg.oasspread
-                result_dict['trace_%s_oasspread_less_prior_%s' % (rtt, rtt)] = (
-                    first_msg.oasspread - second_msg.oasspread
-                    )
-                result_dict['trace_%s_oasspread_divided_by_prior_%s' % (rtt, rtt)] = (
-                        first_msg.oasspread / second_msg.oasspread if second_msg.oasspread != 0.0 else
-                        100.0
-                        )
-                if len(second_other_messages) < len(result_unused_messages):
-                    result_unused_messages = copy.copy(second_other_messages)
-            return result_dict, result_unused_messages
-            
-        def feature_vector(msgs, cusips, required_reclassified_trade_type):
-            'return (feature_vector, unused messages)'
-            def key_with_cusip_info(k, i):
-                first, *others = k.split('_')
-                return '%s_%s_%s' % (
-                    first,
-                    'primary' if i == 0 else 'otr%d' % i,
-                    k[len(first) + 1:],
+        feature_vector = features.FeatureVector()
+        feature_vector['id_target_oasspread'] = trigger.oasspread
+        feature_vector['id_target_reclassified_trade_type'] = trigger.reclassified_trade_type
+        feature_vector['id_trigger_source'] = trigger.source
+        feature_vector['id_trigger_identifier'] = trigger.identifier
+        feature_vector['id_trigger_event_datetime'] = trigger.datetime
+        used = {trigger.issuepriceid}
+        for cusip in cusips:
+            msgs = self._prior_prints(cusip, trigger_sequence_number)
+            used.update(msg.issuepriceid for msg in msgs)
+            for name, feature_creator in feature_creators:
+                cusip_features, unused = feature_creator(msgs, cusip)
+                # update feature names to incorporate the cusip
+                for k, v in cusip_features.items():
+                    key = (
+                        'id_%s_%s_%s' % (name, cusip, k[3:]) if k.startswith('id_') else
+                        '%s_%s_%s' % (name, cusip, k)
                     )
-            
-            if False and trace:
-                pdb.set_trace()
-            vp = machine_learning.make_verbose_print(False)
-            result_unused_messages = msgs
-            # NOTE: these field names are used by message.FeatureVectors.__repr__()
-            # Don't change them here unless you also change them there
-            trace_print_with_oasspread, _ = find_cusip_rtt(
-                msgs,
-                cusips[0],
-                required_reclassified_trade_type,
-                )
-            vp('trace_print_with_oasspread', trace_print_with_oasspread)
-            result_feature_vector = {
-                'id_target_oasspread': trace_print_with_oasspread.oasspread,
-                'id_target_reclassified_trade_type': required_reclassified_trade_type,
-                'id_trigger_source': msgs[0].source,
-                'id_trigger_identifier': msgs[0].identifier,
-                'id_trigger_reclassified_trade_type': msgs[0].reclassified_trade_type,
-                'id_trigger_event_datetime': msgs[0].datetime,
-                }
-            for i, cusip in enumerate(cusips):
-                cf, unused_messages = cusip_features(msgs, cusip)
-                vp('cusip_features result', i, cusip, len(cf), len(unused_messages))
-                result_feature_vector['id_feature_vector_%s' % ('primary' if i == 0 else 'otr%d' % i)] = cusip
-                for k, v in cf.items():
-                    # adjust the keys to reflect whether the features are from the primary or OTR cusip
-                    result_feature_vector[key_with_cusip_info(k, i)] = v
-                if len(unused_messages) < len(result_unused_messages):
-                    result_unused_messages = copy.copy(unused_messages)
-            return result_feature_vector, result_unused_messages
-        
-        def loop(msgs):
-            'return (feature_vectors, unused messages)'
-            vp = machine_learning.make_verbose_print(False)
-            set_trace()
-            feature_creators = (
-                ('trace_print', features.trace_print),
-                )
-            result_feature_vectors = []
-            result_unused = msgs
-            pdb.set_trace()
-            for i in range(0, n_feature_vectors, 1):
-                msgs_to_be_used = msgs[i:]
-                all_features = features.Features()
-                for feature_creator in feature_creators:
-                    for cusip in cusips:
-                        try:
-                            cusip_features, unused = feature_creator[1](msgs_to_be_used, cusip)
-                        except exception.NoFeatures as e:
-                            raise exception.Features('cusip %s, %s' % (cusip, e.msg))
-                        if len(unused) < len(result_unused):
-                            result_unused = copy.copy(unused)
-                        # update feature names to incorporate the cusip
-                        for k, v in cusip_features.items():
-                            key = (
-                                'id_%s_%s' (cusip, k[3:]) if k.startwith('id_') else
-                                '%s_%s_%s' (feature_creator[0], cusip, k)
-                            )
-                            all_features.add(key, v)
-                continue   # bypass old code, for now
-                # try:
-                #     fv, unused = feature_vector(msgs_to_be_used, cusips, required_reclassified_trade_type)
-                #     vp('loop %d: fv trigger identifier: %s len(msgs): %d, len(unused): %d' % (
-                #         i,
-                #         fv['id_trigger_identifier'],
-                #         len(msgs_to_be_used),
-                #         len(unused),
-                #     ))
-                #     if False and i % 10 == 1:
-                #         pdb.set_trace()
-                #     result_feature_vectors.append(fv)
-                #     if len(unused) < len(result_unused):
-                #         result_unused = copy.copy(unused)
-                # except exception.NoPriorEventWithCusipAndRtt as e:
-                #     vp('stub: handle exception %s' % e)
-                #     break
-                # except exception.NoMessageWithCusip as e:
-                #     vp('stub: handle exception %s' % e)
-                #     break
-            set_trace()
-            return list(reversed(result_feature_vectors)), result_unused
+                    feature_vector[key] = v
+        return feature_vector, used
+
+    def _prior_prints(self, cusip, sequence_number):
+        'return List[msg] with the 2 most recent B and S prints at or before sequence_number, most recent first'
+        result = []
+        for rtt in ('B', 'S'):
+            n_found = 0
+            for print_sequence_number, msg in self._live(cusip, rtt):
+                if print_sequence_number <= sequence_number:
+                    result.append((print_sequence_number, msg))
+                    n_found += 1
+                    if n_found == 2:
+                        break
+        return [msg for print_sequence_number, msg in sorted(result, key=lambda x: x[0], reverse=True)]
+
+    def _replace(self, msg):
+        'replace the retained trace print with the same issuepriceid'
+        old_key, entry = self._entries[msg.issuepriceid]
+        self._invalidate(msg.issuepriceid)
+        if (msg.cusip, msg.reclassified_trade_type) == old_key:
+            if entry[2] is None:
+                # reviving a tombstone changes feature vectors that did not use it
+                self._cached_feature_vectors.clear()
+                self._dependents.clear()
+            entry[2] = msg
+            return
+        # the correction changed the cusip or trade type: tombstone the old entry and append the msg
+        entry[2] = None
+        del self._entries[msg.issuepriceid]
+        self.accumulate(msg)
 
-        set_trace()
-        assert n_feature_vectors >= 0
-        result, unused = loop(list(reversed(self._msgs)))
-        set_trace()
-        self._msgs = self._msgs[len(unused):]
-        if True:
-            print('check that we get same results using possibly fewer messages')
-            set_trace()
-            # test: should get same feature vectors (the result)
-            result2, unused2 = loop(list(reversed(self._msgs)))
-            assert len(result) == len(result2)
-            assert len(unused2) == 0
-            for i, item in enumerate(result):
-                item2 = result2[i]
-                for k, v in item.items():
-                    assert item2[k] == v
-            set_trace()
-        return result
 
-        
 def test_tps_make_feature_vectors():
-    return  # the test code is deprecated
-    # test 3 OTRs and consumption of entire set of messages
+    # test 3 OTRs, corrections, and discarding of old messages
     vp = machine_learning.make_verbose_print(False)
-    set_trace = machine_learning.make_set_trace(True)
-    
+
     def make_trace_print_message(tp_info):
         index, cusip, rtt = tp_info
-        return message.TracePrint(
+        return shared_message.TracePrint(
             source='test_tps_make_feature_vectors',
             identifier=str(index),
             cusip=cusip,
             issuepriceid=str(index),
             datetime=datetime.datetime.now(),
-            oasspread=float(index),
+            oasspread=float(index + 1),
             trade_type=None,
             reclassified_trade_type=rtt,
             cancellation_probability=0.0,
             )
-    
+
     trace_prints = (
         (0, 'p', 'B'),
         (1, 'o1', 'S'),
@@ -404,13 +429,19 @@ def test_tps_make_feature_vectors():
         (10, 'o2', 'B'),
         (11, 'p', 'B'),
         (12, 'o2', 'S'),
+        (13, 'o2', 'S'),
+        (14, 'p', 'B'),
+        (15, 'p', 'S'),
     )
-    tps = TracePrintSequence()
+    tps = TracePrintSequence('p', max_n_trades_back=2)
     for tp_info in trace_prints:
         msg = make_trace_print_message(tp_info)
         tps.accumulate(msg)
-    assert len(tps._msgs) == len(trace_prints)
-    set_trace()
+    # the oldest trigger is p S print 9; the 2 p S prints before it (3 and 5) may still be needed
+    assert len(tps) == len(trace_prints)
+    assert [msg.issuepriceid for msg in tps.most_recent('p', 'S', 5)] == ['15', '9', '5', '3']
+    tps.accumulate(make_trace_print_message((9, 'p', 'S')))  # a correction
+    assert len(tps) == len(trace_prints)
     for rtt in ('B', 'S'):
         feature_vectors = tps.feature_vectors(
             cusips=('p', 'o1', 'o2'),
@@ -418,16 +449,103 @@ def test_tps_make_feature_vectors():
             required_reclassified_trade_type=rtt,
             trace=False,
         )
-        set_trace()
+        # the second most recent trigger has only one prior o2 S message
         assert len(feature_vectors) == 1
         for i, fv in enumerate(feature_vectors):
-            print(rtt, i, fv['id_trigger_identifier'], fv['id_target_oasspread'])
+            vp(rtt, i, fv['id_trigger_identifier'], fv['id_target_oasspread'])
             vp(fv)
+        assert feature_vectors[0]['id_trigger_identifier'] == ('14' if rtt == 'B' else '15')
+        assert feature_vectors[0]['trace_print_o2_S_oasspread_less_prior'] == 1.0
+
+    # cancelling a trace print invalidates only the feature vectors that used it
+    fv_B = tps.feature_vectors(('p', 'o1', 'o2'), 2, 'B')[0]
+    fv_S = tps.feature_vectors(('p', 'o1', 'o2'), 2, 'S')[0]
+    assert tps.cancel('11')  # the p B print before the B trigger
+    assert not tps.cancel('99')  # never seen
+    assert tps.feature_vectors(('p', 'o1', 'o2'), 2, 'S')[0] is not fv_S  # it also used the p B print 11
+    assert tps.feature_vectors(('p', 'o1', 'o2'), 2, 'B')[0]['id_trace_print_p_B_msg1_issuepriceid'] == '0'
+    assert [msg.issuepriceid for msg in tps.most_recent('p', 'B', 5)] == ['14', '0']
+    tps.accumulate(make_trace_print_message((13, 'o2', 'S')))  # correct an o2 S print
+    tps.accumulate(make_trace_print_message((11, 'p', 'B')))  # restore the cancelled print
+    fv_B2 = tps.feature_vectors(('p', 'o1', 'o2'), 2, 'B')[0]
+    assert fv_B2 is not fv_B and fv_B2 == fv_B
+    assert tps.feature_vectors(('p', 'o1', 'o2'), 2, 'B')[0] is fv_B2  # served from the cache
+
+
+def test_tps_busy_otr():
+    # the OTR cusip trades 10 times between primary cusip trades
+    trace_prints = []  # List[(cusip, rtt)]
+    for i in range(8):
+        trace_prints.append(('p', 'BS'[i % 2]))
+        for j in range(10):
+            trace_prints.append(('o1', 'BS'[j % 2]))
+    tps = TracePrintSequence('p', max_n_trades_back=2)
+    for index, (cusip, rtt) in enumerate(trace_prints):
+        tps.accumulate(shared_message.TracePrint(
+            source='test_tps_busy_otr',
+            identifier=str(index),
+            cusip=cusip,
+            issuepriceid=str(index),
+            datetime=datetime.datetime.now(),
+            oasspread=float(index + 1),
+            trade_type=None,
+            reclassified_trade_type=rtt,
+            cancellation_probability=0.0,
+        ))
+    # the oldest trigger is the p B print at index 44 (primary trade 4)
+    # all the prints after it are retained, as are the 2 B and 2 S prints before it for each cusip
+    assert len(tps) == (len(trace_prints) - 44) + 4 + 4
+    feature_vectors = tps.feature_vectors(('p', 'o1'), 2, 'B')
+    assert len(feature_vectors) == 2
+    assert [fv['id_trigger_identifier'] for fv in feature_vectors] == ['44', '66']
+    assert feature_vectors[0]['id_trace_print_o1_B_msg0_issuepriceid'] == '42'
+    assert feature_vectors[0]['id_trace_print_o1_S_msg1_issuepriceid'] == '41'
+
+
+def test_handler_cancel():
+    # a cancellation sent through handle() removes the trace print from later feature vectors
+    def make_trace_print_message(index, cusip, rtt):
+        return shared_message.TracePrint(
+            source='test_handler_cancel',
+            identifier=str(index),
+            cusip=cusip,
+            issuepriceid=str(index),
+            datetime=datetime.datetime.now(),
+            oasspread=float(index + 1),
+            trade_type=None,
+            reclassified_trade_type=rtt,
+            cancellation_probability=0.0,
+            )
+
+    handler = PrimaryCusipHandler('p', n_required_feature_vectors=2)
+    handler.handle(shared_message.SetPrimaryOTRs('test_handler_cancel', 's', 'p', ['o1']))
+    handler.handle(shared_message.OutputStart('test_handler_cancel', 'o'))
+    outputs = []
+    for index, (cusip, rtt) in enumerate((
+        ('p', 'B'), ('p', 'S'), ('o1', 'B'), ('o1', 'S'),
+        ('p', 'B'), ('p', 'S'), ('o1', 'B'), ('o1', 'S'),
+        ('p', 'B'),
+    )):
+        outputs = handler.handle(make_trace_print_message(index, cusip, rtt))
+    test_feature_vector = message.from_string(outputs[0][1]).feature_vector
+    assert test_feature_vector['id_trigger_identifier'] == '8'
+    assert test_feature_vector['id_trace_print_p_B_msg1_issuepriceid'] == '4'
+    assert len(outputs) == 1  # the older trigger lacks 2 prior o1 trace prints, so there is no Train message
+    assert handler.handle(shared_message.TracePrintCancel('test_handler_cancel', 'c', '4')) == []
+    handler.handle(make_trace_print_message(9, 'p', 'S'))
+    outputs = handler.handle(make_trace_print_message(10, 'p', 'B'))
+    assert len(outputs) == 2
+    train_feature_vectors = message.from_string(outputs[1][1]).feature_vectors
+    assert [fv['id_trigger_identifier'] for fv in train_feature_vectors] == ['8', '10']
+    assert train_feature_vectors[0]['id_trace_print_p_B_msg1_issuepriceid'] == '0'  # print 4 was cancelled
+    assert train_feature_vectors[1]['id_trace_print_p_B_msg1_issuepriceid'] == '8'
+
 
-    
 def unittest(config):
     'run unit tests'
     test_tps_make_feature_vectors()
+    test_tps_busy_otr()
+    test_handler_cancel()
 
 
 class Identifier:
@@ -469,169 +587,202 @@ class OutputPathMaker:
             )]
 
     
-def do_work(config):
-    set_trace = machine_learning.make_set_trace(True)
-    set_trace()
-    n_required_feature_vectors = max(HpGrids.HpGrid5().n_trades_back_choices)
-    feature_vector_identifiers = Identifier()
-    n_required_feature_vectors = 300  # TODO: set based on model_specs
-    creating_output = False
-    all_trace_prints = []
-    cusips = []  # [0] = primary, [1] = otr 1, [2] = otr 2, ...
-
-    connection = shared_queue.PrimitiveBlockingConnection(
-        path_for_input=InputPathMaker(config.get('in_path_prefix')).make_path_for_input,
-        paths_for_output=OutputPathMaker(config.get('out_path_prefix')).make_paths_for_output,
-        )
-    channel = connection.channel()
-    exchange = config.get('out_exchange')
-    routing_key = 'events.%s.*' % config.get('primary_cusip')  # send every message to all of the experts
-    input_queue = 'events.%s' % (config.get('primary_cusip'))
-    channel.publish(
-        exchange=exchange,
-        routing_key=routing_key,
-        body=str(shared_message.SetVersion(
+class PrimaryCusipHandler:
+    'convert the messages in queue events.{primary_cusip} into messages for the experts'
+    def __init__(self, primary_cusip, n_required_feature_vectors=300):
+        self._primary_cusip = primary_cusip
+        self._feature_vector_identifiers = Identifier()
+        self._n_required_feature_vectors = n_required_feature_vectors  # TODO: set based on model_specs
+        self._creating_output = False
+        self._trace_prints = TracePrintSequence(primary_cusip, max_n_trades_back=n_required_feature_vectors)
+        self._cusips = []  # [0] = primary, [1] = otr 1, [2] = otr 2, ...
+
+        self.input_queue = 'events.%s' % primary_cusip
+        self.routing_key = 'events.%s.*' % primary_cusip  # send every message to all of the experts
+        self.expert_routing_key = '%s.expert.*' % primary_cusip  # {cusip}.expert.{model_spec}
+
+    def set_version(self):
+        'return the SetVersion message that is sent before any other output message'
+        return shared_message.SetVersion(
             source='events_cusips.py',
             identifier=str(datetime.datetime.now()),
             what='machine_learning',
             version='1.0.0.0',
-        )),
         )
-    while True:
-        try:
-            s = channel.consume(input_queue)
-        except StopIteration:
-            break
-        msg = shared_message.from_string(s)
+
+    def handle(self, msg):
+        'return List[(routing_key, body)] of the messages to publish in response to msg'
         print('\n%r' % msg)
+        result = []
         if isinstance(msg, shared_message.BackToZero):
-            pdb.set_trace()
-            print('todo: implement BackToZero')
+            # forget every message read after the configuration parameters were read
+            self._creating_output = False
+            self._trace_prints = TracePrintSequence(
+                self._primary_cusip,
+                max_n_trades_back=self._n_required_feature_vectors,
+            )
+            self._cusips = []
         elif isinstance(msg, shared_message.SetPrimaryOTRs):
-            cusips = [msg.primary_cusip]
+            self._cusips = [msg.primary_cusip]
             for otr_cusip in msg.otr_cusips:
-                cusips.append(otr_cusip)
+                self._cusips.append(otr_cusip)
         elif isinstance(msg, shared_message.SetVersion):
-            channel.publish(
-                exchange=exchange,
-                routing_key=routing_key,
-                body=str(msg),
-                )
+            if msg.what == shared_message.codec_what and msg.version not in shared_message.codecs:
+                log.critical('upstream message codec %s is not one of %s' % (msg.version, shared_message.codecs))
+                sys.exit(1)
+            result.append((self.routing_key, str(msg)))
         elif isinstance(msg, shared_message.TracePrint):
-            def make_feature_vector(msgs, cusips):
-                'return (FeatureVector, unused msgs) or raise NoFeatures'
-                if len(cusips) == 0:
-                    log_msg = (
-                        'A SetCusipOTRs message was not received before a StartOutput message was received'
-                    )
-                    log.critical(log_msg)
-                    assert False, log_msg
-                all_features = features.FeatureVector()
-                shortest_unused = msgs
-                for cusip in cusips:
-                    for name, maker in (('trace_print', features.trace_print),):
-                        try:
-                            fv, unused = maker(msgs, cusip)
-                        except exception.NoFeatures as e:
-                            raise e
-                        if len(unused) < len(shortest_unused):
-                            shortest_unused = copy.copy(unused)
-                        # rename the feature to use the name
-                        # that makes the features unique
-                        for k, v in fv.items():
-                            key = (
-                                'id_%s_%s_%s' % (name, cusip, k[3:]) if k.startswith('id_') else
-                                '%s_%s_%s' % (name, cusip, k)
-                                )
-                            all_features[key] = v
-                # create a unique identifier for the feature vector
-                all_features['id_feature_vector'] = feature_vector_identifiers.get_next()
-                # add id info from TracePrint for the first primary cusip
-                for msg in msgs:
-                    if msg.cusip == cusips[0]:
-                        # found first trade for the primary cusip
-                        all_features['id_primary_cusip'] = msg.cusip
-                        all_features['id_primary_cusip_issuepriceid'] = msg.issuepriceid
-                        all_features['id_primary_cusip_oasspread'] = msg.oasspread
-                        all_features['id_primary_cusip_reclassified_trade_type'] = msg.reclassified_trade_type
-                        break
-                return all_features, shortest_unused
-
-            # handle corrections
-            made_correction = False
-            for i, old_trace_print in enumerate(all_trace_prints):
-                if old_trace_print.issuepriceid == msg.issuepriceid:
-                    all_trace_prints[i] = msg  # replace the previous trace print message
-                    made_correction = True
-                    break
-            if not made_correction:
-                all_trace_prints.append(msg)
-
-            if creating_output:
-                all_msgs = list(reversed(all_trace_prints))
-                try:
-                    last_feature_vector, shortest_unused = make_feature_vector(all_msgs, cusips)
-                except exception.NoFeatures as e:
-                    # info ==> things are working as expected
-                    log.info('unable to create even one feature vector: %s' % str(e))
-                    continue
-                channel.publish(
-                    exchange=exchange,
-                    routing_key='%s.expert.*' % config.get('primary_cusip'),  # {cusip}.expert.{model_spec}
-                    body=str(message.Test(
-                        source='events_cusip.py',
-                        identifier=last_feature_vector['id_feature_vector'],
-                        feature_vector=last_feature_vector,
-                        )),
-                    )
-
-                pdb.set_trace()
-                many_feature_vectors = [last_feature_vector]
-                for i in range(1, len(all_msgs), 1):
-                    try:
-                        another_feature_vector, unused = make_feature_vector(all_msgs[i:])
-                    except exception.NoFeatures as e:
-                        log.info('unable to create %dth feature vector: %s' % (i, str(e)))
-                        break
-                    many_feature_vectors.append(another_feature_vector)
-                    if len(unused) < len(shortest_unused):
-                        shorted_unused = copy.copy(unused)
-                pdb.set_trace()
-                if len(many_feature_vectors) >= n_required_feature_vectors:
-                    pdb.set_trace()
-                    print('create B and S targets')
-                    
-                    print('reconcile targets with features')
-                    channel.publish(
-                        exchange=exchange,
-                        routing_key='%s.expert.*' % config.get('primary_cusip'),
-                        body=str(message.Train(
-                            source='events_cusip.py',
-                            identifier=last_feature_vector['id_feature_vector'],
-                            feature_vectors=many_feature_vectors,  # TODO: include both B and S targets
-                        )),
-                    )
-                # discard TracePrint objects that will never be used
-                all_trace_prints = all_trace_prints[len(shorted_unused):]
+            result.extend(self._handle_trace_print(msg))
         elif isinstance(msg, shared_message.TracePrintCancel):
-            pdb.set_trace()
-            print('todo: implement TracePrintCancel')
+            if not self._trace_prints.cancel(msg.issuepriceid):
+                log.info('cancelled trace print %s was never seen or is no longer retained' % msg.issuepriceid)
         elif isinstance(msg, shared_message.OutputStart):
-            creating_output = True
+            self._creating_output = True
         elif isinstance(msg, shared_message.OutputStop):
-            pdb.set_trace()
-            creating_output = False
+            self._creating_output = False
         else:
-            print(msg)
-            print('%r' % msg)
-            print('unrecognized input message type')
-            pdb.set_trace()
-                
+            log.error('unrecognized input message type: %r' % msg)
+        return result
+
+    def _handle_trace_print(self, msg):
+        'return List[(routing_key, body)]'
+        # a correction replaces the retained trace print with the same issuepriceid
+        self._trace_prints.accumulate(msg)
+        if not self._creating_output or msg.cusip != self._primary_cusip:
+            # only a trade of the primary cusip triggers new feature vectors
+            return []
+        if len(self._cusips) == 0:
+            log_msg = (
+                'A SetCusipOTRs message was not received before a StartOutput message was received'
+            )
+            log.critical(log_msg)
+            assert False, log_msg
+        feature_vectors = self._trace_prints.feature_vectors(
+            cusips=self._cusips,
+            n_feature_vectors=self._n_required_feature_vectors,
+            required_reclassified_trade_type=msg.reclassified_trade_type,
+        )
+        if len(feature_vectors) == 0:
+            # info ==> things are working as expected
+            log.info('unable to create even one feature vector for trace print %s' % msg.issuepriceid)
+            return []
+        identified_feature_vectors = [self._identified(feature_vector) for feature_vector in feature_vectors]
+        last_feature_vector = identified_feature_vectors[-1]
+        result = [(
+            self.expert_routing_key,
+            str(message.Test(
+                source='events_cusip.py',
+                identifier=last_feature_vector['id_feature_vector'],
+                feature_vector=last_feature_vector,
+                )),
+            )]
+        if len(identified_feature_vectors) >= self._n_required_feature_vectors:
+            result.append((
+                self.expert_routing_key,
+                str(message.Train(
+                    source='events_cusip.py',
+                    identifier=last_feature_vector['id_feature_vector'],
+                    feature_vectors=identified_feature_vectors,  # TODO: include both B and S targets
+                )),
+                ))
+        return result
+
+    def _identified(self, feature_vector):
+        'return a copy of the cached feature vector with a unique identifier'
+        result = features.FeatureVector(feature_vector)
+        result['id_feature_vector'] = self._feature_vector_identifiers.get_next()
+        result['id_primary_cusip'] = self._primary_cusip
+        result['id_trigger_event_datetime'] = str(feature_vector['id_trigger_event_datetime'])
+        return result
+
+
+def make_connection(config):
+    return shared_queue.PrimitiveBlockingConnection(
+        path_for_input=InputPathMaker(config.get('in_path_prefix')).make_path_for_input,
+        paths_for_output=OutputPathMaker(config.get('out_path_prefix')).make_paths_for_output,
+        )
+
+
+async def serve_primary_cusip(channel, exchange, handler, max_queued_messages, inactivity_timeout):
+    'read, handle, and publish the messages for one primary cusip'
+    pending = asyncio.Queue(maxsize=max_queued_messages)  # intake waits when the handler falls behind
+
+    async def intake():
+        async for s in channel.consume(handler.input_queue, inactivity_timeout=inactivity_timeout):
+            await pending.put(shared_message.from_string(s))
+        await pending.put(None)  # no more messages
+
+    async def process():
+        await channel.publish(exchange, handler.routing_key, str(handler.set_version()))
+        while True:
+            msg = await pending.get()
+            if msg is None:
+                break
+            for routing_key, body in handler.handle(msg):
+                await channel.publish(exchange, routing_key, body)
+
+    await asyncio.gather(intake(), process())
+
+
+def do_work_service(config):
+    'serve every primary cusip in config value service_primary_cusips in one event loop'
+    connection = make_connection(config)
+    channel = shared_queue.AsyncChannel(
+        connection.channel(),
+        poll_interval=config.get('poll_interval', 0.1),
+    )
+    exchange = config.get('out_exchange')
+
+    async def serve():
+        await asyncio.gather(*[
+            serve_primary_cusip(
+                channel,
+                exchange,
+                PrimaryCusipHandler(primary_cusip),
+                config.get('max_queued_messages', 1000),
+                config.get('inactivity_timeout', None),
+            )
+            for primary_cusip in config.get('service_primary_cusips')
+        ])
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(serve())
+    finally:
+        loop.close()
+    print('have read all messages')
+    connection.close()
+
+
+def do_work(config):
+    if config.get('service_primary_cusips') is not None:
+        do_work_service(config)
+        return
+    set_trace = machine_learning.make_set_trace(True)
+    set_trace()
+    handler = PrimaryCusipHandler(config.get('primary_cusip'))
+
+    connection = make_connection(config)
+    channel = connection.channel()
+    exchange = config.get('out_exchange')
+    channel.publish(
+        exchange=exchange,
+        routing_key=handler.routing_key,
+        body=str(handler.set_version()),
+        )
+    for s in channel.consume_generator(handler.input_queue):
+        for routing_key, body in handler.handle(shared_message.from_string(s)):
+            channel.publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                body=body,
+                )
+
     print('have read all messages')
     pdb.set_trace()
     connection.close()
-                              
-    
+
+
 if __name__ == '__main__':
     if False:
         pdb
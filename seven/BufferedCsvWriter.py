@@ -0,0 +1,151 @@
+'''write rows to a CSV file, flushing to the operating system according to a policy
+
+The rows are formatted into an in-memory buffer. The buffer is written to the file when any of these
+limits is reached:
+- flush_rows: number of rows in the buffer
+- flush_bytes: number of characters in the buffer
+- flush_seconds: seconds since the last flush (checked when a row is written)
+Only complete rows are written, so that a process tailing the file never sees a partial row, and
+a crash loses at most the rows in the buffer.
+
+checkpoint() flushes the buffer and calls os.fsync(), so that the rows written so far survive a
+crash of the operating system.
+
+If the writer is not tail_able, the rows are written to {path}.partial, which is atomically renamed
+to {path} by close(). Hence a file at {path} is always complete. If the writer is tail_able, the
+rows are written directly to {path}, so that an upstream process can tail it.
+
+Copyright 2017 Roy E. Lowrance, roy.lowrance@gmail.com
+
+You may not use this file except in compliance with a License.
+'''
+import csv
+import errno
+import io
+import os
+import pdb
+import tempfile
+import time
+import unittest
+
+
+class BufferedCsvWriter(object):
+    def __init__(self,
+                 path,
+                 field_names,
+                 flush_bytes=64 * 1024,
+                 flush_rows=100,
+                 flush_seconds=1.0,
+                 tail_able=False,
+                 ):
+        assert flush_bytes > 0
+        assert flush_rows > 0
+        assert flush_seconds >= 0.0
+        self._path = path
+        self._flush_bytes = flush_bytes
+        self._flush_rows = flush_rows
+        self._flush_seconds = flush_seconds
+        self._tail_able = tail_able
+
+        self._writing_path = path if tail_able else path + '.partial'
+        self._silently_remove(path)
+        self._silently_remove(self._writing_path)
+        self._file = open(self._writing_path, 'w')
+        self._buffer = io.StringIO()
+        self._dict_writer = csv.DictWriter(
+            self._buffer,
+            field_names,
+            lineterminator='\n',
+        )
+        self._n_rows_buffered = 0
+        self._last_flush_time = time.time()
+        self.n_rows_written = 0
+
+        self._dict_writer.writeheader()
+        self.flush()
+
+    def __repr__(self):
+        return 'BufferedCsvWriter(%s, %d rows written)' % (self._path, self.n_rows_written)
+
+    def checkpoint(self):
+        'flush the buffer and force the file contents to stable storage'
+        self.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        'flush, sync, close, and (if not tail_able) rename the file to its final path'
+        if self._file is None:
+            return
+        self.checkpoint()
+        self._file.close()
+        self._file = None
+        if not self._tail_able:
+            os.replace(self._writing_path, self._path)
+
+    def flush(self):
+        'write the buffered rows to the file'
+        text = self._buffer.getvalue()
+        if len(text) > 0:
+            self._file.write(text)
+            self._file.flush()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        self._n_rows_buffered = 0
+        self._last_flush_time = time.time()
+
+    def writerow(self, row):
+        'buffer the row, then flush if any of the limits has been reached'
+        self._dict_writer.writerow(row)
+        self._n_rows_buffered += 1
+        self.n_rows_written += 1
+        if (self._n_rows_buffered >= self._flush_rows or
+                self._buffer.tell() >= self._flush_bytes or
+                time.time() - self._last_flush_time >= self._flush_seconds):
+            self.flush()
+
+    def _silently_remove(self, path):
+        'remove file, if it exists'
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:  # no such file or directory
+                raise                    # re-raise the exception
+
+
+class TestBufferedCsvWriter(unittest.TestCase):
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_flush_rows(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'out.csv')
+            writer = BufferedCsvWriter(path, ['a', 'b'], flush_rows=2, flush_seconds=60.0, tail_able=True)
+            self.assertEqual(self._read(path), 'a,b\n')
+            writer.writerow({'a': 1, 'b': 2})
+            self.assertEqual(self._read(path), 'a,b\n')
+            writer.writerow({'a': 3, 'b': 4})
+            self.assertEqual(self._read(path), 'a,b\n1,2\n3,4\n')
+            writer.writerow({'a': 5, 'b': 6})
+            writer.checkpoint()
+            self.assertEqual(self._read(path), 'a,b\n1,2\n3,4\n5,6\n')
+            writer.close()
+            self.assertEqual(writer.n_rows_written, 3)
+
+    def test_atomic_close(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'out.csv')
+            writer = BufferedCsvWriter(path, ['a'], flush_rows=1)
+            writer.writerow({'a': 1})
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(self._read(path + '.partial'), 'a\n1\n')
+            writer.close()
+            writer.close()  # closing twice is allowed
+            self.assertFalse(os.path.exists(path + '.partial'))
+            self.assertEqual(self._read(path), 'a\n1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
+    if False:
+        pdb
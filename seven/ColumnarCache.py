@@ -0,0 +1,489 @@
+'''columnar binary cache of a CSV file, used by the event readers instead of parsing the CSV file
+
+The cache for {path} is the directory {path}.columnar, which holds
+- meta.json: the field names, the kind of each column, and the size, mtime, and sha1 of {path}
+- datetimes.npy: datetime64[s] for each row, built from the datetime columns
+- one or more .npy files for each column
+  - kind int: the values as int64
+  - kind float: the values as float64
+  - kind str: the values as utf-8 text, each followed by a unit separator, and the byte offset of each row
+A column has kind int or float only if formatting the stored number reproduces the CSV text exactly.
+Hence the rows served from the cache are identical to those returned by csv.DictReader.
+
+The cache is built from rows_per_chunk rows of the CSV file at a time. Each chunk is appended to raw
+files that are converted to the .npy files at the end, so building needs memory for one chunk only.
+
+The .npy files are memory mapped. The cache is rebuilt when the size of {path} changes or when its mtime
+changes and its sha1 hash also changes.
+
+Several processes may build the cache for the same file at once. Each builds in its own temporary
+directory and renames it to {path}.columnar. A process that finds a fresh cache already there uses it
+instead of replacing it. If its rename fails, it uses the cache published by the other process when
+that cache is fresh, and otherwise returns an err, so that the caller reads the CSV file instead.
+
+Copyright 2017 Roy E. Lowrance, roy.lowrance@gmail.com
+
+You may not use this file except in compliance with a License.
+'''
+import csv
+import errno
+import hashlib
+import itertools
+import json
+import numpy as np
+import os
+import pdb
+import shutil
+import tempfile
+import unittest
+
+
+version = 1
+separator = '\x1f'  # the ASCII unit separator
+rows_per_chunk = 4096  # rows read from the CSV file or served from the cache at a time
+copy_block_size = 1024 * 1024  # array elements copied at a time from a raw file into a .npy file
+column_dtypes = {  # key = kind, value = Dict[name of .npy file, dtype]
+    'int': {'values': np.int64},
+    'float': {'values': np.float64},
+    'str': {'text': np.uint8, 'offsets': np.int64},
+}
+
+
+def open_or_build(path, datetime_column_names):
+    'return (ColumnarCache, None) or (None, err)'
+    cache_dir = path + '.columnar'
+    stat = os.stat(path)
+    meta = _read_meta(cache_dir)
+    if meta is not None and _is_fresh(meta, path, stat, datetime_column_names):
+        if meta['source_mtime_ns'] != stat.st_mtime_ns:
+            # the file was touched but not changed
+            meta['source_mtime_ns'] = stat.st_mtime_ns
+            _write_meta(cache_dir, meta)
+        return _open(cache_dir, meta)
+    err = _build(path, stat, datetime_column_names, cache_dir)
+    if err is not None:
+        return None, err
+    meta = _read_meta(cache_dir)
+    if meta is None:
+        return None, 'columnar cache %s was removed by another process' % cache_dir
+    return _open(cache_dir, meta)
+
+
+class ColumnarCache(object):
+    def __init__(self, cache_dir, meta):
+        self._cache_dir = cache_dir
+        self.field_names = meta['field_names']
+        self.n_rows = meta['n_rows']
+        self._kinds = meta['kinds']
+        self.datetimes = self._load('datetimes')  # np.array of datetime64[s]
+        self._columns = {}  # key = field_name, value = (kind, values[, offsets])
+        for i, (field_name, kind) in enumerate(zip(self.field_names, self._kinds)):
+            if kind == 'str':
+                self._columns[field_name] = (kind, self._load('%d.text' % i), self._load('%d.offsets' % i))
+            else:
+                self._columns[field_name] = (kind, self._load('%d.values' % i))
+
+    def __len__(self):
+        return self.n_rows
+
+    def __repr__(self):
+        return 'ColumnarCache(%s, %d rows, %d columns)' % (self._cache_dir, self.n_rows, len(self.field_names))
+
+    def column(self, field_name):
+        'return the typed values in the column: np.array for int and float, List[str] for str'
+        column = self._columns[field_name]
+        if column[0] == 'str':
+            return self._texts(column, 0, self.n_rows)
+        return column[1]
+
+    def iter_rows(self, start=0):
+        'yield each row as a Dict[field_name, str], as csv.DictReader would, starting with row number start'
+        for chunk_start in range(start, self.n_rows, rows_per_chunk):
+            chunk_stop = min(chunk_start + rows_per_chunk, self.n_rows)
+            columns = [
+                self._texts(self._columns[field_name], chunk_start, chunk_stop)
+                for field_name in self.field_names
+            ]
+            for values in zip(*columns):
+                yield dict(zip(self.field_names, values))
+
+    def _load(self, name):
+        return np.load(os.path.join(self._cache_dir, name + '.npy'), mmap_mode='r')
+
+    def _texts(self, column, start, stop):
+        'return List[str] with the CSV text of the values in rows [start, stop)'
+        kind = column[0]
+        if kind == 'str':
+            text, offsets = column[1], column[2]
+            chunk = text[offsets[start]:offsets[stop]].tobytes().decode('utf-8')
+            return chunk.split(separator)[:-1]
+        elif kind == 'int':
+            return [str(value) for value in column[1][start:stop].tolist()]
+        else:
+            return [repr(value) for value in column[1][start:stop].tolist()]
+
+
+def _build(path, stat, datetime_column_names, cache_dir):
+    'write the cache files for path; return None or err'
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        err = _write_cache_files(path, stat, datetime_column_names, temp_dir)
+        if err is not None:
+            return err
+        if _has_fresh_cache(cache_dir, path, stat, datetime_column_names):
+            return None  # another process built the cache while we did
+        try:
+            if os.path.exists(cache_dir):
+                shutil.rmtree(cache_dir)
+            os.rename(temp_dir, cache_dir)
+        except OSError as e:
+            # another process removed or published the cache between our steps
+            if _has_fresh_cache(cache_dir, path, stat, datetime_column_names):
+                return None
+            return 'could not publish columnar cache %s: %s' % (cache_dir, e)
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+    return None
+
+
+def _write_cache_files(path, stat, datetime_column_names, temp_dir):
+    'write the cache files into temp_dir, reading path rows_per_chunk rows at a time; return None or err'
+    with open(path) as f:
+        reader = csv.reader(f)
+        try:
+            field_names = next(reader)
+        except StopIteration:
+            return 'file %s is empty' % path
+        for datetime_column_name in datetime_column_names:
+            if datetime_column_name not in field_names:
+                return 'file %s has no column %s' % (path, datetime_column_name)
+        n_fields = len(field_names)
+        indices = [field_names.index(datetime_column_name) for datetime_column_name in datetime_column_names]
+        column_writers = [_ColumnWriter(temp_dir, i) for i in range(n_fields)]
+        datetimes_path = os.path.join(temp_dir, 'datetimes.raw')
+        n_rows = 0
+        try:
+            with open(datetimes_path, 'wb') as datetimes_file:
+                while True:
+                    rows = list(itertools.islice(reader, rows_per_chunk))
+                    if len(rows) == 0:
+                        break
+                    for row_number, row in enumerate(rows, n_rows + 1):
+                        if len(row) != n_fields:
+                            return 'row %d of %s has %d fields, not %d' % (row_number, path, len(row), n_fields)
+                    columns = list(zip(*rows))
+                    try:
+                        datetimes = np.array(
+                            ['T'.join(values) for values in zip(*[columns[index] for index in indices])],
+                            dtype='datetime64[s]',
+                        )
+                    except ValueError as e:
+                        return 'datetime columns of %s not interpretable as datetimes: %s' % (path, e)
+                    datetimes_file.write(datetimes.tobytes())
+                    for i, column in enumerate(columns):
+                        if not column_writers[i].write(column):
+                            return 'column %s of %s contains the unit separator character' % (field_names[i], path)
+                    n_rows += len(rows)
+        finally:
+            for column_writer in column_writers:
+                column_writer.close()
+    _save_raw_as_npy(datetimes_path, os.path.join(temp_dir, 'datetimes.npy'), 'datetime64[s]')
+    _write_meta(temp_dir, {
+        'version': version,
+        'datetime_column_names': list(datetime_column_names),
+        'field_names': field_names,
+        'kinds': [column_writer.save() for column_writer in column_writers],
+        'n_rows': n_rows,
+        'source_sha1': _sha1(path),
+        'source_size': stat.st_size,
+        'source_mtime_ns': stat.st_mtime_ns,
+    })
+    return None
+
+
+class _ColumnWriter(object):
+    'encode the values of one column a chunk at a time, appending them to raw files'
+    # The kind is int or float while every value written has that kind. When a chunk has a value
+    # that does not, the kind becomes str and the values already written are re-encoded as text.
+    # save() converts the raw files {index}.{name}.raw into the .npy files of the cache.
+    def __init__(self, directory, index):
+        self._directory = directory
+        self._index = index
+        self.kind = None  # None until a value has been written
+        self._files = {}  # key = name, value = file open for appending
+        self._n_text_bytes = 0
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def save(self):
+        'write the .npy files and return the kind of the column'
+        self.close()
+        if self.kind is None:
+            # no rows
+            np.save(self._path('values', 'npy'), np.zeros(0, dtype=np.int64))
+            return 'int'
+        for name, dtype in column_dtypes[self.kind].items():
+            _save_raw_as_npy(self._path(name, 'raw'), self._path(name, 'npy'), dtype)
+        return self.kind
+
+    def write(self, values):
+        'append the values; return False if they cannot be encoded'
+        if self.kind != 'str':
+            for kind in ('int', 'float'):
+                if self.kind in (None, kind):
+                    numbers = _encode_numbers(kind, values)
+                    if numbers is not None:
+                        self.kind = kind
+                        self._file('values').write(numbers.tobytes())
+                        return True
+            if not self._become_str():
+                return False
+        return self._write_texts(values)
+
+    def _become_str(self):
+        'change the kind to str, re-encoding the values already written; return False if that fails'
+        previous_kind = self.kind
+        self.kind = 'str'
+        self._file('text')
+        self._file('offsets').write(np.zeros(1, dtype=np.int64).tobytes())
+        if previous_kind is None:
+            return True
+        self._files.pop('values').close()
+        values_path = self._path('values', 'raw')
+        numbers = np.memmap(values_path, dtype=column_dtypes[previous_kind]['values'], mode='r')
+        format = str if previous_kind == 'int' else repr
+        for start in range(0, len(numbers), rows_per_chunk):
+            if not self._write_texts([format(number) for number in numbers[start:start + rows_per_chunk].tolist()]):
+                return False
+        del numbers
+        os.remove(values_path)
+        return True
+
+    def _file(self, name):
+        if name not in self._files:
+            self._files[name] = open(self._path(name, 'raw'), 'ab')
+        return self._files[name]
+
+    def _path(self, name, extension):
+        return os.path.join(self._directory, '%d.%s.%s' % (self._index, name, extension))
+
+    def _write_texts(self, values):
+        'append the values as text; return False if a value contains the separator'
+        if any(separator in value for value in values):
+            return False
+        encoded_values = [(value + separator).encode('utf-8') for value in values]
+        lengths = [len(encoded_value) for encoded_value in encoded_values]
+        offsets = self._n_text_bytes + np.cumsum(lengths, dtype=np.int64)
+        self._file('text').write(b''.join(encoded_values))
+        self._file('offsets').write(offsets.tobytes())
+        if len(offsets) > 0:
+            self._n_text_bytes = int(offsets[-1])
+        return True
+
+
+def _encode_numbers(kind, values):
+    'return np.array of the values as numbers of the kind, or None if they cannot be stored exactly as that kind'
+    convert, format = (int, str) if kind == 'int' else (float, repr)
+    try:
+        numbers = [convert(value) for value in values]
+    except ValueError:
+        return None
+    if all(format(number) == value for number, value in zip(numbers, values)):
+        try:
+            return np.array(numbers, dtype=column_dtypes[kind]['values'])
+        except OverflowError:
+            return None
+    return None
+
+
+def _save_raw_as_npy(raw_path, npy_path, dtype):
+    'write the array in the raw file as a .npy file, copying a block at a time, then remove the raw file'
+    dtype = np.dtype(dtype)
+    n = os.path.getsize(raw_path) // dtype.itemsize
+    if n == 0:
+        np.save(npy_path, np.zeros(0, dtype=dtype))  # a file of length 0 cannot be memory mapped
+    else:
+        raw = np.memmap(raw_path, dtype=dtype, mode='r')
+        npy = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=(n,))
+        for start in range(0, n, copy_block_size):
+            npy[start:start + copy_block_size] = raw[start:start + copy_block_size]
+        npy.flush()
+        del raw, npy
+    os.remove(raw_path)
+
+
+def _has_fresh_cache(cache_dir, path, stat, datetime_column_names):
+    'return True if cache_dir holds a cache with the current contents of path'
+    meta = _read_meta(cache_dir)
+    return meta is not None and _is_fresh(meta, path, stat, datetime_column_names)
+
+
+def _is_fresh(meta, path, stat, datetime_column_names):
+    'return True if the cache described by meta has the current contents of path'
+    if meta.get('version') != version:
+        return False
+    if meta['datetime_column_names'] != list(datetime_column_names):
+        return False
+    if meta['source_size'] != stat.st_size:
+        return False
+    if meta['source_mtime_ns'] == stat.st_mtime_ns:
+        return True
+    return meta['source_sha1'] == _sha1(path)
+
+
+def _open(cache_dir, meta):
+    'return (ColumnarCache, None) or (None, err)'
+    try:
+        return ColumnarCache(cache_dir, meta), None
+    except OSError as e:
+        # another process is replacing the cache
+        return None, 'could not open columnar cache %s: %s' % (cache_dir, e)
+
+
+def _read_meta(cache_dir):
+    'return Dict or None'
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _sha1(path):
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _write_meta(cache_dir, meta):
+    'write meta.json atomically'
+    path = os.path.join(cache_dir, 'meta.json')
+    temp_path = path + '.%d.temp' % os.getpid()  # other processes may be writing it too
+    with open(temp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(temp_path, path)
+
+
+class TestColumnarCache(unittest.TestCase):
+    def _write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def test_same_as_dict_reader(self):
+        text = ''.join([
+            'effectivedate,effectivetime,cusip,quantity,oasspread,price\n',
+            '2017-01-03,10:01:02,037833100,100,1.5,100.00\n',
+            '2017-01-03,10:01:03,037833AJ9,200,-2.25,\n',
+            '2017-01-04,09:00:00,"A,B",7,3,1e-05\n',
+        ])
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'trace.csv')
+            self._write(path, text)
+            cache, err = open_or_build(path, ('effectivedate', 'effectivetime'))
+            self.assertTrue(err is None)
+            with open(path) as f:
+                expected = list(csv.DictReader(f))
+            self.assertEqual(list(cache.iter_rows()), expected)
+            self.assertEqual(list(cache.iter_rows(start=2)), expected[2:])
+            self.assertEqual(cache.column('quantity').tolist(), [100, 200, 7])
+            self.assertEqual(cache.column('cusip'), ['037833100', '037833AJ9', 'A,B'])
+            self.assertEqual(str(cache.datetimes[1]), '2017-01-03T10:01:03')
+
+    def test_kind_changes_between_chunks(self):
+        global rows_per_chunk
+        text = ''.join([
+            'date,a,b,c\n',
+            '2017-01-01,1,1.5,x\n',
+            '2017-01-02,2,2.5,y\n',
+            '2017-01-03,3,3,z\n',   # b is not a float
+            '2017-01-04,4.0,4.5,\n',  # a is not an int
+            '2017-01-05,5,5.5,w\n',
+        ])
+        saved_rows_per_chunk = rows_per_chunk
+        rows_per_chunk = 2
+        try:
+            with tempfile.TemporaryDirectory() as dir:
+                path = os.path.join(dir, 'x.csv')
+                self._write(path, text)
+                cache, err = open_or_build(path, ('date',))
+                self.assertTrue(err is None)
+                with open(path) as f:
+                    self.assertEqual(list(cache.iter_rows()), list(csv.DictReader(f)))
+                self.assertEqual(cache.column('a'), ['1', '2', '3', '4.0', '5'])
+                self.assertEqual(cache.column('b'), ['1.5', '2.5', '3', '4.5', '5.5'])
+                self.assertEqual(len(cache.datetimes), 5)
+        finally:
+            rows_per_chunk = saved_rows_per_chunk
+
+    def test_rebuilt_when_stale(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'x.csv')
+            self._write(path, 'date,value\n2017-01-01,1\n')
+            cache, err = open_or_build(path, ('date',))
+            self.assertEqual(cache.column('value').tolist(), [1])
+            self._write(path, 'date,value\n2017-01-01,1\n2017-01-02,2\n')
+            cache, err = open_or_build(path, ('date',))
+            self.assertEqual(cache.column('value').tolist(), [1, 2])
+
+    def test_concurrent_builders(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'x.csv')
+            cache_dir = path + '.columnar'
+            self._write(path, 'date,value\n2017-01-01,1\n')
+            cache, err = open_or_build(path, ('date',))
+            inode = os.stat(os.path.join(cache_dir, 'meta.json')).st_ino
+
+            # a builder that finds the fresh cache of another process keeps it
+            self.assertTrue(_build(path, os.stat(path), ('date',), cache_dir) is None)
+            self.assertEqual(os.stat(os.path.join(cache_dir, 'meta.json')).st_ino, inode)
+
+            # a builder whose rename loses the race uses the fresh cache published by the winner
+            self._write(path, 'date,value\n2017-01-01,1\n2017-01-02,2\n')
+            rename = os.rename
+
+            def publish_then_fail(src, dst):
+                rename(src, dst)
+                raise OSError(errno.ENOTEMPTY, 'Directory not empty')
+
+            os.rename = publish_then_fail
+            try:
+                cache, err = open_or_build(path, ('date',))
+            finally:
+                os.rename = rename
+            self.assertTrue(err is None)
+            self.assertEqual(cache.column('value').tolist(), [1, 2])
+
+            # otherwise the caller gets an err, so that it reads the CSV file
+            self._write(path, 'date,value\n2017-01-01,3\n')
+
+            def fail(src, dst):
+                raise OSError(errno.ENOTEMPTY, 'Directory not empty')
+
+            os.rename = fail
+            try:
+                cache, err = open_or_build(path, ('date',))
+            finally:
+                os.rename = rename
+            self.assertTrue(cache is None)
+            self.assertTrue(isinstance(err, str))
+            self.assertEqual(sorted(os.listdir(dir)), ['x.csv'])  # the temporary directory was removed
+
+    def test_err_when_not_rectangular(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, 'x.csv')
+            self._write(path, 'date,value\n2017-01-01\n')
+            cache, err = open_or_build(path, ('date',))
+            self.assertTrue(cache is None)
+            self.assertTrue(isinstance(err, str))
+
+
+if __name__ == '__main__':
+    unittest.main()
+    if False:
+        pdb
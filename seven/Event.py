@@ -7,8 +7,31 @@ import datetime
 import pdb
 
 
+microseconds_per_day = 24 * 60 * 60 * 1000000
+
+
+def timestamp(dt):
+    'return int, the number of microseconds from 0001-01-01 to the datetime.datetime dt'
+    return (
+        (dt.toordinal() - 1) * microseconds_per_day +
+        ((dt.hour * 60 + dt.minute) * 60 + dt.second) * 1000000 +
+        dt.microsecond
+    )
+
+
 class Event(object):
     'a stream of data is read by an EventReader, which returns a sequence of Events'
+    # the datetime, date, and sort key are computed once, as the event loops use them repeatedly
+    __slots__ = (
+        'year', 'month', 'day', 'hour', 'minute', 'second', 'microsecond',
+        'source', 'source_identifier',
+        'payload',
+        'make_event_attributes_class',
+        'sort_key',
+        '_date',
+        '_datetime',
+    )
+
     def __init__(self,
                  year, month, day, hour, minute, second, microsecond,
                  source, source_identifier,
@@ -30,12 +53,7 @@ class Event(object):
         self.make_event_attributes_class = make_event_attributes_class
 
         # check for valid values by attempting to construct
-        datetime.date(self.year, self.month, self.day)
-        datetime.time(self.hour, self.minute, self.second, self.microsecond)
-
-    def __repr__(self):
-        reclassified_trade_type = self.maybe_reclassified_trade_type()
-        return 'Event(%s, %s, %s, %s, %s, %s, %s, %s, %s, %d columns, cusip %s, %s)' % (
+        self._datetime = datetime.datetime(
             self.year,
             self.month,
             self.day,
@@ -43,15 +61,20 @@ class Event(object):
             self.minute,
             self.second,
             self.microsecond,
+        )
+        self._date = self._datetime.date()
+
+        # events are ordered by their sort keys
+        self.sort_key = (
+            timestamp(self._datetime),
             self.source,
             self.source_identifier,
             len(self.payload),
-            self.cusip() if self.is_trace_print() else 'None',
-            '' if reclassified_trade_type is None else reclassified_trade_type,
-            )
+        )
 
-    def _as_tuple(self):
-        return (
+    def __repr__(self):
+        reclassified_trade_type = self.maybe_reclassified_trade_type()
+        return 'Event(%s, %s, %s, %s, %s, %s, %s, %s, %s, %d columns, cusip %s, %s)' % (
             self.year,
             self.month,
             self.day,
@@ -61,52 +84,36 @@ class Event(object):
             self.microsecond,
             self.source,
             self.source_identifier,
-            len(self.payload))
+            len(self.payload),
+            self.cusip() if self.is_trace_print() else 'None',
+            '' if reclassified_trade_type is None else reclassified_trade_type,
+            )
 
     def __eq__(self, other):
         # ref: http://portingguide.readthedocs.io/en/latest/comparisons.html
-        return self._as_tuple() == other._as_tuple()
+        return self.sort_key == other.sort_key
 
     def __ge__(self, other):
-        return self._as_tuple() >= other._as_tuple()
+        return self.sort_key >= other.sort_key
 
     def __gt__(self, other):
-        return self._as_tuple() > other._as_tuple()
+        return self.sort_key > other.sort_key
 
     def __le__(self, other):
-        return self._as_tuple() <= other._as_tuple()
+        return self.sort_key <= other.sort_key
 
     def __lt__(self, other):
-        return self._as_tuple() < other._as_tuple()
+        return self.sort_key < other.sort_key
 
     def __ne__(self, other):
-        return self._as_tuple() != other._as_tuple()
+        return self.sort_key != other.sort_key
 
     def __hash__(self):
-        return hash((
-            self.year,
-            self.month,
-            self.day,
-            self.hour,
-            self.minute,
-            self.second,
-            self.microsecond,
-            self.source,
-            self.source_identifier,
-            len(self.payload),
-            ))
+        return hash(self.sort_key)
 
     def datetime(self):
         'return the date and time as a datetime.datetime object'
-        return datetime.datetime(
-            self.year,
-            self.month,
-            self.day,
-            self.hour,
-            self.minute,
-            self.second,
-            self.microsecond,
-            )
+        return self._datetime
 
     def datetime_str(self):
         'return the date and time as a string'
@@ -122,11 +129,7 @@ class Event(object):
 
     def date(self):
         'return the date as a datetime.date object'
-        return datetime.date(
-            self.year,
-            self.month,
-            self.day,
-            )
+        return self._date
 
     def is_trace_print(self):
         'return True or False'
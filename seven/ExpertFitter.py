@@ -0,0 +1,262 @@
+'''fit the experts for every model spec in a hyperparameter grid, possibly in parallel
+
+An ExpertFitter has one method of interest:
+  fit(model_specs, random_seed, feature_names, x, y, previous_models=None, tree_replacement_fraction=None)
+    -> List[Tuple[model_spec, fitted model or None, err or None]]
+The returned list is in the same order as model_specs, whatever order the fits completed in.
+
+If previous_models (Dict[model_spec, fitted model]) has a model for a model spec that was fitted on
+the same feature names, the new model is warm started from it (see models2.Model.warm_start_from):
+an elastic net starts from the previous coefficients and a random forests model keeps the most
+recent trees, regrowing the fraction tree_replacement_fraction of them on the new data.
+
+Implementations
+  SerialExpertFitter: fit in the calling thread
+  ThreadPoolExpertFitter: fit in a pool of threads; the scikit-learn fitting code releases the GIL
+  ProcessPoolExpertFitter: fit in a pool of processes; the training data are placed in shared memory
+    once per call and each worker process fits a contiguous chunk of the model specs
+
+Copyright 2017 Roy E. Lowrance, roy.lowrance@gmail.com
+
+You may not use this file except in compliance with a License.
+'''
+import abc
+import concurrent.futures
+import numpy as np
+import pdb
+import unittest
+
+from . import models2
+from . import ModelSpec
+
+
+def make_model(model_spec, random_seed):
+    'return an unfitted models2.Model'
+    model_constructor = (
+        models2.ModelNaive if model_spec.name == 'n' else
+        models2.ModelElasticNet if model_spec.name == 'en' else
+        models2.ModelRandomForests if model_spec.name == 'rf' else
+        None
+    )
+    return model_constructor(model_spec, random_seed)
+
+
+def fit_one(model_spec, random_seed, feature_names, x, y, previous_model=None, tree_replacement_fraction=None):
+    'return (model_spec, fitted model, None) or (model_spec, None, err)'
+    model = make_model(model_spec, random_seed)
+    if previous_model is not None and previous_model.feature_names == feature_names:
+        model.warm_start_from(previous_model, tree_replacement_fraction)
+    try:
+        model.fit_array(feature_names, x, y)
+    except models2.ExceptionFit as e:
+        return model_spec, None, str(e)
+    return model_spec, model, None
+
+
+def _fit_chunk_from_shared_memory(model_specs, random_seed, feature_names, shm_name, x_shape, y_shape,
+                                  previous_models, tree_replacement_fraction):
+    'fit each model spec using training data in shared memory; run in a worker process'
+    # previous_models: List[fitted model or None], parallel to model_specs
+    from multiprocessing import shared_memory  # python 3.8 and later
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        x = np.ndarray(x_shape, dtype=np.float64, buffer=shm.buf)
+        y = np.ndarray(y_shape, dtype=np.float64, buffer=shm.buf, offset=x.nbytes)
+        x.flags.writeable = False
+        y.flags.writeable = False
+        result = [
+            fit_one(model_spec, random_seed, feature_names, x, y, previous_model, tree_replacement_fraction)
+            for model_spec, previous_model in zip(model_specs, previous_models)
+        ]
+        del x, y  # release the exported buffers, so that shm can be closed
+    finally:
+        shm.close()
+    return result
+
+
+class ExpertFitter(object, metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def fit(self, model_specs, random_seed, feature_names, x, y, previous_models=None, tree_replacement_fraction=None):
+        'return List[(model_spec, fitted model or None, err or None)] in the order of model_specs'
+
+    def close(self):
+        'release any workers'
+        pass
+
+
+class SerialExpertFitter(ExpertFitter):
+    def __repr__(self):
+        return 'SerialExpertFitter()'
+
+    def fit(self, model_specs, random_seed, feature_names, x, y, previous_models=None, tree_replacement_fraction=None):
+        previous_models = {} if previous_models is None else previous_models
+        return [
+            fit_one(
+                model_spec, random_seed, feature_names, x, y,
+                previous_models.get(model_spec), tree_replacement_fraction,
+            )
+            for model_spec in model_specs
+        ]
+
+
+class ThreadPoolExpertFitter(ExpertFitter):
+    def __init__(self, n_workers):
+        self._n_workers = n_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+
+    def __repr__(self):
+        return 'ThreadPoolExpertFitter(n_workers=%d)' % self._n_workers
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def fit(self, model_specs, random_seed, feature_names, x, y, previous_models=None, tree_replacement_fraction=None):
+        previous_models = {} if previous_models is None else previous_models
+        futures = [
+            self._executor.submit(
+                fit_one,
+                model_spec, random_seed, feature_names, x, y,
+                previous_models.get(model_spec), tree_replacement_fraction,
+            )
+            for model_spec in model_specs
+        ]
+        return [future.result() for future in futures]
+
+
+class ProcessPoolExpertFitter(ExpertFitter):
+    def __init__(self, n_workers):
+        self._n_workers = n_workers
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+
+    def __repr__(self):
+        return 'ProcessPoolExpertFitter(n_workers=%d)' % self._n_workers
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def fit(self, model_specs, random_seed, feature_names, x, y, previous_models=None, tree_replacement_fraction=None):
+        from multiprocessing import shared_memory  # python 3.8 and later
+        model_specs = list(model_specs)
+        previous_models = {} if previous_models is None else previous_models
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        y = np.ascontiguousarray(y, dtype=np.float64)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, x.nbytes + y.nbytes))
+        try:
+            np.ndarray(x.shape, dtype=np.float64, buffer=shm.buf)[:] = x
+            np.ndarray(y.shape, dtype=np.float64, buffer=shm.buf, offset=x.nbytes)[:] = y
+            chunk_size = (len(model_specs) + self._n_workers - 1) // self._n_workers
+            futures = [
+                self._executor.submit(
+                    _fit_chunk_from_shared_memory,
+                    model_specs[start:start + chunk_size],
+                    random_seed,
+                    feature_names,
+                    shm.name,
+                    x.shape,
+                    y.shape,
+                    [previous_models.get(model_spec) for model_spec in model_specs[start:start + chunk_size]],
+                    tree_replacement_fraction,
+                )
+                for start in range(0, len(model_specs), max(1, chunk_size))
+            ]
+            result = []
+            for future in futures:
+                result.extend(future.result())
+        finally:
+            shm.close()
+            shm.unlink()
+        return result
+
+
+def make_expert_fitter(executor, n_workers):
+    'factory'
+    if n_workers == 1:
+        return SerialExpertFitter()
+    elif executor == 'thread':
+        return ThreadPoolExpertFitter(n_workers)
+    elif executor == 'process':
+        return ProcessPoolExpertFitter(n_workers)
+    else:
+        assert False, 'executor %s is not one of thread, process' % executor
+
+
+class TestExpertFitter(unittest.TestCase):
+    def test_results_in_model_spec_order(self):
+        model_specs = [ModelSpec.ModelSpec(name='n') for i in range(5)]
+        feature_names = ['a']
+        x = np.zeros((4, 1))
+        y = np.array([1.0, 2.0, 3.0, 4.0])
+        for fitter in (
+                SerialExpertFitter(),
+                ThreadPoolExpertFitter(2),
+                ProcessPoolExpertFitter(2),
+        ):
+            results = fitter.fit(model_specs, 123, feature_names, x, y)
+            fitter.close()
+            self.assertEqual(len(results), len(model_specs))
+            for i, (model_spec, model, err) in enumerate(results):
+                self.assertEqual(model_spec, model_specs[i])
+                self.assertTrue(err is None)
+                self.assertEqual(model.predict(None), [4.0])
+
+
+class TestWarmStart(unittest.TestCase):
+    def _model(self, model_class, model_spec, sklearn_model):
+        # construct without the constructor, whose default hyperparameters may be unknown to scikit-learn
+        model = model_class.__new__(model_class)
+        models2.Model.__init__(model, model_spec, 123)
+        model.model = sklearn_model
+        return model
+
+    def test_elastic_net_same_fit(self):
+        import sklearn.linear_model
+        model_spec = ModelSpec.ModelSpec(name='en', n_trades_back=10, alpha=0.01, l1_ratio=0.5)
+        feature_names = ['a', 'b']
+        rng = np.random.RandomState(1)
+        x = rng.normal(size=(10, 2))
+        y = x.dot([1.0, -2.0]) + 3.0
+
+        def make():
+            return self._model(
+                models2.ModelElasticNet,
+                model_spec,
+                sklearn.linear_model.ElasticNet(alpha=0.01, l1_ratio=0.5, tol=1e-10, max_iter=100000),
+            )
+
+        previous = make()
+        previous.fit_array(feature_names, x[:-1], y[:-1])
+        cold = make()
+        cold.fit_array(feature_names, x[1:], y[1:])
+        warm = make()
+        warm.warm_start_from(previous, None)
+        warm.fit_array(feature_names, x[1:], y[1:])
+        self.assertTrue(np.allclose(warm.model.coef_, cold.model.coef_))
+
+    def test_random_forests_replaces_oldest_trees(self):
+        import sklearn.ensemble
+        model_spec = ModelSpec.ModelSpec(name='rf', n_trades_back=10, n_estimators=10, max_depth=None,
+                                         max_features=None)
+        feature_names = ['a']
+        x = np.arange(10.0).reshape(-1, 1)
+        y = 2.0 * np.arange(10.0)
+
+        def make():
+            return self._model(
+                models2.ModelRandomForests,
+                model_spec,
+                sklearn.ensemble.RandomForestRegressor(n_estimators=10, random_state=123),
+            )
+
+        previous = make()
+        previous.fit_array(feature_names, x, y)
+        warm = make()
+        warm.warm_start_from(previous, 0.3)
+        warm.fit_array(feature_names, x, y)
+        self.assertEqual(len(warm.model.estimators_), 10)
+        self.assertEqual(warm.model.estimators_[:7], previous.model.estimators_[3:])
+
+
+if __name__ == '__main__':
+    unittest.main()
+    if False:
+        pdb
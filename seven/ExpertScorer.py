@@ -0,0 +1,137 @@
+'''predict with every expert in a set of trained experts in one pass
+
+The ExpertScorer is built once, just after a set of experts is trained. It holds
+- the model specs, in the order of the trained models
+- the coefficients of the elastic net models, stacked into one matrix for each transform_x
+- the random forests models, grouped by transform_x
+- the predictions of the naive models, which do not depend on the query
+- the feature importances of every model, as a matrix with one row per model
+
+A query is a 1D np.array with one value per feature, in the order of feature_names.
+
+Copyright 2017 Roy E. Lowrance, roy.lowrance@gmail.com
+
+You may not use this file except in compliance with a License.
+'''
+import collections
+import numpy as np
+import pdb
+import unittest
+
+from . import models2
+from . import ModelSpec
+
+
+class ExpertScorer(object):
+    def __init__(self, trained_models, feature_names):
+        'trained_models: Dict[model_spec, fitted models2.Model]'
+        self.model_specs = list(trained_models.keys())
+        self.model_families = np.array([model_spec.name for model_spec in self.model_specs])
+        self.feature_names = feature_names
+
+        n_models = len(self.model_specs)
+        n_features = 0 if feature_names is None else len(feature_names)
+        self._naive_indices = []
+        self._naive_predictions = []
+        en = collections.defaultdict(list)  # key = transform_x, value = List[index]
+        self._rf = collections.defaultdict(list)  # key = transform_x, value = List[(index, model)]
+        self._log_y_indices = []
+        self.importances = np.zeros((n_models, n_features))
+        for index, model_spec in enumerate(self.model_specs):
+            model = trained_models[model_spec]
+            if model_spec.name == 'n':
+                self._naive_indices.append(index)
+                self._naive_predictions.append(model.predictions[0])
+                continue
+            assert model.feature_names == feature_names
+            if model_spec.transform_y == 'log':
+                self._log_y_indices.append(index)
+            if model_spec.name == 'en':
+                en[model_spec.transform_x].append(index)
+                self.importances[index] = model.model.coef_
+            elif model_spec.name == 'rf':
+                self._rf[model_spec.transform_x].append((index, model))
+                self.importances[index] = model.model.feature_importances_
+            else:
+                assert False, 'unknown model name %s' % model_spec.name
+
+        # stack the elastic net coefficients
+        self._en = {}  # key = transform_x, value = (indices, coefficients 2D, intercepts 1D)
+        for transform_x, indices in en.items():
+            models = [trained_models[self.model_specs[index]] for index in indices]
+            self._en[transform_x] = (
+                np.array(indices, dtype=int),
+                np.array([model.model.coef_ for model in models]),
+                np.array([model.model.intercept_ for model in models]),
+            )
+        self._transformer = None if len(self.model_specs) == 0 else trained_models[self.model_specs[0]]
+
+    def __len__(self):
+        return len(self.model_specs)
+
+    def __repr__(self):
+        return 'ExpertScorer(%d models)' % len(self.model_specs)
+
+    def predict(self, query):
+        'return 1D np.array with the prediction of each model for the query'
+        result = np.zeros(len(self.model_specs))
+        result[self._naive_indices] = self._naive_predictions
+        transformed = {}  # key = transform_x, value = 2D np.array with one row
+
+        def transformed_query(transform_x):
+            if transform_x not in transformed:
+                transformed[transform_x] = self._transformer._transform_columns(
+                    transform_x,
+                    self.feature_names,
+                    query.reshape(1, -1),
+                )
+            return transformed[transform_x]
+
+        for transform_x, (indices, coefficients, intercepts) in self._en.items():
+            result[indices] = coefficients.dot(transformed_query(transform_x)[0]) + intercepts
+        for transform_x, indexed_models in self._rf.items():
+            x = transformed_query(transform_x)
+            for index, model in indexed_models:
+                result[index] = model.model.predict(x)[0]
+        if len(self._log_y_indices) > 0:
+            result[self._log_y_indices] = np.exp(result[self._log_y_indices])
+        return result
+
+
+class TestExpertScorer(unittest.TestCase):
+    def test_same_as_predict(self):
+        import sklearn.linear_model
+        feature_names = ['a', 'b_size']
+        x = np.array([[1.0, 2.0], [2.0, 1.0], [3.0, 5.0], [4.0, 3.0]])
+        y = np.array([1.0, 3.0, 2.0, 5.0])
+        trained_models = {}
+        naive_spec = ModelSpec.ModelSpec(name='n')
+        naive = models2.ModelNaive(naive_spec, 123)
+        naive.fit_array(feature_names, x, y)
+        trained_models[naive_spec] = naive
+        for transform_x in (None, 'log1p'):
+            model_spec = ModelSpec.ModelSpec(
+                name='en',
+                n_trades_back=4,
+                transform_x=transform_x,
+                alpha=0.01,
+                l1_ratio=0.5,
+            )
+            model = models2.ModelElasticNet.__new__(models2.ModelElasticNet)
+            models2.Model.__init__(model, model_spec, 123)
+            model.model = sklearn.linear_model.ElasticNet(alpha=0.01, l1_ratio=0.5)
+            model.fit_array(feature_names, x, y)
+            trained_models[model_spec] = model
+        scorer = ExpertScorer(trained_models, feature_names)
+        query = np.array([2.5, 4.0])
+        predictions = scorer.predict(query)
+        for index, model_spec in enumerate(scorer.model_specs):
+            expected = trained_models[model_spec].predict([dict(zip(feature_names, query))])[0]
+            self.assertAlmostEqual(predictions[index], expected)
+        self.assertEqual(list(scorer.model_families), ['n', 'en', 'en'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+    if False:
+        pdb
@@ -15,6 +15,10 @@ from . import ModelSpec
 
 
 class HpGrid(object):
+    # the experts with these model names are warm started from the experts trained just before them
+    warm_start_model_names = ()
+    # fraction of the trees of a warm-started random forests model that are regrown on the new data
+    tree_replacement_fraction = 0.1
 
     def iter_model_specs(self):
         'yield each element: ModelSpec of the grid'
@@ -153,6 +157,11 @@ class HpGrid5(HpGrid):
         self.max_features_choices = ('sqrt', None)     # number of features to consider when looking for best split
 
 
+class HpGrid6(HpGrid5):
+    'grid 5, with the elastic net and random forests experts warm started from the previous experts'
+    warm_start_model_names = ('en', 'rf')
+
+
 def construct_HpGridN(hpset):
     'factory'
     if hpset == 'grid1':
@@ -165,6 +174,8 @@ def construct_HpGridN(hpset):
         return HpGrid4()
     elif hpset == 'grid5':
         return HpGrid5()
+    elif hpset == 'grid6':
+        return HpGrid6()
     else:
         logging.critical('bad hpset value %s' % hpset)
         sys.exit(1)
@@ -0,0 +1,69 @@
+'''accumulate the mean of the values for each key, without keeping the values
+
+The running totals and counts of two MeanAccumulators can be merged, so that the values can be
+accumulated in several processes and combined.
+
+Copyright 2017 Roy E. Lowrance, roy.lowrance@gmail.com
+
+You may not use this file except in compliance with a License.
+'''
+import collections
+import pdb
+import unittest
+
+
+class MeanAccumulator(object):
+    'running total and count of the values for each key'
+    def __init__(self):
+        self._totals = collections.defaultdict(float)  # Dict[key, float]
+        self._counts = collections.defaultdict(int)    # Dict[key, int]
+
+    def __len__(self):
+        return len(self._totals)
+
+    def __repr__(self):
+        return 'MeanAccumulator(%d keys)' % len(self)
+
+    def add(self, key, value):
+        'key: Tuple'
+        self._totals[key] += value
+        self._counts[key] += 1
+
+    def means(self):
+        'return List[Tuple[*key, mean value]]'
+        return [
+            key + (total / self._counts[key],)
+            for key, total in self._totals.items()
+        ]
+
+    def merge(self, other):
+        'add the totals and counts of the other MeanAccumulator'
+        for key, total in other._totals.items():
+            self._totals[key] += total
+            self._counts[key] += other._counts[key]
+
+
+class TestMeanAccumulator(unittest.TestCase):
+    def test_add_and_means(self):
+        accumulator = MeanAccumulator()
+        accumulator.add(('a', 1), 1.0)
+        accumulator.add(('a', 1), 2.0)
+        accumulator.add(('b', 2), 5.0)
+        self.assertEqual(len(accumulator), 2)
+        self.assertEqual(sorted(accumulator.means()), [('a', 1, 1.5), ('b', 2, 5.0)])
+
+    def test_merge(self):
+        accumulator1 = MeanAccumulator()
+        accumulator1.add(('a',), 1.0)
+        accumulator2 = MeanAccumulator()
+        accumulator2.add(('a',), 2.0)
+        accumulator2.add(('a',), 6.0)
+        accumulator2.add(('b',), 4.0)
+        accumulator1.merge(accumulator2)
+        self.assertEqual(sorted(accumulator1.means()), [('a', 3.0), ('b', 4.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
+    if False:
+        pdb
@@ -0,0 +1,223 @@
+'''decide when to retrain the experts and which model specs to retrain
+
+A RetrainScheduler is told about the feature vectors, tests, and trainings of a TestTrain
+  observe_feature_vector(simulated_datetime)
+  observe_test(simulated_datetime, absolute_error): absolute error of the ensemble prediction
+  observe_training(simulated_datetime)
+and it answers
+  reason_not_to_train(simulated_datetime) -> None or err
+  select_model_specs(model_specs, lag) -> List[model_spec] to train, where lag (a datetime.timedelta)
+    is how far the simulated clock is behind the datetime of the event being processed
+
+Implementations
+  MinTimedeltaScheduler: train when min_timedelta of simulated time has passed since the last training
+  EveryNTradesScheduler: train when n_trades feature vectors have been seen since the last training
+  DriftScheduler: train when the absolute error of the ensemble exceeds a multiple of its mean over the
+    preceding tests
+  TimeBudgetScheduler: wrap another scheduler; while the lag exceeds max_lag, drop the expensive model
+    specs (by default, the random forests) from the trainings
+
+Copyright 2017 Roy E. Lowrance, roy.lowrance@gmail.com
+
+You may not use this file except in compliance with a License.
+'''
+import abc
+import collections
+import datetime
+import pdb
+import unittest
+
+from . import ModelSpec
+
+
+class RetrainScheduler(object, metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def reason_not_to_train(self, simulated_datetime):
+        'return None if the experts should be trained now, otherwise an err'
+
+    def observe_feature_vector(self, simulated_datetime):
+        pass
+
+    def observe_test(self, simulated_datetime, absolute_error):
+        pass
+
+    def observe_training(self, simulated_datetime):
+        pass
+
+    def select_model_specs(self, model_specs, lag):
+        'return List[model_spec] to train'
+        return list(model_specs)
+
+
+class MinTimedeltaScheduler(RetrainScheduler):
+    def __init__(self, min_timedelta):
+        self._min_timedelta = min_timedelta
+        self._last_training_datetime = datetime.datetime(1, 1, 1)
+
+    def __repr__(self):
+        return 'MinTimedeltaScheduler(min_timedelta=%s)' % self._min_timedelta
+
+    def observe_training(self, simulated_datetime):
+        self._last_training_datetime = simulated_datetime
+
+    def reason_not_to_train(self, simulated_datetime):
+        if simulated_datetime - self._last_training_datetime < self._min_timedelta:
+            return '%s had not passed since last training' % self._min_timedelta
+        return None
+
+
+class EveryNTradesScheduler(RetrainScheduler):
+    def __init__(self, n_trades):
+        assert n_trades >= 1
+        self._n_trades = n_trades
+        self._n_trades_since_training = n_trades  # so that the first opportunity to train is taken
+
+    def __repr__(self):
+        return 'EveryNTradesScheduler(n_trades=%d)' % self._n_trades
+
+    def observe_feature_vector(self, simulated_datetime):
+        self._n_trades_since_training += 1
+
+    def observe_training(self, simulated_datetime):
+        self._n_trades_since_training = 0
+
+    def reason_not_to_train(self, simulated_datetime):
+        if self._n_trades_since_training < self._n_trades:
+            return 'had %d trades since last training, need %d' % (self._n_trades_since_training, self._n_trades)
+        return None
+
+
+class DriftScheduler(RetrainScheduler):
+    def __init__(self, window, factor):
+        assert window >= 1
+        assert factor > 0.0
+        self._window = window
+        self._factor = factor
+        self._has_trained = False
+        # the absolute errors of the tests since the last training, the most recent last
+        self._absolute_errors = collections.deque([], window + 1)
+
+    def __repr__(self):
+        return 'DriftScheduler(window=%d, factor=%f)' % (self._window, self._factor)
+
+    def observe_test(self, simulated_datetime, absolute_error):
+        self._absolute_errors.append(absolute_error)
+
+    def observe_training(self, simulated_datetime):
+        # the errors of the previous experts say nothing about the drift of the new ones
+        self._has_trained = True
+        self._absolute_errors.clear()
+
+    def reason_not_to_train(self, simulated_datetime):
+        if not self._has_trained:
+            return None
+        if len(self._absolute_errors) <= self._window:
+            return 'had %d tests since last training, need %d to detect drift' % (
+                len(self._absolute_errors),
+                self._window + 1,
+            )
+        errors = list(self._absolute_errors)
+        threshold = self._factor * sum(errors[:-1]) / self._window
+        if errors[-1] <= threshold:
+            return 'absolute error %f did not exceed drift threshold %f' % (errors[-1], threshold)
+        return None
+
+
+class TimeBudgetScheduler(RetrainScheduler):
+    def __init__(self, scheduler, max_lag, expensive_model_names=('rf',)):
+        self._scheduler = scheduler
+        self._max_lag = max_lag
+        self._expensive_model_names = expensive_model_names
+
+    def __repr__(self):
+        return 'TimeBudgetScheduler(%s, max_lag=%s)' % (self._scheduler, self._max_lag)
+
+    def observe_feature_vector(self, simulated_datetime):
+        self._scheduler.observe_feature_vector(simulated_datetime)
+
+    def observe_test(self, simulated_datetime, absolute_error):
+        self._scheduler.observe_test(simulated_datetime, absolute_error)
+
+    def observe_training(self, simulated_datetime):
+        self._scheduler.observe_training(simulated_datetime)
+
+    def reason_not_to_train(self, simulated_datetime):
+        return self._scheduler.reason_not_to_train(simulated_datetime)
+
+    def select_model_specs(self, model_specs, lag):
+        model_specs = self._scheduler.select_model_specs(model_specs, lag)
+        if lag <= self._max_lag:
+            return model_specs
+        return [
+            model_spec
+            for model_spec in model_specs
+            if model_spec.name not in self._expensive_model_names
+        ]
+
+
+def make_retrain_scheduler(policy, min_timedelta, n_trades, drift_window, drift_factor, max_lag):
+    'factory; max_lag is None or a datetime.timedelta'
+    if policy == 'time':
+        scheduler = MinTimedeltaScheduler(min_timedelta)
+    elif policy == 'trades':
+        scheduler = EveryNTradesScheduler(n_trades)
+    elif policy == 'drift':
+        scheduler = DriftScheduler(drift_window, drift_factor)
+    else:
+        assert False, 'policy %s is not one of time, trades, drift' % policy
+    if max_lag is None:
+        return scheduler
+    return TimeBudgetScheduler(scheduler, max_lag)
+
+
+class TestRetrainScheduler(unittest.TestCase):
+    def setUp(self):
+        self.t0 = datetime.datetime(2017, 7, 1, 10, 0, 0)
+
+    def test_min_timedelta(self):
+        scheduler = MinTimedeltaScheduler(datetime.timedelta(0, 60.0))
+        self.assertTrue(scheduler.reason_not_to_train(self.t0) is None)
+        scheduler.observe_training(self.t0)
+        self.assertTrue(isinstance(scheduler.reason_not_to_train(self.t0 + datetime.timedelta(0, 59.0)), str))
+        self.assertTrue(scheduler.reason_not_to_train(self.t0 + datetime.timedelta(0, 60.0)) is None)
+
+    def test_every_n_trades(self):
+        scheduler = EveryNTradesScheduler(3)
+        self.assertTrue(scheduler.reason_not_to_train(self.t0) is None)
+        scheduler.observe_training(self.t0)
+        for i in range(2):
+            scheduler.observe_feature_vector(self.t0)
+            self.assertTrue(isinstance(scheduler.reason_not_to_train(self.t0), str))
+        scheduler.observe_feature_vector(self.t0)
+        self.assertTrue(scheduler.reason_not_to_train(self.t0) is None)
+
+    def test_drift(self):
+        scheduler = DriftScheduler(window=3, factor=2.0)
+        self.assertTrue(scheduler.reason_not_to_train(self.t0) is None)
+        scheduler.observe_training(self.t0)
+        for absolute_error in (1.0, 2.0, 3.0, 3.9):
+            scheduler.observe_test(self.t0, absolute_error)
+        self.assertTrue(isinstance(scheduler.reason_not_to_train(self.t0), str))  # threshold is 4.0
+        scheduler.observe_test(self.t0, 12.0)
+        self.assertTrue(scheduler.reason_not_to_train(self.t0) is None)  # threshold is 2 * (2 + 3 + 3.9) / 3
+        scheduler.observe_training(self.t0)
+        self.assertTrue(isinstance(scheduler.reason_not_to_train(self.t0), str))
+
+    def test_time_budget(self):
+        model_specs = [
+            ModelSpec.ModelSpec(name='n'),
+            ModelSpec.ModelSpec(name='en', n_trades_back=10, alpha=0.01, l1_ratio=0.5),
+            ModelSpec.ModelSpec(name='rf', n_trades_back=10, n_estimators=10, max_depth=None, max_features=None),
+        ]
+        scheduler = make_retrain_scheduler('trades', None, 1, None, None, datetime.timedelta(0, 1.0))
+        self.assertEqual(scheduler.select_model_specs(model_specs, datetime.timedelta(0, 1.0)), model_specs)
+        self.assertEqual(scheduler.select_model_specs(model_specs, datetime.timedelta(0, 2.0)), model_specs[:2])
+        self.assertTrue(scheduler.reason_not_to_train(self.t0) is None)
+        scheduler.observe_training(self.t0)
+        self.assertTrue(isinstance(scheduler.reason_not_to_train(self.t0), str))
+
+
+if __name__ == '__main__':
+    unittest.main()
+    if False:
+        pdb
@@ -0,0 +1,194 @@
+'''append-only store of feature vectors, actual target values, and datetimes as numpy arrays
+
+The rows are kept in increasing order of arrival. The columns are the non-id features,
+in sorted order of their names (which is the order used by models2.Model).
+
+Storage is a contiguous buffer with room for 2 * maxlen rows. When the buffer fills,
+the most recent maxlen rows are copied into a newly-allocated buffer. Because filled
+rows are never overwritten, the arrays returned by the accessors are views that remain
+valid for as long as the caller holds them.
+
+Copyright 2017 Roy E. Lowrance, roy.lowrance@gmail.com
+
+You may not use this file except in compliance with a License.
+'''
+import datetime
+import numpy as np
+import pdb
+import unittest
+
+
+class TrainingMatrix(object):
+    def __init__(self, maxlen):
+        assert maxlen >= 1
+        self._maxlen = maxlen
+
+        self.feature_names = None  # List[str], set by the first call to append()
+
+        self._capacity = 2 * maxlen
+        self._features = None   # np.array 2D, allocated once we know the number of features
+        self._actuals = None    # np.array 1D of float
+        self._datetimes = None  # np.array 1D of datetime64[us]
+        self._start = 0         # index of oldest retained row
+        self._stop = 0          # index one past the youngest row
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __repr__(self):
+        return 'TrainingMatrix(%d rows, %d features, maxlen=%d)' % (
+            len(self),
+            0 if self.feature_names is None else len(self.feature_names),
+            self._maxlen,
+        )
+
+    def append(self, features, actual, when):
+        'append one row; features is Dict[feature_name, value], actual is a float or None'
+        assert isinstance(features, dict)
+        assert isinstance(when, datetime.datetime)
+        if self.feature_names is None:
+            self._allocate([
+                feature_name
+                for feature_name in sorted(features.keys())
+                if not feature_name.startswith('id_')
+            ])
+        row = self._next_row(actual, when)
+        for column, feature_name in enumerate(self.feature_names):
+            self._features[row, column] = features[feature_name]
+
+    def append_row(self, feature_names, row, actual, when):
+        'append one row; row is a 1D np.array with the values of the sorted feature_names'
+        assert isinstance(when, datetime.datetime)
+        if self.feature_names is None:
+            assert list(feature_names) == sorted(feature_names)
+            self._allocate(list(feature_names))
+        else:
+            assert feature_names is self.feature_names or list(feature_names) == self.feature_names
+        self._features[self._next_row(actual, when)] = row
+
+    def actuals(self):
+        'return read-only 1D np.array with the actual target value for each row'
+        return self._view(self._actuals)
+
+    def datetimes(self):
+        'return read-only 1D np.array of datetime64 values'
+        return self._view(self._datetimes)
+
+    def features(self):
+        'return read-only 2D np.array with one row per feature vector'
+        return self._view(self._features)
+
+    def training_data(self):
+        'return (features, targets, err) where the target is the actual value at the next later datetime'
+        n = len(self)
+        if n < 2:
+            return None, None, 'need at least 2 rows to create training data, had %d' % n
+        datetimes = self.datetimes()
+        # the target for row i is the actual for the first row with a strictly later datetime
+        next_indices = np.searchsorted(datetimes, datetimes[:-1], side='right')
+        if next_indices[-1] == n:
+            return None, None, 'no future trade in same primary cusip to find target value'
+        targets = self.actuals()[next_indices]
+        if np.isnan(targets).any():
+            return None, None, 'some training targets were not interpretable as floats'
+        return self.features()[:-1], targets, None
+
+    def _allocate(self, feature_names):
+        self.feature_names = feature_names
+        self._features = np.empty((self._capacity, len(self.feature_names)))
+        self._actuals = np.empty(self._capacity)
+        self._datetimes = np.empty(self._capacity, dtype='datetime64[us]')
+
+    def _next_row(self, actual, when):
+        'return index of a new row, after storing its actual and datetime'
+        if self._stop == self._capacity:
+            self._reallocate()
+        row = self._stop
+        self._actuals[row] = np.nan if actual is None else actual
+        self._datetimes[row] = np.datetime64(when, 'us')
+        self._stop += 1
+        if len(self) > self._maxlen:
+            self._start += 1
+        return row
+
+    def _reallocate(self):
+        'copy retained rows into a new buffer, so that views into the old buffer stay valid'
+        def moved(old):
+            new = np.empty_like(old)
+            new[:n] = old[self._start:self._stop]
+            return new
+
+        n = len(self)
+        self._features = moved(self._features)
+        self._actuals = moved(self._actuals)
+        self._datetimes = moved(self._datetimes)
+        self._start = 0
+        self._stop = n
+
+    def _view(self, a):
+        result = a[self._start:self._stop]
+        result.flags.writeable = False
+        return result
+
+
+class TestTrainingMatrix(unittest.TestCase):
+    def _append(self, tm, i, when=None):
+        tm.append(
+            features={'id_x': 'ignored', 'b': 10.0 * i, 'a': float(i)},
+            actual=100.0 + i,
+            when=datetime.datetime(2017, 1, 1, 0, 0, i) if when is None else when,
+        )
+
+    def test_columns_sorted_without_ids(self):
+        tm = TrainingMatrix(maxlen=3)
+        self._append(tm, 1)
+        self.assertEqual(tm.feature_names, ['a', 'b'])
+        self.assertEqual(tm.features().tolist(), [[1.0, 10.0]])
+
+    def test_maxlen_and_views(self):
+        tm = TrainingMatrix(maxlen=3)
+        for i in range(3):
+            self._append(tm, i)
+        held = tm.features()
+        for i in range(3, 10):
+            self._append(tm, i)
+        self.assertEqual(len(tm), 3)
+        self.assertEqual(tm.features()[:, 0].tolist(), [7.0, 8.0, 9.0])
+        self.assertEqual(tm.actuals().tolist(), [107.0, 108.0, 109.0])
+        self.assertEqual(held[:, 0].tolist(), [0.0, 1.0, 2.0])  # earlier views are not overwritten
+        self.assertFalse(tm.features().flags.writeable)
+
+    def test_append_row(self):
+        tm = TrainingMatrix(maxlen=2)
+        self._append(tm, 1)
+        for i in range(2, 5):
+            tm.append_row(tm.feature_names, np.array([float(i), 10.0 * i]), 100.0 + i, datetime.datetime(2017, 1, i))
+        self.assertEqual(tm.features().tolist(), [[3.0, 30.0], [4.0, 40.0]])
+        self.assertEqual(tm.actuals().tolist(), [103.0, 104.0])
+
+    def test_training_data(self):
+        tm = TrainingMatrix(maxlen=10)
+        same = datetime.datetime(2017, 1, 1, 0, 0, 30)
+        self._append(tm, 1)
+        self._append(tm, 2, when=same)
+        self._append(tm, 3, when=same)
+        self._append(tm, 4, when=datetime.datetime(2017, 1, 1, 0, 0, 40))
+        features, targets, err = tm.training_data()
+        self.assertTrue(err is None)
+        self.assertEqual(features[:, 0].tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(targets.tolist(), [102.0, 104.0, 104.0])
+
+    def test_training_data_errors(self):
+        tm = TrainingMatrix(maxlen=10)
+        self._append(tm, 1)
+        features, targets, err = tm.training_data()
+        self.assertTrue(isinstance(err, str))
+        self._append(tm, 1)  # same datetime, so no future trade
+        features, targets, err = tm.training_data()
+        self.assertTrue(isinstance(err, str))
+
+
+if __name__ == '__main__':
+    unittest.main()
+    if False:
+        pdb
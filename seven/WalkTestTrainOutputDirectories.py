@@ -1,88 +1,304 @@
-'visit every output directory created by test_train.py'
+'''visit every output directory created by test_train.py
+
+The output directory of test_train.py is
+  {root}/{issuer}/{cusip}/{target}/{hpset}/{start_events}/{start_predictions}/{stop_predictions}/
+    {upstream_version}/{feature_version}
+and the invocation parameters of the run that wrote it are the names of the directories on that path.
+
+The walker lists each directory with os.scandir, and prunes while descending:
+- the start_events, start_predictions, and stop_predictions directories must be named by a date
+- the start_predictions and stop_predictions dates must be within the dates asked for, if any
+- the upstream_version and feature_version directories are looked up by name, not listed
+The subtree of each issuer is walked by one of n_workers threads. The visit function is always called
+in the calling thread, in sorted order of the directory paths.
+
+test_train.py writes most of its output files as {name}.partial and renames them to {name} when the run
+finishes. The walker lists each output directory and warns about every {name}.partial file in it, as
+such a file was left by a run that did not finish (or is still running).
+
+If a manifest_path is given, the manifest file there records, for each directory listed, its mtime
+and the names of its subdirectories. A later walk, possibly by another program, reuses the recorded
+names of a directory whose mtime has not changed, instead of listing it again. A directory is
+recorded only if it was last modified more than manifest_min_age_seconds before it was listed, as
+a file system may not change the mtime of a directory modified within the same clock tick.
+
+Copyright 2017 Roy E. Lowrance, roy.lowrance@gmail.com
+
+You may not use this file except in compliance with a License.
+'''
+import concurrent.futures
 import datetime
+import json
 import os
 import pdb
+import tempfile
+import time
+import unittest
+
+from . import logging
+
+
+level_names = (
+    'issuer',
+    'cusip',
+    'target',
+    'hpset',
+    'start_events',
+    'start_predictions',
+    'stop_predictions',
+    'upstream_version',
+    'feature_version',
+)
+manifest_version = 1
+manifest_min_age_seconds = 2.0
 
 
 class WalkTestTrainOutputDirectories(object):
     'apply a function to each data-containing directory produced by test_train.py'
-    def __init__(self, root_directory, upstream_version, feature_version):
+    def __init__(self, root_directory, upstream_version, feature_version, manifest_path=None, n_workers=1):
+        assert n_workers >= 1
         self._root_directory = root_directory
         self._upstream_version = upstream_version
         self._feature_version = feature_version
+        self._manifest_path = manifest_path
+        self._n_workers = n_workers
 
-    def walk(self, visit):
-        for issuer in os.listdir(self._root_directory):
-            path_issuer = os.path.join(self._root_directory, issuer)
-            for cusip in os.listdir(path_issuer):
-                path_cusip = os.path.join(path_issuer, cusip)
-                for target in os.listdir(path_cusip):
-                    path_target = os.path.join(path_cusip, target)
-                    for hpset in os.listdir(path_target):
-                        path_hpset = os.path.join(path_target, hpset)
-                        for start_events in os.listdir(path_hpset):
-                            if not self._is_date(start_events):
-                                # skip directories without a date
-                                # these are possibly left-over from prior versions of the application
-                                # in any case, they were not created by test_train.py
-                                continue
-                            path_startevents = os.path.join(path_hpset, start_events)
-                            for start_predictions in os.listdir(path_startevents):
-                                if not self._is_date(start_predictions):
-                                    continue
-                                path_startpredictions = os.path.join(path_startevents, start_predictions)
-                                for stop_predictions in os.listdir(path_startpredictions):
-                                    if not self._is_date(stop_predictions):
-                                        continue
-                                    path_stoppredictions = os.path.join(path_startpredictions, stop_predictions)
-                                    for upstream_version in os.listdir(path_stoppredictions):
-                                        path_upstreamversion = os.path.join(path_stoppredictions, upstream_version)
-                                        if os.path.isfile(path_upstreamversion):
-                                            continue
-                                        for feature_version in os.listdir(path_upstreamversion):
-                                            path_featureversion = os.path.join(path_upstreamversion, feature_version)
-                                            if os.path.isfile(path_featureversion):
-                                                continue
-                                            if upstream_version == self._upstream_version and feature_version == self._feature_version:
-                                                invocation_parameters = {
-                                                    'issuer': issuer,
-                                                    'cusip': cusip,
-                                                    'target': target,
-                                                    'hpset': hpset,
-                                                    'start_events': start_events,
-                                                    'start_predictions': start_predictions,
-                                                    'stop_predictions': stop_predictions,
-                                                    'upstream_version': upstream_version,
-                                                    'feature_version': feature_version,
-                                                }
-                                                visit(
-                                                    directory_path=path_featureversion,
-                                                    invocation_parameters=invocation_parameters,
-                                                )
+    def __repr__(self):
+        return 'WalkTestTrainOutputDirectories(%s, %s, %s)' % (
+            self._root_directory,
+            self._upstream_version,
+            self._feature_version,
+        )
 
-    def walk_prediction_dates_between(self, visit, start_date, stop_date):
-        def as_datetime_date(s):
-            return self._as_datetime_date(s)
+    def walk(self, visit, start_date=None, stop_date=None):
+        'call visit(directory_path=, invocation_parameters=) for each output directory'
+        # start_date and stop_date, if not None, bound the start_predictions and stop_predictions dates
+        old_manifest = self._read_manifest()
+        new_manifest = {}  # key = directory path relative to the root, value = [mtime_ns, subdirectory names]
+        issuers = self._subdirectory_names('', 0, start_date, stop_date, old_manifest, new_manifest)
+        if self._n_workers == 1:
+            results = [
+                self._walk_subtree((issuer,), start_date, stop_date, old_manifest)
+                for issuer in issuers
+            ]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._n_workers) as executor:
+                results = list(executor.map(
+                    lambda issuer: self._walk_subtree((issuer,), start_date, stop_date, old_manifest),
+                    issuers,
+                ))
+        for leaves, manifest in results:
+            new_manifest.update(manifest)
+        self._write_manifest(old_manifest, new_manifest)
+        for leaves, manifest in results:
+            for names in leaves:
+                visit(
+                    directory_path=os.path.join(self._root_directory, *names),
+                    invocation_parameters=dict(zip(level_names, names)),
+                )
 
-        def my_visitor(directory_path, invocation_parameters):
-            if start_date <= as_datetime_date(invocation_parameters['start_predictions']):
-                if as_datetime_date(invocation_parameters['stop_predictions']) <= stop_date:
-                    visit(directory_path, invocation_parameters)
+    def walk_prediction_dates_between(self, visit, start_date, stop_date):
+        self.walk(visit, start_date=start_date, stop_date=stop_date)
 
-        self.walk(my_visitor)
+    def _walk_subtree(self, names, start_date, stop_date, old_manifest):
+        'return (List[names of a leaf directory], manifest entries) for the subtree at the names'
+        leaves = []
+        manifest = {}
+        pending = [names]
+        while len(pending) > 0:
+            names = pending.pop()
+            if len(names) == len(level_names):
+                self._report_partial_files(names)
+                leaves.append(names)
+                continue
+            relative_path = os.path.join(*names)
+            subdirectory_names = self._subdirectory_names(
+                relative_path,
+                len(names),
+                start_date,
+                stop_date,
+                old_manifest,
+                manifest,
+            )
+            # push in reverse order, so that the leaves are found in sorted order
+            for name in reversed(subdirectory_names):
+                pending.append(names + (name,))
+        return leaves, manifest
 
-    def _as_datetime_date(self, s):
-        year, month, day = s.split('-')
-        return datetime.date(int(year), int(month), int(day))
+    def _report_partial_files(self, names):
+        'warn about and return List[path] of the files in the output directory not finalized by test_train.py'
+        path = os.path.join(self._root_directory, *names)
+        try:
+            with os.scandir(path) as it:
+                partial_names = sorted(dir_entry.name for dir_entry in it if dir_entry.name.endswith('.partial'))
+        except OSError as e:
+            logging.warning('could not list directory %s: %s' % (path, e))
+            return []
+        result = [os.path.join(path, name) for name in partial_names]
+        for partial_path in result:
+            logging.warning('%s was not finalized; its test_train.py run did not finish or is still running' % (
+                partial_path,
+            ))
+        return result
 
-    def _is_date(self, s):
-        'does string s contain a valid date?'
+    def _subdirectory_names(self, relative_path, level, start_date, stop_date, old_manifest, new_manifest):
+        'return sorted List[name] of the subdirectories at the level that may hold output directories'
+        path = os.path.join(self._root_directory, relative_path)
+        level_name = level_names[level]
+        if level_name in ('upstream_version', 'feature_version'):
+            name = self._upstream_version if level_name == 'upstream_version' else self._feature_version
+            return [name] if os.path.isdir(os.path.join(path, name)) else []
         try:
-            self._as_datetime_date(s)
+            mtime_ns = os.stat(path).st_mtime_ns
+            entry = old_manifest.get(relative_path)
+            if entry is not None and entry[0] == mtime_ns:
+                names = entry[1]
+            else:
+                with os.scandir(path) as it:
+                    names = sorted(dir_entry.name for dir_entry in it if dir_entry.is_dir())
+        except OSError as e:
+            # possibly removed while we walked
+            logging.warning('could not list directory %s: %s' % (path, e))
+            return []
+        if time.time_ns() - mtime_ns > manifest_min_age_seconds * 1e9:
+            new_manifest[relative_path] = [mtime_ns, names]
+        return [name for name in names if self._is_wanted(level_name, name, start_date, stop_date)]
+
+    def _is_wanted(self, level_name, name, start_date, stop_date):
+        'can the directory with the name at the level hold output directories we want?'
+        if level_name not in ('start_events', 'start_predictions', 'stop_predictions'):
             return True
-        except Exception:
+        # skip directories without a date
+        # these are possibly left-over from prior versions of the application
+        # in any case, they were not created by test_train.py
+        date = self._as_datetime_date(name)
+        if date is None:
             return False
+        if level_name == 'start_predictions' and start_date is not None:
+            return start_date <= date
+        if level_name == 'stop_predictions' and stop_date is not None:
+            return date <= stop_date
+        return True
+
+    def _as_datetime_date(self, s):
+        'return datetime.date or None, if s does not contain a valid date'
+        try:
+            year, month, day = s.split('-')
+            return datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            return None
+
+    def _read_manifest(self):
+        'return Dict[relative path, [mtime_ns, List[name]]]'
+        if self._manifest_path is None:
+            return {}
+        try:
+            with open(self._manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != manifest_version or manifest.get('root') != self._root_directory:
+            return {}
+        return manifest['directories']
+
+    def _write_manifest(self, old_manifest, new_manifest):
+        'write the manifest atomically, keeping the entries for directories not listed in this walk'
+        if self._manifest_path is None:
+            return
+        directories = dict(old_manifest)
+        directories.update(new_manifest)
+        temp_path = self._manifest_path + '.%d.temp' % os.getpid()
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(
+                    {'version': manifest_version, 'root': self._root_directory, 'directories': directories},
+                    f,
+                )
+            os.replace(temp_path, self._manifest_path)
+        except OSError as e:
+            logging.warning('could not write walk manifest %s: %s' % (self._manifest_path, e))
+
+
+class TestWalkTestTrainOutputDirectories(unittest.TestCase):
+    def _make_tree(self, root, leaves):
+        for leaf in leaves:
+            os.makedirs(os.path.join(root, *leaf))
+
+    def _walk(self, walker, **kwds):
+        visited = []
+
+        def visit(directory_path, invocation_parameters):
+            visited.append((directory_path, invocation_parameters))
+
+        walker.walk(visit, **kwds)
+        return visited
+
+    def test_walk(self):
+        leaves = (
+            ('AAPL', 'c1', 'oasspread', 'grid5', '2017-01-01', '2017-04-01', '2017-04-30', '1', '2'),
+            ('AAPL', 'c1', 'oasspread', 'grid5', '2017-01-01', '2017-05-01', '2017-05-31', '1', '2'),
+            ('AAPL', 'c1', 'oasspread', 'grid5', '2017-01-01', '2017-05-01', '2017-05-31', '1', '3'),
+            ('AAPL', 'c1', 'oasspread', 'grid5', 'old', '2017-05-01', '2017-05-31', '1', '2'),
+            ('MSFT', 'c2', 'oasspread', 'grid5', '2017-01-01', '2017-06-01', '2017-06-30', '1', '2'),
+        )
+        with tempfile.TemporaryDirectory() as dir:
+            root = os.path.join(dir, 'test_train')
+            self._make_tree(root, leaves)
+            with open(os.path.join(root, 'AAPL', 'notes.txt'), 'w') as f:
+                f.write('not a directory')
+            manifest_path = os.path.join(dir, 'manifest.json')
+            for n_workers in (1, 2):
+                walker = WalkTestTrainOutputDirectories(root, '1', '2', manifest_path, n_workers)
+                visited = self._walk(walker)
+                self.assertEqual([directory_path for directory_path, ip in visited], [
+                    os.path.join(root, *leaf)
+                    for leaf in (leaves[0], leaves[1], leaves[4])
+                ])
+                self.assertEqual(visited[2][1]['issuer'], 'MSFT')
+                self.assertEqual(visited[2][1]['feature_version'], '2')
+                visited = self._walk(
+                    walker,
+                    start_date=datetime.date(2017, 5, 1),
+                    stop_date=datetime.date(2017, 5, 31),
+                )
+                self.assertEqual([directory_path for directory_path, ip in visited], [os.path.join(root, *leaves[1])])
+
+    def test_manifest_reused_until_directory_changes(self):
+        with tempfile.TemporaryDirectory() as dir:
+            root = os.path.join(dir, 'test_train')
+            self._make_tree(root, [('AAPL', 'c1', 'oasspread', 'grid5', '2017-01-01', '2017-04-01', '2017-04-30', '1', '2')])
+            old = time.time() - 60.0
+            for dirpath, dirnames, filenames in os.walk(root):
+                os.utime(dirpath, (old, old))
+            manifest_path = os.path.join(dir, 'manifest.json')
+            walker = WalkTestTrainOutputDirectories(root, '1', '2', manifest_path)
+            self.assertEqual(len(self._walk(walker)), 1)
+            with open(manifest_path) as f:
+                self.assertEqual(json.load(f)['directories']['AAPL'][1], ['c1'])
+            # a stale manifest entry is used as long as the mtime of its directory is unchanged
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            manifest['directories']['AAPL'][1] = []
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f)
+            self.assertEqual(len(self._walk(walker)), 0)
+            os.utime(os.path.join(root, 'AAPL'), (old + 1.0, old + 1.0))
+            self.assertEqual(len(self._walk(walker)), 1)
+
+    def test_partial_files_reported(self):
+        leaf = ('AAPL', 'c1', 'oasspread', 'grid5', '2017-01-01', '2017-04-01', '2017-04-30', '1', '2')
+        with tempfile.TemporaryDirectory() as dir:
+            root = os.path.join(dir, 'test_train')
+            self._make_tree(root, [leaf])
+            for name in ('signal.csv.partial', 'actions.csv'):
+                with open(os.path.join(root, *leaf, name), 'w') as f:
+                    f.write('a\n')
+            walker = WalkTestTrainOutputDirectories(root, '1', '2')
+            self.assertEqual(walker._report_partial_files(leaf), [os.path.join(root, *leaf, 'signal.csv.partial')])
+            self.assertEqual(len(self._walk(walker)), 1)  # the directory is still visited
 
 
 if __name__ == '__main__':
-    pdb
+    unittest.main()
+    if False:
+        pdb
@@ -162,6 +162,16 @@ def path_existing(s):
         raise argparse.ArgumentTypeError('%s is not a path to an existing file or dir' % s)
 
 
+def positive_float(s):
+    'convert s to a positive float or raise exception'
+    try:
+        value = float(s)
+        assert value > 0.0
+        return value
+    except:
+        raise argparse.ArgumentTypeError('%s is not a positive float' % s)
+
+
 def positive_int(s):
     'convert s to a positive integer or raise exception'
     try:
@@ -115,6 +115,12 @@ def _test_train_output_path(operational_environment):
         return operational_environment
 
 
+def _walk_manifest_path(dir_in):
+    'the manifest shared by the programs that walk the test_train output directories in dir_in'
+    # it is next to dir_in, not in it, so that it is not mistaken for an issuer directory
+    return os.path.normpath(dir_in) + '.walk-manifest.json'
+
+
 def analysis_accuracy(operational_environment, start_predictions, stop_predictions,
                       upstream_version, feature_version,
                       debug=False, executable='analysis_accuracy', test=False, trace=False):
@@ -145,11 +151,14 @@ def analysis_accuracy(operational_environment, start_predictions, stop_predictio
     result = {
         'command': command,
 
+        'dir_cache': os.path.join(dir_working, executable, 'cache'),  # shared by all invocations
         'dir_in': dir_in,
         'dir_out': dir_out,
 
         'in_secmaster': path.input(issuer=None, logical_name='security master'),
 
+        'walk_manifest': _walk_manifest_path(dir_in),
+
         'out_invocation': os.path.join(dir_out, 'invocation.csv'),
         'out_rmse_overall': os.path.join(dir_out, 'rmse_overall.csv'),
         'out_rmse_by_cusip': os.path.join(dir_out, 'rmse_by_cusip.csv'),
@@ -202,6 +211,8 @@ def analysis_experts(operational_environment, start_predictions, stop_prediction
 
         'in_secmaster': path.input(issuer=None, logical_name='security master'),
 
+        'walk_manifest': _walk_manifest_path(dir_in),
+
         'out_mean_weights': os.path.join(dir_out, 'mean_weights.csv'),
         'out_mean_weights_by_date': os.path.join(dir_out, 'mean_weights_by_date.csv'),
         'out_mean_weights_by_date_top_k': os.path.join(dir_out, 'mean_weights_by_date_top_k.csv'),
@@ -249,6 +260,8 @@ def analysis_importances(operational_environment, start_predictions, stop_predic
 
         'in_secmaster': path.input(issuer=None, logical_name='security master'),
 
+        'walk_manifest': _walk_manifest_path(dir_in),
+
         'out_mean_importance': os.path.join(dir_out, 'mean_importance.csv'),
         'out_mean_importance_by_date': os.path.join(dir_out, 'mean_importance_by_date.csv'),
         'out_log': os.path.join(dir_out, '0log.txt'),
@@ -2,16 +2,78 @@
 import abc
 import csv
 import datetime
+import itertools
+import numpy as np
+import os
 import pdb
 import sys
 
 # imports from directory seven
+from . import ColumnarCache
 from . import crazy_print_classifier
 from . import Event
 from . import make_event_attributes
 from . import logging
 
 
+def datetime_column_names_of(logical_name):
+    'return the names of the columns with the datetime of each row of the input file control.path[logical_name]'
+    return ('effectivedate', 'effectivetime') if logical_name == 'in_trace' else ('date',)
+
+
+def open_rows(control, path, datetime_column_names, start_date=None):
+    'return (file or None, iterator of Dict[column_name, str]) for the rows in the CSV file at path'
+    # if control.event_reader['columnar_cache'] is True, serve the rows from a columnar cache of the file
+    # if start_date is not None, skip the rows before that date; the file must be sorted by date
+    if control.event_reader.get('columnar_cache', False):
+        cache, err = ColumnarCache.open_or_build(path, datetime_column_names)
+        if err is None:
+            start = 0
+            if start_date is not None:
+                start = int(np.searchsorted(cache.datetimes, np.datetime64(start_date, 's'), side='left'))
+            return None, cache.iter_rows(start)
+        logging.warning('reading CSV file, as could not build columnar cache: %s' % err)
+    file = open(path)
+    if start_date is None:
+        return file, csv.DictReader(file)
+    field_names = next(csv.reader([file.readline()]))
+    offset = offset_of_first_row_on_or_after(
+        path,
+        data_start=file.tell(),
+        date_column_index=field_names.index(datetime_column_names[0]),
+        start_date=start_date,
+    )
+    file.seek(offset)
+    return file, csv.DictReader(file, fieldnames=field_names)
+
+
+def offset_of_first_row_on_or_after(path, data_start, date_column_index, start_date):
+    'return byte offset in the date-sorted CSV file of the first row with date >= start_date'
+    # binary search over byte offsets; each probe reads the first full line at or after the probe
+    def parse_date(line):
+        fields = next(csv.reader([line.decode('utf-8')]))
+        year, month, day = fields[date_column_index].split('-')
+        return datetime.date(int(year), int(month), int(day))
+
+    with open(path, 'rb') as f:
+        lo = data_start  # a line start; every line that starts before lo is before start_date
+        hi = os.fstat(f.fileno()).st_size  # every line that starts at or after hi is not before start_date
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(mid - 1)
+            f.readline()  # advance to the start of the first line at or after mid
+            line_start = f.tell()
+            if line_start >= hi:
+                hi = mid  # no line starts in [mid, hi)
+                continue
+            line = f.readline()
+            if parse_date(line) < start_date:
+                lo = line_start + len(line)
+            else:
+                hi = line_start
+    return lo
+
+
 class EventReader(object, metaclass=abc.ABCMeta):
     def __init__(self, control, event_source):
         self._control = control
@@ -58,14 +120,22 @@ class EventReaderDate(EventReader, metaclass=abc.ABCMeta):
         # prepare to test that the file is in date order
         self._prior_event_date = datetime.date(datetime.MINYEAR, 1, 1)
 
-        # prepare to read the CSV file
-        self._file = open(path)
-        self._dict_reader = csv.DictReader(self._file)
+        # prepare to read the CSV file, starting with the first event on control.event_reader['start_date']
+        self._file, self._dict_reader = open_rows(
+            control,
+            path,
+            (date_column_name,),
+            start_date=control.event_reader.get('start_date', None),
+        )
 
         self._records_read = 0
 
     def close(self):
-        self._file.close()
+        'close the file and drop the rows, which may be served from the memory maps of a columnar cache'
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._dict_reader = iter(())
 
     def __next__(self):
         'return (Event, err) or raise StopIteration'
@@ -374,21 +444,32 @@ class Trace(EventReader):
         self._control_feature_version_major = int(splits[0])
         self._control_feature_version_minor = '' if len(splits) == 1 else splits[1:]
 
-        path = control.path['in_' + self._event_source]
-        self._file = open(path)
-        self._dict_reader = csv.DictReader(self._file)
-        self._prior_record_datetime = datetime.datetime(datetime.MINYEAR, 1, 1)
-        self._records_read = 0
-
         self._crazy_print_classifier = crazy_print_classifier.CrazyPrintClassifier(
             control.event_reader['trace'],
         )
 
+        path = control.path['in_' + self._event_source]
+        datetime_column_names = datetime_column_names_of('in_' + self._event_source)
+        start_date = control.event_reader.get('start_date', None)
+        if start_date is not None and self._control_feature_version_major >= 2:
+            # the crazy print classifier must see every print, so pass it the rows before start_date
+            # without creating events for them
+            self._file, rows = open_rows(control, path, datetime_column_names)
+            self._dict_reader = self._skip_rows_before(rows, start_date)
+        else:
+            self._file, self._dict_reader = open_rows(control, path, datetime_column_names, start_date)
+        self._prior_record_datetime = datetime.datetime(datetime.MINYEAR, 1, 1)
+        self._records_read = 0
+
     def __iter__(self):
         return self
 
     def close(self):
-        self._file.close()
+        'close the file and drop the rows, which may be served from the memory maps of a columnar cache'
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._dict_reader = iter(())
 
     def __next__(self):
         'return (Event, err) or raise StopIteration'
@@ -439,6 +520,19 @@ class Trace(EventReader):
     def records_read(self):
         return self._records_read
 
+    def _skip_rows_before(self, rows, start_date):
+        'return iterator starting at the first row on or after start_date, classifying the skipped prints'
+        start = start_date.isoformat()
+        for row in rows:
+            if row['effectivedate'] >= start:
+                return itertools.chain([row], rows)
+            try:
+                oasspread = float(row['oasspread'])
+            except ValueError:
+                continue  # __next__ would not have classified this print
+            self._crazy_print_classifier.is_crazy(row['cusip'], oasspread)
+        return iter(())
+
 
 if __name__ == '__main__':
     pdb
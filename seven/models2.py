@@ -6,6 +6,7 @@ You may not use this file except in compliance with a License.
 '''
 
 import abc
+import math
 import numbers
 import numpy as np
 import pandas as pd
@@ -69,6 +70,10 @@ class Model(timeseries.Model, metaclass=abc.ABCMeta):
         self.importances = None
         self.feature_names = None   # list of names used, in same order as importances
 
+    def warm_start_from(self, previous, tree_replacement_fraction):
+        'start the next fit from previous, a fitted model with the same model spec and feature names'
+        pass  # by default, fit from scratch
+
     # helper methods for subclasses to use
 
     def _fit(self, training_features, training_targets, trace=False):
@@ -99,6 +104,33 @@ class Model(timeseries.Model, metaclass=abc.ABCMeta):
             print('exception in _fit:', e)
             raise ExceptionFit(e)
 
+    def _fit_array(self, feature_names, x, y):
+        'common fitting procedure for scikit-learn models given a 2D np.array of features'
+        # x has one column for each feature name; y has one target value for each row of x
+        assert len(feature_names) == x.shape[1]
+        assert len(x) == len(y)
+
+        # select the number of trades back
+        n_trades_back = self.model_spec.n_trades_back
+        relevant_x = x[-n_trades_back:]
+        relevant_y = y[-n_trades_back:]
+        if len(relevant_x) == 0:
+            raise ExceptionFit('no training data after looking back n trades (%d)' % n_trades_back)
+        if np.isnan(relevant_x).any():
+            raise timeseries.ExceptionFit('nan in training features')
+        if np.isnan(relevant_y).any():
+            raise timeseries.ExceptionFit('nan in training targets')
+
+        self.feature_names = feature_names
+        try:
+            self.model.fit(
+                self._transform_columns(self.model_spec.transform_x, feature_names, relevant_x),
+                relevant_y,
+            )
+        except Exception as e:
+            print('exception in _fit_array:', e)
+            raise ExceptionFit(e)
+
     def _make_featurenames_x(self, feature_vectors, trace=False):
         'return list of feature_names and np.array 2D with one column for each possibly-transformed feature'
         'return np.array 2D containing the features possibly transformed'
@@ -159,6 +191,25 @@ class Model(timeseries.Model, metaclass=abc.ABCMeta):
             pdb.set_trace()
         return result
 
+    def _transform_columns(self, transformation, feature_names, x):
+        'return x or a transformed copy of x; the same transformation as _transform_raw_value'
+        if transformation is None:
+            return x
+        size_columns = [i for i, feature_name in enumerate(feature_names) if feature_name.endswith('_size')]
+        if len(size_columns) == 0:
+            return x
+        result = np.array(x)
+        if transformation == 'log':
+            assert (result[:, size_columns] > 0.0).all()
+            result[:, size_columns] = np.log(result[:, size_columns])
+        elif transformation == 'log1p':
+            assert (result[:, size_columns] + 1 > 0.0).all()
+            result[:, size_columns] = np.log1p(result[:, size_columns])
+        else:
+            logging.critical('unexpected transformation: %s' % transformation)
+            sys.exit(1)
+        return result
+
     def _transform_raw_value(self, transformation, feature_name, raw_value):
         if feature_name.endswith('_size'):
             if transformation is None:
@@ -195,6 +246,11 @@ class ModelNaive(Model):
         self.predictions = [training_targets[-1]]  # predictions must be a list
         self.importances = {}   # no features, no importances
 
+    def fit_array(self, feature_names, x, y):
+        'predict the last trade of the type'
+        self.predictions = [float(y[-1])]  # predictions must be a list
+        self.importances = {}   # no features, no importances
+
     def predict(self, query_features):
         'predict the most recent historic trade for the trade_type'
         return self.predictions
@@ -212,7 +268,7 @@ class ModelElasticNet(Model):
             fit_intercept=True,
             normalize=False,
             max_iter=1000,
-            copy_X=False,
+            copy_X=True,  # fit_array() may be passed read-only views of a TrainingMatrix
             tol=0.0001,
             warm_start=False,
             selection='cyclic',
@@ -221,6 +277,19 @@ class ModelElasticNet(Model):
     def fit(self, training_features, training_targets):
         'set self.fitted_model'
         self._fit(training_features, training_targets, trace=False)
+        self._set_importances()
+
+    def fit_array(self, feature_names, x, y):
+        'set self.fitted_model from a 2D np.array of features'
+        self._fit_array(feature_names, x, y)
+        self._set_importances()
+
+    def warm_start_from(self, previous, tree_replacement_fraction):
+        'start the coordinate descent from the coefficients of the previous model'
+        self.model.set_params(warm_start=True)
+        self.model.coef_ = previous.model.coef_.copy()
+
+    def _set_importances(self):
         self.importances = {}
         for i, coef in enumerate(self.model.coef_):
             self.importances[self.feature_names[i]] = coef
@@ -254,6 +323,23 @@ class ModelRandomForests(Model):
 
     def fit(self, training_features, training_targets):
         self._fit(training_features, training_targets, trace=False)
+        self._set_importances()
+
+    def fit_array(self, feature_names, x, y):
+        self._fit_array(feature_names, x, y)
+        self._set_importances()
+
+    def warm_start_from(self, previous, tree_replacement_fraction):
+        'keep the most recently grown trees of the previous model; the next fit grows the others'
+        # scikit-learn appends the trees grown by a warm-started fit, so the oldest trees are first
+        estimators = previous.model.estimators_
+        n_replaced = int(math.ceil(tree_replacement_fraction * len(estimators)))
+        if n_replaced >= len(estimators):
+            return  # fit from scratch
+        self.model.set_params(warm_start=True)
+        self.model.estimators_ = list(estimators[n_replaced:])
+
+    def _set_importances(self):
         self.importances = {}
         for i, importance in enumerate(self.model.feature_importances_):
             self.importances[self.feature_names[i]] = importance
@@ -14,6 +14,14 @@ lap_count = collections.Counter()  # type: Dict[str, int]
 last_lap_end_time = datetime.datetime.now()
 
 
+def reset() -> None:
+    'forget every lap, so that another run in the same process starts from zero'
+    global last_lap_end_time
+    accumulated_lap_time.clear()
+    lap_count.clear()
+    last_lap_end_time = datetime.datetime.now()
+
+
 def end_lap(lap_name: str) -> None:
     global last_lap_end_time
     now = datetime.datetime.now()
@@ -18,12 +18,27 @@ defined by the constructor.
 
 Messags on RabbitMQ queues have additional fields called
 headers. Those fields are invisible to this code.
+
+TracePrint messages, which are most of the messages, can instead be encoded
+with a compact binary codec. The binary body is the character "#" followed by
+the base64 encoding of
+- a byte with the codec version (now 1)
+- the datetime as an int64 number of microseconds since 0001-01-01T00:00:00
+- the oasspread and cancellation_probability as float64 values
+- the utf-8 lengths of the source, identifier, cusip, issuepriceid, trade_type,
+  and reclassified_trade_type as bytes, followed by those utf-8 strings
+from_string() accepts either encoding. A producer that writes binary bodies
+announces it by first sending SetVersion(what='message_codec', version='binary.1').
+JSON remains the default codec.
 '''
 import abc
+import base64
 import copy
 import datetime
 import json
 import pdb
+import struct
+import sys
 import typing
 import unittest
 
@@ -59,6 +74,44 @@ def str_to_datetime(s: str):
         )
 
 
+#####################################################
+# binary codec for TracePrint
+#####################################################
+codec_what = 'message_codec'  # the what field of the SetVersion message that announces the codec
+codecs = ('json', 'binary.1')
+binary_prefix = '#'
+binary_version = 1
+_binary_header = struct.Struct('<Bqdd6B')
+_datetime_origin = datetime.datetime(1, 1, 1)
+_one_microsecond = datetime.timedelta(microseconds=1)
+_interned = {}  # key = bytes, value = interned str
+
+
+def _intern(b: bytes):
+    'return the interned str for the utf-8 bytes b'
+    result = _interned.get(b)
+    if result is None:
+        result = sys.intern(b.decode('utf-8'))
+        _interned[b] = result
+    return result
+
+
+def to_string(message, codec: str='json'):
+    'return str encoding the message with the codec, falling back to json if the codec does not apply'
+    assert codec in codecs, 'codec %s is not one of %s' % (codec, codecs)
+    if codec == 'binary.1' and isinstance(message, TracePrint):
+        result = message.as_binary_str()
+        if result is not None:
+            return result
+    return str(message)
+
+
+def make_set_codec(source: str, identifier: str, codec: str):
+    'return the SetVersion message that announces the codec of the messages that follow it'
+    assert codec in codecs, 'codec %s is not one of %s' % (codec, codecs)
+    return SetVersion(source, identifier, codec_what, codec)
+
+
 #####################################################
 # base abstract class
 #####################################################
@@ -259,6 +312,55 @@ class TracePrint(Message):
             })
         return result
 
+    def as_binary_str(self):
+        'return str with the binary encoding or None if a field cannot be binary encoded'
+        strs = (
+            self.source,
+            self.identifier,
+            self.cusip,
+            self.issuepriceid,
+            self.trade_type,
+            self.reclassified_trade_type,
+        )
+        if not all(isinstance(x, str) for x in strs):
+            return None
+        encoded = [x.encode('utf-8') for x in strs]
+        if any(len(x) > 255 for x in encoded):
+            return None
+        header = _binary_header.pack(
+            binary_version,
+            (self.datetime - _datetime_origin) // _one_microsecond,
+            self.oasspread,
+            self.cancellation_probability,
+            *[len(x) for x in encoded]
+        )
+        return binary_prefix + base64.b64encode(header + b''.join(encoded)).decode('ascii')
+
+    @staticmethod
+    def from_binary_str(s: str):
+        'return TracePrint from the str created by as_binary_str()'
+        b = base64.b64decode(s[len(binary_prefix):])
+        fields = _binary_header.unpack_from(b)
+        version, microseconds, oasspread, cancellation_probability = fields[:4]
+        assert version == binary_version, 'binary codec version %s is not known' % version
+        strs = []
+        start = _binary_header.size
+        for length in fields[4:]:
+            strs.append(b[start:start + length])
+            start += length
+        source, identifier, cusip, issuepriceid, trade_type, reclassified_trade_type = strs
+        return TracePrint(
+            _intern(source),
+            identifier.decode('utf-8'),
+            _intern(cusip),
+            issuepriceid.decode('utf-8'),
+            _datetime_origin + datetime.timedelta(microseconds=microseconds),
+            oasspread,
+            _intern(trade_type),
+            _intern(reclassified_trade_type),
+            cancellation_probability,
+            )
+
     @staticmethod
     def from_dict(d: dict):
         return TracePrint(
@@ -360,7 +462,9 @@ class OutputStop(Message):
 ###################################################################
 def from_string(s: str):
     'return an appropriate subclass of Message'
-    # s is a json-encoded string
+    # s is a json-encoded string or a binary-encoded TracePrint
+    if s.startswith(binary_prefix):
+        return TracePrint.from_binary_str(s)
     obj = json.loads(s)
     assert isinstance(obj, dict)
     message_type = obj['message_type']
@@ -498,6 +602,34 @@ class Test(unittest.TestCase):
         self.assertEqual(m2.reclassified_trade_type, reclassified_trade_type)
         self.assertEqual(m2.cancellation_probability, cancellation_probability)
 
+    def test_TracePrint_binary(self):
+        m = TracePrint(
+            source='trace_issuer.csv',
+            identifier='123',
+            cusip='037833AJ9',
+            issuepriceid='123',
+            datetime=datetime.datetime(2017, 1, 3, 10, 1, 2, 345678),
+            oasspread=-1.25,
+            trade_type='D',
+            reclassified_trade_type='B',
+            cancellation_probability=0.0,
+            )
+        s = to_string(m, codec='binary.1')
+        self.assertTrue(s.startswith(binary_prefix))
+        self.assertLess(len(s), len(str(m)))
+        m2 = from_string(s)
+        self.assertTrue(isinstance(m2, TracePrint))
+        self.assertEqual(m2.as_dict(), m.as_dict())
+
+        # fields that are not strs are encoded with json
+        m.identifier = 123
+        m2 = from_string(to_string(m, codec='binary.1'))
+        self.assertEqual(m2.identifier, 123)
+
+        set_codec = from_string(str(make_set_codec('unittest', '1', 'binary.1')))
+        self.assertEqual(set_codec.what, codec_what)
+        self.assertEqual(set_codec.version, 'binary.1')
+
     def test_TracePrintCancel(self):
         vp = make_verbose_print(False)
         source = 'unittest'
@@ -1,7 +1,16 @@
 'fascade to enable testing without starting RabbitMQ'
-# The classes FileBlockChannel and FileBlockingConnection are stubs in the current implementation.
-# The classes are intended to fully emulate a subset of the RabbitMQ system, but they are complex
-# and haven't yet been written, so they are stubs at present.
+# The classes FileBlockingChannel and FileBlockingConnection emulate a subset of the RabbitMQ system
+# using a local persistent broker (class FileBroker) whose state is kept in files in a directory.
+# The files are flushed but not synced to disk: the state survives a restart of the processes that
+# use it, but a crash of the operating system may lose the most recent messages and acknowledgements.
+# - exchanges (direct, fanout, topic) route messages by routing key to the bound queues
+# - each queue (class FileQueue) is an append-only log of segment files with an offset index
+# - consumers receive messages through basic_consume callbacks or basic_get
+# - basic_ack and basic_nack update the committed offset of a queue, which is persisted, so that a
+#   restarted consumer receives the unacknowledged messages again
+# - basic_qos(prefetch_count=n) limits the unacknowledged messages to n and reads them in batches
+# - the queue can be replayed from any offset
+# Methods that are not implemented raise an exception.
 #
 # The classes PrimitiveChannel and PrimitiveConnection are implemented. They provide just barely
 # enough functionality to get started on development and testing. These classes DO NOT fully
@@ -19,11 +28,22 @@
 #   from the file.
 # - All transactions are blocking (nothing is asynchronous)
 # - Parameter values for method calls are restricted
+#
+# The class AsyncChannel adapts a PrimitiveBlockingChannel to asyncio. Consumers poll the queue files
+# with asyncio.sleep() between empty reads, so that one event loop can serve many queues.
 
 import abc
+import asyncio
+import bisect
+import collections
 import copy
+import json
+import os
 import pika
 import pdb
+import shutil
+import struct
+import tempfile
 import time
 import typing
 import unittest
@@ -34,12 +54,16 @@ import shared_message
 class PrimitiveBlockingChannel:
     'provide a subset of the functionality of a BlockChannel'
     # ref: http://pika.readthedocs.io/en/latest/modules/adapters/blocking.html
+    # Published messages are buffered by the producer files; call flush() to make them visible to
+    # consumers in other processes before the channel is closed.
     def __init__(self, path_for_input, paths_for_output):
         self._path_for_input = path_for_input
         self._paths_for_output = paths_for_output
-        
-        self._consumer_files = {}  # key = path, value = open file
+
+        self._consumer_files = {}  # key = queue, value = open file
+        self._partial_lines = {}  # key = queue, value = str without a final \n
         self._producer_files = {}  # key = path, value = open file
+        self._routes = {}  # key = (exchange, routing_key), value = List[open file]
 
     def __str__(self):
         return 'PrimitiveBlockingChannel(|consumer_files|=%d, |producer_files|=%d)' % (
@@ -58,7 +82,7 @@ class PrimitiveBlockingChannel:
             f.close()
         for path, f in self._producer_files.items():
             f.close()
-        
+
     def consume(self,
                 queue: str,
                 no_ack=False,
@@ -67,15 +91,50 @@ class PrimitiveBlockingChannel:
                 inactivity_timeout=None,
                 ):
         'iterate over message in the file representing the queue, raising StopIteration at end of file'
-        if queue not in self._consumer_files:
-            path = self._path_for_input(queue)
-            f = open(path, 'r')
-            self._consumer_files[queue] = f
-        line = self._consumer_files[queue].readline()
+        line = self._consumer_file(queue).readline()
         if len(line) == 0:
             raise StopIteration  # the file is at end of file
         return line[:-1]  # remove final \n
 
+    def consume_batch(self,
+                      queue: str,
+                      max_messages: int,
+                      timeout: float=None,
+                      ) -> typing.List[str]:
+        'return up to max_messages messages; at end of file, wait up to timeout seconds for more'
+        # return an empty list if there are no messages
+        f = self._consumer_file(queue)
+        result = []
+        deadline = None if timeout is None else time.time() + timeout
+        while len(result) < max_messages:
+            line = self._partial_lines.pop(queue, '') + f.readline()
+            if len(line) > 0 and line[-1] == '\n':
+                result.append(line[:-1])  # remove final \n
+                continue
+            if len(line) > 0:
+                self._partial_lines[queue] = line  # the producer has not yet written the rest of the line
+            if len(result) > 0 or deadline is None or time.time() >= deadline:
+                break
+            time.sleep(min(0.1, max(0.0, deadline - time.time())))
+        return result
+
+    def consume_generator(self,
+                          queue: str,
+                          batch_size: int=1000,
+                          inactivity_timeout: float=None,
+                          ):
+        'yield each message in the queue, ending when no message arrives for inactivity_timeout seconds'
+        while True:
+            messages = self.consume_batch(queue, batch_size, timeout=inactivity_timeout)
+            if len(messages) == 0:
+                return
+            yield from messages
+
+    def flush(self):
+        'write the buffered published messages'
+        for f in self._producer_files.values():
+            f.flush()
+
     def publish(self,
                 exchange: str,
                 routing_key: str,
@@ -91,15 +150,39 @@ class PrimitiveBlockingChannel:
         assert mandatory is False
         assert immediate is False
 
-        paths = self._paths_for_output(exchange, routing_key)
-        for path in paths:
-            if path not in self._producer_files:
-                f = open(path, 'w')
-                self._producer_files[path] = f
-            f = self._producer_files[path]
-            f.write(body)
-            f.write('\n')
-                      
+        line = body + '\n'
+        for f in self._route(exchange, routing_key):
+            f.write(line)
+
+    def publish_batch(self,
+                      exchange: str,
+                      routing_key: str,
+                      bodies: typing.Iterable[str],
+                      ):
+        'append each message to file, with one write per file'
+        text = ''.join([body + '\n' for body in bodies])
+        for f in self._route(exchange, routing_key):
+            f.write(text)
+
+    def _consumer_file(self, queue):
+        if queue not in self._consumer_files:
+            path = self._path_for_input(queue)
+            f = open(path, 'r')
+            self._consumer_files[queue] = f
+        return self._consumer_files[queue]
+
+    def _route(self, exchange, routing_key):
+        'return List[open file] for the exchange and routing_key'
+        key = (exchange, routing_key)
+        if key not in self._routes:
+            files = []
+            for path in self._paths_for_output(exchange, routing_key):
+                if path not in self._producer_files:
+                    self._producer_files[path] = open(path, 'w', buffering=1024 * 1024)
+                files.append(self._producer_files[path])
+            self._routes[key] = files
+        return self._routes[key]
+
 
 class PrimitiveBlockingConnection:
     def __init__(self, path_for_input, paths_for_output):
@@ -136,16 +219,379 @@ class PrimitiveBlockingConnection:
                 )
 
 
+class AsyncChannel:
+    'adapt a PrimitiveBlockingChannel to asyncio'
+    def __init__(self, channel, batch_size=1000, poll_interval=0.1):
+        self._channel = channel
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+
+    def __str__(self):
+        return 'AsyncChannel(%s)' % self._channel
+
+    def close(self):
+        self._channel.close()
+
+    async def consume(self, queue: str, inactivity_timeout: float=None):
+        'yield each message; stop when no message arrives for inactivity_timeout seconds (None ==> at EOF)'
+        loop = asyncio.get_event_loop()
+        last_message_time = loop.time()
+        while True:
+            messages = self._channel.consume_batch(queue, self._batch_size)
+            if len(messages) > 0:
+                for message in messages:
+                    yield message
+                last_message_time = loop.time()
+                await asyncio.sleep(0)  # let the other tasks run
+                continue
+            if inactivity_timeout is None or loop.time() - last_message_time >= inactivity_timeout:
+                return
+            await asyncio.sleep(self._poll_interval)
+
+    def flush(self):
+        self._channel.flush()
+
+    async def publish(self, exchange: str, routing_key: str, body: str):
+        self._channel.publish(exchange, routing_key, body)
+
+    async def publish_batch(self, exchange: str, routing_key: str, bodies: typing.Iterable[str]):
+        self._channel.publish_batch(exchange, routing_key, bodies)
+
+
+class FileQueue:
+    'persistent append-only log of the messages in one queue, stored in segment files with offset indices'
+    # Layout of the directory for a queue
+    #   {base_offset:020d}.log: the messages in the segment, each a line of utf-8 text
+    #   {base_offset:020d}.index: for each message in the segment, its byte position in the .log file as
+    #                             a little-endian int64
+    #   offsets.json: the committed offset, which is the offset of the oldest unacknowledged message
+    # A message is written to the .log file before its position is written to the .index file, so that
+    # a reader sees only complete messages.
+    # Any number of processes may read a queue, but only one process should append to it.
+    def __init__(self, directory, segment_max_messages=100000):
+        self._directory = directory
+        self._segment_max_messages = segment_max_messages
+        os.makedirs(directory, exist_ok=True)
+
+        self._segment_bases = self._read_segment_bases()
+        if len(self._segment_bases) == 0:
+            self._create_segment(0)
+        self._append_files = None  # (log file, index file) for the last segment, opened lazily
+        self._read_files = {}  # key = segment base, value = (log file, index file)
+
+        self.committed_offset = self._read_committed_offset()
+        self.next_delivery_offset = self.committed_offset
+        self._pending = set()  # offsets delivered but neither acknowledged nor rejected
+        self._redeliveries = collections.deque()  # offsets rejected with requeue=True
+
+    def __str__(self):
+        return 'FileQueue(%s, committed_offset=%d, end_offset=%d)' % (
+            self._directory,
+            self.committed_offset,
+            self.end_offset(),
+        )
+
+    def append(self, body: str) -> int:
+        'append the message and return its offset'
+        encoded = body.encode('utf-8')
+        assert b'\n' not in encoded
+        base = self._segment_bases[-1]
+        if self._n_messages(base) >= self._segment_max_messages:
+            self._close_append_files()
+            base = self.end_offset()
+            self._create_segment(base)
+        if self._append_files is None:
+            self._append_files = (
+                open(self._path(base, 'log'), 'ab'),
+                open(self._path(base, 'index'), 'ab'),
+            )
+        log_file, index_file = self._append_files
+        position = log_file.tell()
+        log_file.write(encoded)
+        log_file.write(b'\n')
+        log_file.flush()
+        index_file.write(struct.pack('<q', position))
+        index_file.flush()
+        return base + self._n_messages(base) - 1
+
+    def close(self):
+        self._close_append_files()
+        for log_file, index_file in self._read_files.values():
+            log_file.close()
+            index_file.close()
+        self._read_files = {}
+
+    def end_offset(self) -> int:
+        'return offset that the next appended message will have'
+        self._segment_bases = self._read_segment_bases()  # another process may have added segments
+        base = self._segment_bases[-1]
+        return base + self._n_messages(base)
+
+    def read(self, offset: int, max_messages: int) -> typing.List[typing.Tuple[int, str]]:
+        'return up to max_messages (offset, body) pairs, starting at the offset'
+        result = []
+        while len(result) < max_messages:
+            i = bisect.bisect_right(self._segment_bases, offset) - 1
+            if i < 0:
+                break  # the offset precedes the retained messages
+            base = self._segment_bases[i]
+            n_available = self._n_messages(base) - (offset - base)
+            if n_available <= 0:
+                # the segments are contiguous, so the offset is at the end of the last known segment
+                n_segments = len(self._segment_bases)
+                self._segment_bases = self._read_segment_bases()  # another process may have added one
+                if len(self._segment_bases) == n_segments:
+                    break  # no more messages
+                continue
+            n = min(n_available, max_messages - len(result))
+            log_file, index_file = self._open_for_read(base)
+            index_file.seek((offset - base) * 8)
+            log_file.seek(struct.unpack('<q', index_file.read(8))[0])
+            for k in range(n):
+                result.append((offset + k, log_file.readline()[:-1].decode('utf-8')))
+            offset += n
+        return result
+
+    def take(self, max_messages: int) -> typing.List[typing.Tuple[int, str, bool]]:
+        'return up to max_messages (offset, body, redelivered) and mark them as pending'
+        result = []
+        while len(self._redeliveries) > 0 and len(result) < max_messages:
+            offset = self._redeliveries.popleft()
+            for offset, body in self.read(offset, 1):
+                result.append((offset, body, True))
+        if len(result) < max_messages:
+            for offset, body in self.read(self.next_delivery_offset, max_messages - len(result)):
+                result.append((offset, body, False))
+                self.next_delivery_offset = offset + 1
+        for offset, body, redelivered in result:
+            self._pending.add(offset)
+        return result
+
+    def acknowledge(self, offsets):
+        'mark the delivered messages as processed and persist the committed offset'
+        for offset in offsets:
+            self._pending.discard(offset)
+        self._commit()
+
+    def reject(self, offsets, requeue: bool):
+        'mark the delivered messages as not processed'
+        for offset in sorted(offsets):
+            self._pending.discard(offset)
+            if requeue:
+                self._redeliveries.append(offset)
+        self._commit()
+
+    def seek(self, offset: int):
+        'deliver messages starting at the offset; previously delivered messages are forgotten'
+        self.next_delivery_offset = offset
+        self._pending = set()
+        self._redeliveries = collections.deque()
+        self._commit()
+
+    def _close_append_files(self):
+        if self._append_files is not None:
+            for f in self._append_files:
+                f.close()
+            self._append_files = None
+
+    def _commit(self):
+        committed_offset = min([self.next_delivery_offset] + list(self._pending) + list(self._redeliveries))
+        if committed_offset != self.committed_offset:
+            self.committed_offset = committed_offset
+            path = os.path.join(self._directory, 'offsets.json')
+            with open(path + '.temp', 'w') as f:
+                json.dump({'committed_offset': committed_offset}, f)
+            os.replace(path + '.temp', path)
+
+    def _create_segment(self, base):
+        for extension in ('log', 'index'):
+            open(self._path(base, extension), 'ab').close()
+        self._segment_bases = self._read_segment_bases()
+
+    def _n_messages(self, base):
+        return os.path.getsize(self._path(base, 'index')) // 8
+
+    def _open_for_read(self, base):
+        if base not in self._read_files:
+            self._read_files[base] = (
+                open(self._path(base, 'log'), 'rb'),
+                open(self._path(base, 'index'), 'rb'),
+            )
+        return self._read_files[base]
+
+    def _path(self, base, extension):
+        return os.path.join(self._directory, '%020d.%s' % (base, extension))
+
+    def _read_committed_offset(self):
+        try:
+            with open(os.path.join(self._directory, 'offsets.json')) as f:
+                return json.load(f)['committed_offset']
+        except FileNotFoundError:
+            return self._segment_bases[0]
+
+    def _read_segment_bases(self):
+        return sorted(
+            int(name[:-len('.log')])
+            for name in os.listdir(self._directory)
+            if name.endswith('.log')
+        )
+
+
+class FileBroker:
+    'the exchanges, bindings, and queues of a broker whose state is kept in a directory'
+    # Layout of the directory
+    #   exchanges.json: Dict[exchange, {'type': exchange_type, 'bindings': List[[queue, routing_key]]}]
+    #   queues/{queue}/: the FileQueue for each queue
+    # The exchange named '' is the default exchange. It routes to the queue named by the routing key.
+    def __init__(self, directory, segment_max_messages=100000):
+        self._directory = directory
+        self._segment_max_messages = segment_max_messages
+        os.makedirs(os.path.join(directory, 'queues'), exist_ok=True)
+        self._exchanges = self._read_exchanges()
+        self._queues = {}  # key = queue name, value = FileQueue
+        self._routes = {}  # key = (exchange, routing_key), value = List[queue name]
+
+    def __str__(self):
+        return 'FileBroker(%s, |exchanges|=%d)' % (self._directory, len(self._exchanges))
+
+    def bind(self, queue, exchange, routing_key):
+        self.declare_queue(queue)
+        binding = [queue, routing_key]
+        if binding not in self._exchanges[exchange]['bindings']:
+            self._exchanges[exchange]['bindings'].append(binding)
+            self._write_exchanges()
+
+    def close(self):
+        for queue in self._queues.values():
+            queue.close()
+
+    def declare_exchange(self, exchange, exchange_type):
+        assert exchange_type in ('direct', 'fanout', 'topic')
+        if exchange in self._exchanges:
+            assert self._exchanges[exchange]['type'] == exchange_type
+        else:
+            self._exchanges[exchange] = {'type': exchange_type, 'bindings': []}
+            self._write_exchanges()
+
+    def declare_queue(self, queue) -> FileQueue:
+        if queue not in self._queues:
+            self._queues[queue] = FileQueue(
+                os.path.join(self._directory, 'queues', queue),
+                segment_max_messages=self._segment_max_messages,
+            )
+        return self._queues[queue]
+
+    def delete_exchange(self, exchange):
+        del self._exchanges[exchange]
+        self._write_exchanges()
+
+    def delete_queue(self, queue):
+        if queue in self._queues:
+            self._queues.pop(queue).close()
+        shutil.rmtree(os.path.join(self._directory, 'queues', queue), ignore_errors=True)
+        for exchange in self._exchanges.values():
+            exchange['bindings'] = [binding for binding in exchange['bindings'] if binding[0] != queue]
+        self._write_exchanges()
+
+    def has_exchange(self, exchange):
+        return exchange == '' or exchange in self._exchanges
+
+    def has_queue(self, queue):
+        return queue in self._queues or os.path.isdir(os.path.join(self._directory, 'queues', queue))
+
+    def publish(self, exchange, routing_key, body) -> int:
+        'append the message to each queue that the exchange routes it to; return number of queues'
+        queues = self.route(exchange, routing_key)
+        for queue in queues:
+            self.declare_queue(queue).append(body)
+        return len(queues)
+
+    def route(self, exchange, routing_key) -> typing.List[str]:
+        'return names of the queues to which the exchange routes the routing key'
+        key = (exchange, routing_key)
+        if key not in self._routes:
+            if exchange == '':
+                self._routes[key] = [routing_key]
+            else:
+                exchange_type = self._exchanges[exchange]['type']
+                self._routes[key] = [
+                    queue
+                    for queue, binding_key in self._exchanges[exchange]['bindings']
+                    if (exchange_type == 'fanout' or
+                        (exchange_type == 'direct' and binding_key == routing_key) or
+                        (exchange_type == 'topic' and topic_matches(binding_key, routing_key)))
+                ]
+        return self._routes[key]
+
+    def unbind(self, queue, exchange, routing_key):
+        self._exchanges[exchange]['bindings'].remove([queue, routing_key])
+        self._write_exchanges()
+
+    def _read_exchanges(self):
+        try:
+            with open(os.path.join(self._directory, 'exchanges.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_exchanges(self):
+        self._routes = {}  # the routes may have changed
+        path = os.path.join(self._directory, 'exchanges.json')
+        with open(path + '.temp', 'w') as f:
+            json.dump(self._exchanges, f, indent=1, sort_keys=True)
+        os.replace(path + '.temp', path)
+
+
+def topic_matches(binding_key: str, routing_key: str) -> bool:
+    'return True iff the routing key matches the binding key of a topic exchange'
+    # in the binding key, * matches exactly one word and # matches zero or more words
+    def matches(binding_words, routing_words):
+        if len(binding_words) == 0:
+            return len(routing_words) == 0
+        if binding_words[0] == '#':
+            return any(
+                matches(binding_words[1:], routing_words[i:])
+                for i in range(len(routing_words) + 1)
+            )
+        if len(routing_words) == 0:
+            return False
+        if binding_words[0] == '*' or binding_words[0] == routing_words[0]:
+            return matches(binding_words[1:], routing_words[1:])
+        return False
+
+    return matches(binding_key.split('.'), routing_key.split('.'))
+
+
 class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
     'emulate RabbitMQ blocking connections using the file system'
     # ref: http://pika.readthedocs.io/en/0.11.0/modules/channel.html
+    # Messages are held in the FileBroker of the connection.
+    # Delivery is at least once: a message that is not acknowledged before the channel is closed
+    # is delivered again to the next consumer of its queue.
+    # To replay a queue from an offset, supply arguments={'x-stream-offset': offset} to basic_consume.
     def __init__(self, connection, channel_number, on_open_callback):
         'create new channel (the primary means of interacting with RabbitMQ)'
         # create instances by calling FileBlockingConnection.channel()
         assert on_open_callback is None  # not yet implemented (sorry)
-        self._connection = connections
+        self._connection = connection
         self._channel_number = channel_number
         self._on_open_callback = on_open_callback
+        self._broker = connection._broker
+
+        self._consumers = collections.OrderedDict()  # key = consumer_tag, value = (queue, callback, no_ack)
+        self._last_consumer_number = 0
+        self._last_delivery_tag = 0
+        self._unacked = collections.OrderedDict()  # key = delivery_tag, value = (queue, offset)
+        self._prefetch_count = 0  # 0 means no limit
+        self._stop_consuming = False
+        self._is_open = True
+
+    def __repr__(self):
+        return 'FileBlockingChannel(channel_number=%d, |consumers|=%d, |unacked|=%d)' % (
+            self._channel_number,
+            len(self._consumers),
+            len(self._unacked),
+        )
 
     def add_on_cancel_callback(self, callbacke):
         'specify callback function called with basic_cancel sent by server'
@@ -169,11 +615,12 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
         # parameters
         #  delivery_tag: assigned by the server when message was delivered (an int or long)
         #  multiple: if True, the delivery tag is treated as an up-to-and-including value
-        pass
+        for queue, offsets in self._settle(delivery_tag, multiple).items():
+            self._broker.declare_queue(queue).acknowledge(offsets)
 
     def basic_cancel(self, callback=None, consumer_tag: str='', nowait=False):
         'tell server to not send any more message to a consumer'
-        raise NotImplemented()
+        del self._consumers[consumer_tag]
 
     def basic_consume(self,
                       consumer_callback,
@@ -183,33 +630,55 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
                       consumer_tag: str=None,
                       arguments=None,
                       ) -> str:
-        'specify callback function called for each message on specified queue'
-        # TODO: implement me
-        raise NotImplemented()
-        
-    def basid_get(self,
-                  callback,
+        'specify callback function called for each message on specified queue; return the consumer tag'
+        # the callback is called as consumer_callback(channel, method, properties, body)
+        assert self._broker.has_queue(queue)
+        if consumer_tag is None:
+            self._last_consumer_number += 1
+            consumer_tag = 'ctag%d.%d' % (self._channel_number, self._last_consumer_number)
+        assert consumer_tag not in self._consumers
+        if arguments is not None and 'x-stream-offset' in arguments:
+            self._broker.declare_queue(queue).seek(arguments['x-stream-offset'])
+        self._consumers[consumer_tag] = (queue, consumer_callback, no_ack)
+        return consumer_tag
+
+    def basic_get(self,
                   queue,
-                  no_ack,
-    ):
-        'get a single message'
-        raise NotImplemented()
+                  no_ack=False,
+                  ):
+        'return (method, properties, body) for a single message or (None, None, None) if the queue is empty'
+        for offset, body, redelivered in self._broker.declare_queue(queue).take(1):
+            delivery_tag = self._deliver(queue, offset, no_ack)
+            method = pika.spec.Basic.GetOk(
+                delivery_tag=delivery_tag,
+                redelivered=redelivered,
+                exchange='',
+                routing_key=queue,
+            )
+            return method, pika.spec.BasicProperties(), body
+        return None, None, None
 
     def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
         'reject one or more messages'
-        raise NotImplemented()
+        # parameters
+        #  delivery_tag: as for basic_ack; None or 0 rejects all of the outstanding messages
+        for queue, offsets in self._settle(delivery_tag, multiple).items():
+            self._broker.declare_queue(queue).reject(offsets, requeue)
 
     def basic_publish(self,
                       exchange: str,
                       routing_key: str,
                       body: str,
-                      properties,
-                      mandatory: bool,
-                      immediate: bool,
+                      properties=None,
+                      mandatory: bool=False,
+                      immediate: bool=False,
                       ):
-        'publish to the channel'
-        # TODO: implement me
-        raise NotImplemented()
+        'publish to the channel; return False if mandatory and the message was not routed to any queue'
+        # the properties are not stored
+        assert isinstance(body, str)
+        assert immediate is False  # RabbitMQ does not support immediate
+        n_queues = self._broker.publish(exchange, routing_key, body)
+        return not (mandatory and n_queues == 0)
 
     def basic_qos(self,
                   callback=None,
@@ -218,31 +687,36 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
                   all_channels=False,
                   ):
         'specify qualify of service'
-        pass  # fully implemented, but we do nothing regarding QoS
+        # prefetch_count is the maximum number of unacknowledged messages; 0 means no limit
+        # Up to prefetch_count messages are read from a queue at once
+        assert prefetch_size == 0  # not implemented
+        self._prefetch_count = prefetch_count
 
     def basic_reject(self, delivery_tag, requeue=True):
         'reject an incoming message'
-        raise NotImplemented()
+        self.basic_nack(delivery_tag=delivery_tag, multiple=False, requeue=requeue)
 
     def basic_recover(self, callback=None, requeue=False):
         'ask the server to redeliver all unacknowledged messages'
-        raise NotImplemented()
+        if len(self._unacked) > 0:
+            self.basic_nack(delivery_tag=next(reversed(self._unacked)), multiple=True, requeue=True)
 
     def close(self, reply_code=0, reply_text='Normal shutdown'):
         'invoke a graceful showdown of the channel'
         # parameters
         #  reply_code: reason to send to the broker
         #  reply_text: reason text to send to the broker
-        for file in self._files:
-            file.close()
+        # unacknowledged messages are redelivered, as the committed offsets do not include them
+        self._consumers = collections.OrderedDict()
+        self._is_open = False
 
     def confirm_delivery(self, callback=None, nowait=False):
         'turn on Confirm mode'
-        raise NotImplemented()
+        pass  # every publish is confirmed, as it completes before basic_publish returns
 
     def consumer_tags(self):
         'return list of currently active consumers'
-        raise NotImplemented()
+        return list(self._consumers.keys())
 
     def exchange_bind(self,
                       callback=None,
@@ -267,7 +741,11 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
                          arguments=None,
                          ):
         'create an exchange if it does not already exist'
-        raise NotImplemented()
+        # every exchange is durable
+        if passive:
+            assert self._broker.has_exchange(exchange)
+        else:
+            self._broker.declare_exchange(exchange, exchange_type)
 
     def exchange_delete(self,
                         callback=None,
@@ -276,7 +754,7 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
                         nowait=False,
                         ):
         'delete the exchange'
-        raise NotImplemented()
+        self._broker.delete_exchange(exchange)
 
     def exchange_unbind(self,
                         callback=None,
@@ -305,7 +783,7 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
         'return True iff the channel is open'
         return self._is_open
 
-    def open():
+    def open(self):
         'open the channel'
         # lazily open files when consume and publish method calls are executed'
         self._is_open = True
@@ -319,7 +797,7 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
                    arguments=None,
                    ):
         'bind the queue to the specified exchange'
-        raise NotImplemented()
+        self._broker.bind(queue, exchange, queue if routing_key is None else routing_key)
 
     def queue_declare(self,
                       callback,
@@ -332,7 +810,11 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
                       arguments=None,
                       ):
         'declare queue, creating it if needed'
-        raise NotImplemented()
+        # every queue is durable
+        assert queue != ''  # server-named queues are not implemented
+        if passive:
+            assert self._broker.has_queue(queue)
+        self._broker.declare_queue(queue)
 
     def queue_delete(self,
                      callback=None,
@@ -342,7 +824,7 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
                      nowait=False,
                      ):
         'delete a queue from the broker'
-        raise NotImplemented()
+        self._broker.delete_queue(queue)
 
     def queue_purge(self,
                     callback=None,
@@ -350,7 +832,8 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
                     nowait=False,
                     ):
         'purge all the message from the specified queue'
-        raise NotImplemented()
+        file_queue = self._broker.declare_queue(queue)
+        file_queue.seek(file_queue.end_offset())
 
     def queue_unbind(self,
                      callback=None,
@@ -360,7 +843,7 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
                      arguments=None,
                      ):
         'unbind a queue fron an exchange'
-        raise NotImplemented()
+        self._broker.unbind(queue, exchange, queue if routing_key is None else routing_key)
 
     def tx_commit(self,
                   callback=None,
@@ -380,26 +863,104 @@ class FileBlockingChannel(pika.adapters.blocking_connection.BlockingChannel):
         'select standard transaction mode'
         raise NotImplemented()
 
-    def start_consuming():
-        'repeatedly read message and call the callback function specified by basic_consumer'
-        # raise exception to exit; so caller should use a try-except blocking
-        # TODO: implement me
-        raise NotImplemented()
-
-    def stop_consuming():
-        pass
+    def start_consuming(self):
+        'repeatedly read message and call the callback function specified by basic_consume'
+        # return when stop_consuming() is called or when no message has arrived for the idle_timeout
+        # of the connection; if the idle_timeout is None, wait for messages forever (as does RabbitMQ)
+        self._stop_consuming = False
+        idle_since = time.time()
+        while not self._stop_consuming and len(self._consumers) > 0:
+            if self._deliver_available() > 0:
+                idle_since = time.time()
+                continue
+            idle_timeout = self._connection._idle_timeout
+            if idle_timeout is not None and time.time() - idle_since >= idle_timeout:
+                break
+            time.sleep(self._connection._poll_interval)
+
+    def stop_consuming(self, consumer_tag=None):
+        self._stop_consuming = True
+
+    def _deliver(self, queue, offset, no_ack):
+        'return new delivery tag for the message at the offset in the queue'
+        self._last_delivery_tag += 1
+        if no_ack:
+            self._broker.declare_queue(queue).acknowledge([offset])
+        else:
+            self._unacked[self._last_delivery_tag] = (queue, offset)
+        return self._last_delivery_tag
+
+    def _deliver_available(self):
+        'call the consumer callbacks with messages already in the queues; return number delivered'
+        n_delivered = 0
+        for consumer_tag, (queue, callback, no_ack) in list(self._consumers.items()):
+            if self._prefetch_count == 0:
+                max_messages = 1000  # read in batches of this size
+            else:
+                max_messages = self._prefetch_count - len(self._unacked)
+                if max_messages <= 0:
+                    continue  # wait for the callback to acknowledge some messages
+            file_queue = self._broker.declare_queue(queue)
+            messages = file_queue.take(max_messages)
+            for i, (offset, body, redelivered) in enumerate(messages):
+                delivery_tag = self._deliver(queue, offset, no_ack)
+                method = pika.spec.Basic.Deliver(
+                    consumer_tag=consumer_tag,
+                    delivery_tag=delivery_tag,
+                    redelivered=redelivered,
+                    exchange='',
+                    routing_key=queue,
+                )
+                callback(self, method, pika.spec.BasicProperties(), body)
+                n_delivered += 1
+                if self._stop_consuming:
+                    # return the messages that were read but not delivered
+                    file_queue.reject([offset for offset, body, redelivered in messages[i + 1:]], requeue=True)
+                    return n_delivered
+        return n_delivered
+
+    def _settle(self, delivery_tag, multiple):
+        'remove the delivery tags from the unacknowledged messages; return Dict[queue, List[offset]]'
+        if delivery_tag is None or delivery_tag == 0:
+            # as in RabbitMQ, no delivery tag means all of the outstanding messages
+            delivery_tags = list(self._unacked.keys())
+        elif multiple:
+            delivery_tags = [tag for tag in self._unacked.keys() if tag <= delivery_tag]
+        else:
+            delivery_tags = [delivery_tag]
+        result = collections.defaultdict(list)
+        for tag in delivery_tags:
+            queue, offset = self._unacked.pop(tag)
+            result[queue].append(offset)
+        return result
 
 
 class FileBlockingConnection(pika.adapters.blocking_connection.BlockingConnection):
     'emulate RabbitMQ BlockingConnect using the file system'
     # ref: http://pika.readthedocs.io/en/0.11.0/modules/adapters/blocking.html
     # implement all of the methods
-    def __init__(self, parameters=None, _impl_class=None):
+    def __init__(self,
+                 parameters=None,
+                 _impl_class=None,
+                 directory: str=None,
+                 idle_timeout: float=None,
+                 poll_interval: float=0.1,
+                 segment_max_messages: int=100000,
+                 ):
+        'connect to the broker whose state is in the directory'
+        # idle_timeout: seconds that start_consuming waits for a new message before returning, or None
+        # poll_interval: seconds between checks for new messages
         assert parameters is None
         assert _impl_class is None
+        assert directory is not None
+        self._broker = FileBroker(directory, segment_max_messages=segment_max_messages)
+        self._idle_timeout = idle_timeout
+        self._poll_interval = poll_interval
         self._last_channel_number = 0
         self._channels = []  # typing.List[FileBlockingChannel]
-        pass
+
+    def __repr__(self):
+        return 'FileBlockingConnection(%s, |channels|=%d)' % (self._broker, len(self._channels))
 
     def add_on_connection_unblocked_callback(self, callback_method):
         raise NotImplemented()
@@ -419,7 +980,7 @@ class FileBlockingConnection(pika.adapters.blocking_connection.BlockingConnectio
         self._last_channel_number += 1
         fbc = FileBlockingChannel(
             connection=self,
-            channgel_number=self._last_channel_number,
+            channel_number=self._last_channel_number,
             on_open_callback=None,
         )
         self._channels.append(fbc)
@@ -429,6 +990,7 @@ class FileBlockingConnection(pika.adapters.blocking_connection.BlockingConnectio
         'disconnect from RabbitMQ, closing any open channels'
         for channel in self._channels:
             channel.close()
+        self._broker.close()
 
     def consumer_cancel_notify(self):
         raise NotImplemented()
@@ -474,7 +1036,156 @@ class FileBlockingConnection(pika.adapters.blocking_connection.BlockingConnectio
 
 ###########################################################
 class Test(unittest.TestCase):
-    pass
+    def test_file_queue_segments_and_offsets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            q = FileQueue(directory, segment_max_messages=3)
+            for i in range(8):
+                self.assertEqual(q.append('message %d' % i), i)
+            self.assertEqual(q.end_offset(), 8)
+            self.assertEqual(q.read(2, 4), [(k, 'message %d' % k) for k in range(2, 6)])
+            self.assertEqual(q.read(7, 10), [(7, 'message 7')])
+            taken = q.take(5)
+            self.assertEqual([offset for offset, body, redelivered in taken], [0, 1, 2, 3, 4])
+            q.acknowledge([0, 1, 3])
+            self.assertEqual(q.committed_offset, 2)
+            q.reject([2], requeue=True)
+            self.assertEqual(q.take(1), [(2, 'message 2', True)])
+            q.close()
+
+            # a new reader starts at the committed offset
+            q = FileQueue(directory, segment_max_messages=3)
+            self.assertEqual(q.committed_offset, 2)
+            q.close()
+
+    def test_primitive_batches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'queue')
+            channel = PrimitiveBlockingChannel(
+                path_for_input=lambda queue: path,
+                paths_for_output=lambda exchange, routing_key: [path],
+            )
+            channel.publish('exchange', 'key', 'body 0')
+            channel.publish_batch('exchange', 'key', ['body %d' % i for i in range(1, 5)])
+            channel.flush()
+            self.assertEqual(channel.consume('queue'), 'body 0')
+            self.assertEqual(channel.consume_batch('queue', 3), ['body 1', 'body 2', 'body 3'])
+            self.assertEqual(list(channel.consume_generator('queue', batch_size=2)), ['body 4'])
+            self.assertEqual(channel.consume_batch('queue', 3, timeout=0.0), [])
+            channel.close()
+
+    def test_async_channel(self):
+        with tempfile.TemporaryDirectory() as directory:
+            def path(name):
+                return os.path.join(directory, name)
+
+            with open(path('in.A'), 'w') as f:
+                f.write('a0\na1\n')
+            with open(path('in.B'), 'w') as f:
+                f.write('b0\n')
+            channel = AsyncChannel(PrimitiveBlockingChannel(
+                path_for_input=lambda queue: path('in.%s' % queue),
+                paths_for_output=lambda exchange, routing_key: [path('out.%s' % routing_key)],
+            ))
+
+            async def copy_queue(queue):
+                async for body in channel.consume(queue):
+                    await channel.publish('exchange', queue, body.upper())
+
+            async def copy_queues():
+                await asyncio.gather(copy_queue('A'), copy_queue('B'))
+
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(copy_queues())
+            finally:
+                loop.close()
+            channel.close()
+            with open(path('out.A')) as f:
+                self.assertEqual(f.read(), 'A0\nA1\n')
+            with open(path('out.B')) as f:
+                self.assertEqual(f.read(), 'B0\n')
+
+    def test_topic_matches(self):
+        self.assertTrue(topic_matches('events.*', 'events.037833AJ9'))
+        self.assertFalse(topic_matches('events.*', 'events.037833AJ9.en'))
+        self.assertTrue(topic_matches('events.#', 'events.037833AJ9.en'))
+        self.assertTrue(topic_matches('#', 'events'))
+        self.assertFalse(topic_matches('features.*', 'events.037833AJ9'))
+
+    def test_publish_consume_ack(self):
+        with tempfile.TemporaryDirectory() as directory:
+            connection = FileBlockingConnection(directory=directory, idle_timeout=0.0)
+            channel = connection.channel()
+            channel.exchange_declare(exchange='etl', exchange_type='topic')
+            for queue in ('events.A', 'events.all'):
+                channel.queue_declare(None, queue=queue)
+            channel.queue_bind(None, 'events.A', 'etl', routing_key='events.A')
+            channel.queue_bind(None, 'events.all', 'etl', routing_key='events.*')
+            for i in range(5):
+                channel.basic_publish('etl', 'events.A' if i % 2 == 0 else 'events.B', 'body %d' % i)
+
+            received = []
+
+            def callback(channel, method, properties, body):
+                received.append(body)
+                if body == 'body 2':
+                    channel.stop_consuming()  # without acknowledging body 2
+                else:
+                    channel.basic_ack(delivery_tag=method.delivery_tag)
+
+            # with no acknowledgements, at most prefetch_count messages are delivered
+            channel.basic_qos(prefetch_count=2)
+            consumer_tag = channel.basic_consume(lambda *args: received.append(args[3]), 'events.all')
+            channel.start_consuming()
+            self.assertEqual(received, ['body 0', 'body 1'])
+            channel.basic_cancel(consumer_tag=consumer_tag)
+            channel.basic_recover(requeue=True)
+
+            received = []
+            channel.basic_consume(callback, 'events.all')
+            channel.start_consuming()
+            self.assertEqual(received, ['body 0', 'body 1', 'body 2'])
+            connection.close()
+
+            # the unacknowledged messages are delivered to the next consumer
+            connection = FileBlockingConnection(directory=directory, idle_timeout=0.0)
+            channel = connection.channel()
+            method, properties, body = channel.basic_get('events.all')
+            self.assertEqual(body, 'body 2')
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            method, properties, body = channel.basic_get('events.all', no_ack=True)
+            self.assertEqual(body, 'body 3')
+            method, properties, body = channel.basic_get('events.all', no_ack=True)
+            self.assertEqual(body, 'body 4')
+            self.assertEqual(channel.basic_get('events.all'), (None, None, None))
+
+            # replay from an offset
+            received = []
+            channel.basic_consume(
+                lambda channel, method, properties, body: received.append(body),
+                'events.A',
+                no_ack=True,
+                arguments={'x-stream-offset': 1},
+            )
+            channel.start_consuming()
+            self.assertEqual(received, ['body 2', 'body 4'])
+            connection.close()
+
+    def test_nack_without_delivery_tag(self):
+        with tempfile.TemporaryDirectory() as directory:
+            connection = FileBlockingConnection(directory=directory, idle_timeout=0.0)
+            channel = connection.channel()
+            channel.exchange_declare(exchange='etl', exchange_type='topic')
+            channel.queue_declare(None, queue='events.A')
+            channel.queue_bind(None, 'events.A', 'etl', routing_key='events.A')
+            for i in range(3):
+                channel.basic_publish('etl', 'events.A', 'body %d' % i)
+            for i in range(2):
+                channel.basic_get('events.A')
+            channel.basic_nack()  # rejects and requeues both outstanding messages
+            bodies = [channel.basic_get('events.A', no_ack=True)[2] for i in range(4)]
+            self.assertEqual(bodies, ['body 0', 'body 1', 'body 2', None])
+            connection.close()
 
 
 if __name__ == '__main__':
@@ -6,6 +6,13 @@ INVOCATION
   python test_train.py {issuer} {cusip} {target} {hpset}
     {start_events} {start_predictions} {stop_predictions} {upstream_version} {feature_version}
     [--config {config}] [--debug] [--test] [--trace] [--dev]
+    [--fit-workers {n}] [--fit-executor {thread|process}]
+    [--explain {all|none|sampled}] [--explain-every {n}]
+    [--flush-rows {n}] [--flush-seconds {s}] [--checkpoint-seconds {s}]
+    [--event-cache] [--more-cusips {cusip} ...]
+    [--retrain {time|trades|drift}] [--retrain-every {n}]
+    [--retrain-drift-window {n}] [--retrain-drift-factor {f}]
+    [--retrain-max-lag {s}] [--retrain-background]
 where
  issuer the issuer (ex: AAPL)
  cusip is the cusip id (9 characters; ex: 68389XAS4)
@@ -15,6 +22,8 @@ where
      fundamentals tend to be published once a quarter
   It should be about a quarter before the start_prediction date, so that feature vectors
      can be accumulated before the predictions start
+  The event readers start reading their input files at this date, without creating events for
+     earlier rows.
  start_predictions: YYYY-MM-DD is the first date on which we attempt to test and train
  stop_predictions: YYYY-MM-DD is the last date on which we attempt to test and train
  upstream_version: any sequence of characters without spaces, identifies the versions of all the input files
@@ -33,6 +42,43 @@ where
    and logging.error()
  --test means to set control.test, so that test code is executed
  --trace means to invoke pdb.set_trace() early in execution
+ --fit-workers {n} means to fit the experts for the model specs in the hpset using n workers
+   The default is 1, which fits the experts one after the other in the main thread.
+ --fit-executor {thread|process} selects the kind of workers used when n > 1
+   thread (the default) uses a pool of threads; the scikit-learn fitting code releases the GIL
+   process uses a pool of processes that read the training data from shared memory
+ --explain {all|none|sampled} controls which ensemble predictions have their explanations written
+   to the ensemble-predictions directory
+   all (the default) writes every explanation
+   none writes no explanations
+   sampled writes the explanation for the first ensemble prediction and every n-th one after that
+ --explain-every {n} sets n for --explain sampled; the default is 100
+ --flush-rows {n} and --flush-seconds {s} set when the buffered rows of the CSV output files are written
+   A file is written when it has n buffered rows (default 100) or when s seconds (default 1.0) have
+   passed since it was last written.
+ --checkpoint-seconds {s} sets how often the CSV output files are synced to disk. They are synced after
+   a training when s seconds (default 60.0) have passed since they were last synced, and at the end of the run.
+   The actions file is written after every row, so that an upstream process can tail it.
+   The other files are written as {name}.partial and renamed to {name} at the end of the run.
+   A {name}.partial file left by a run that did not finish is reported by the programs that walk the
+   test_train output directories.
+ --more-cusips {cusip} ... means to also test and train for each of these primary cusips of the issuer
+   The input files are read once for all of the primary cusips. The output for each primary cusip
+   is written to the directory it would have had if it were the {cusip} invocation parameter.
+   Each primary cusip has its own OTR cusip, set by the liq flow on the run events for it.
+ --event-cache means to read the input events from a columnar binary cache of each input CSV file
+   The cache for file {path} is the directory {path}.columnar. It is built on first use and
+   rebuilt automatically when the CSV file changes. See seven/ColumnarCache.py.
+ --retrain {time|trades|drift} selects when the experts are retrained. See seven/RetrainScheduler.py.
+   time (the default) retrains when EnsembleHyperparameters.min_timedelta_between_training has passed
+   trades retrains after every n trades, where n is set by --retrain-every {n} (default 1)
+   drift retrains when the absolute error of the ensemble exceeds f times its mean over the n
+     preceding tests, where n is set by --retrain-drift-window {n} (default 20) and f is set by
+     --retrain-drift-factor {f} (default 2.0)
+ --retrain-max-lag {s} means to skip the random forests model specs when retraining while the
+   simulated clock is more than s seconds behind the event being processed
+ --retrain-background means to fit the experts in a background thread. The event loop keeps testing
+   with the previous sets of experts; the new set is used from the first event after it is fitted.
 
 EXAMPLES OF INVOCATION
   python test_train.py AAPL 037833AJ9 oasspread grid5 2017-04-01 2017-09-14 2017-09-14 1 1 --debug # run until end of events
@@ -94,27 +140,34 @@ import argparse
 import copy
 import csv
 import collections
+import concurrent.futures
 import datetime
-import errno
 import gc
 import heapq
 import json
 import math
+import numpy as np
 import os
 import pdb
 from pprint import pprint
 import random
 import signal
 import sys
+import threading
+import types
+import unittest
 
 
 import seven.arg_type
+import seven.BufferedCsvWriter
 import seven.build
 import seven.debug
 import seven.dirutility
 import seven.Event
 import seven.EventAttributes
 import seven.event_readers
+import seven.ExpertFitter
+import seven.ExpertScorer
 import seven.HpGrids
 import seven.Logger
 import seven.logging
@@ -123,7 +176,9 @@ import seven.make_event_attributes
 import seven.models2
 import seven.pickle_utilities
 import seven.read_csv
+import seven.RetrainScheduler
 import seven.Timer
+import seven.TrainingMatrix
 import seven.wallclock
 
 pp = pprint
@@ -163,9 +218,24 @@ def make_control(argv):
     parser.add_argument('stop_predictions', type=seven.arg_type.date)
     parser.add_argument('upstream_version', type=str)
     parser.add_argument('feature_version', type=str)
+    parser.add_argument('--checkpoint-seconds', type=seven.arg_type.positive_float, default=60.0)
     parser.add_argument('--config', action='store')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--dev', action='store_true')
+    parser.add_argument('--event-cache', action='store_true')
+    parser.add_argument('--explain', choices=('all', 'none', 'sampled'), default='all')
+    parser.add_argument('--explain-every', type=seven.arg_type.positive_int, default=100)
+    parser.add_argument('--fit-executor', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--fit-workers', type=seven.arg_type.n_processes, default=1)
+    parser.add_argument('--flush-rows', type=seven.arg_type.positive_int, default=100)
+    parser.add_argument('--flush-seconds', type=seven.arg_type.positive_float, default=1.0)
+    parser.add_argument('--more-cusips', type=seven.arg_type.cusip, nargs='+', default=[])
+    parser.add_argument('--retrain', choices=('time', 'trades', 'drift'), default='time')
+    parser.add_argument('--retrain-background', action='store_true')
+    parser.add_argument('--retrain-drift-factor', type=seven.arg_type.positive_float, default=2.0)
+    parser.add_argument('--retrain-drift-window', type=seven.arg_type.positive_int, default=20)
+    parser.add_argument('--retrain-every', type=seven.arg_type.positive_int, default=1)
+    parser.add_argument('--retrain-max-lag', type=seven.arg_type.positive_float, default=None)
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--trace', action='store_true')
 
@@ -207,6 +277,8 @@ def make_control(argv):
         random_seed=random_seed,
         timer=timer,
         event_reader = {
+            'columnar_cache': arg.event_cache,
+            'start_date': arg.start_events,  # the event readers skip rows before this date
             'trace': {
                 'number_variances_per_cusip': 2,
                 'max_deviation': 10,
@@ -221,6 +293,36 @@ def make_control(argv):
     return control
 
 
+def make_control_for_cusip(control, cusip):
+    'return a Control for another primary cusip of the same issuer, which reads the same input files'
+    arg = copy.copy(control.arg)
+    arg.cusip = cusip
+    paths = seven.build.test_train(
+        arg.issuer,
+        arg.cusip,
+        arg.target,
+        arg.hpset,
+        arg.start_events,
+        arg.start_predictions,
+        arg.stop_predictions,
+        arg.upstream_version,
+        arg.feature_version,
+        test=arg.test,
+    )
+    for logical_name, location in control.path.items():
+        if logical_name.startswith('in_'):
+            paths[logical_name] = location  # possibly as changed by the --config file
+    seven.dirutility.assure_exists(paths['dir_out'])
+    seven.dirutility.assure_exists(os.path.join(paths['dir_out'], 'ensemble-predictions'))
+    return Control(
+        arg=arg,
+        path=paths,
+        random_seed=control.random_seed,
+        timer=control.timer,
+        event_reader=control.event_reader,
+    )
+
+
 def config(control, config_path):
     'return updated control object'
     with open(config_path) as f:
@@ -236,32 +338,35 @@ def config(control, config_path):
 
 
 class ExpertAccuracy(object):
+    'accuracy of one set of trained experts, as arrays with one element for each model spec'
     def __init__(self,
                  actual,                # float
-                 absolute_errors,       # Dict[model_spec, float]
+                 absolute_errors,       # np.array 1D of float
                  ensemble_prediction,   # float, for one set of trained experts
-                 explanation,           # List[str]
-                 importances,           # Dict[model_spec, Dict[feature_name, weighted_importance]]
-                 normalized_weights,    # Dict[model_spec, noramlized_weight: float]
-                 predictions,           # Dict[model_spec, float]
+                 feature_names,         # List[feature_name], the columns of weighted_importances
+                 model_specs,           # List[model_spec], the rows of the arrays
+                 normalized_weights,    # np.array 1D of float
+                 predictions,           # np.array 1D of float
                  standard_deviation,    # float, for one set of trained experts
+                 weighted_importances,  # np.array 2D [model_spec, feature_name] of normalized_weight * importance
                  ):
         assert isinstance(actual, float)
-        assert isinstance(absolute_errors, dict)
+        assert isinstance(absolute_errors, np.ndarray)
         assert isinstance(ensemble_prediction, float)
-        assert isinstance(explanation, list)
-        assert isinstance(importances, dict)
-        assert isinstance(normalized_weights, dict)
-        assert isinstance(predictions, dict)
+        assert isinstance(model_specs, list)
+        assert isinstance(normalized_weights, np.ndarray)
+        assert isinstance(predictions, np.ndarray)
         assert isinstance(standard_deviation, float)
+        assert isinstance(weighted_importances, np.ndarray)
         self.actual = actual
         self.absolute_errors = absolute_errors
         self.ensemble_prediction = ensemble_prediction
-        self.explanation = explanation
-        self.importances = importances
+        self.feature_names = feature_names
+        self.model_specs = model_specs
         self.normalized_weights = normalized_weights
         self.predictions = predictions
         self.standard_deviation = standard_deviation
+        self.weighted_importances = weighted_importances
 
     def __repr__(self):
         return 'ExpertAccuracies(actual=%0.2f, ensemble_prediction=%0.2f, standard_deviation=%0.2f)' % (
@@ -270,6 +375,37 @@ class ExpertAccuracy(object):
             self.standard_deviation,
         )
 
+    def explanation(self):
+        'return List[str] explaining the ensemble prediction and standard deviation'
+        lines = []
+        lines.append('ensemble prediction and standard deviation')
+        for i, model_spec in enumerate(self.model_specs):
+            lines.append(
+                'expert %30s prediction %10.6f actual %10.6f absolute error %10.6f normalized weight %10.6f' % (
+                    model_spec,
+                    self.predictions[i],
+                    self.actual,
+                    self.absolute_errors[i],
+                    self.normalized_weights[i],
+                ))
+        lines.append('ensemble_prediction=%f, standard_deviation=%f' % (
+            self.ensemble_prediction,
+            self.standard_deviation,
+        ))
+        # the weighted feature importances
+        lines.append(' ')
+        lines.append('start of weighted feature importance when not zero')
+        model_indices, feature_indices = np.nonzero(self.weighted_importances > 0.0)
+        for i, j in zip(model_indices, feature_indices):
+            lines.append('model_spec %30s weight %10.6f feature %60s weighted importance %10.6f' % (
+                self.model_specs[i],
+                self.normalized_weights[i],
+                self.feature_names[j],
+                self.weighted_importances[i, j],
+            ))
+        lines.append('end of weighted feature importance when not zero')
+        return lines
+
 
 class EnsemblePrediction(object):
     def __init__(self,
@@ -279,25 +415,26 @@ class EnsemblePrediction(object):
                  elapsed_wallclock_seconds,  # time to make expert predictions and ensemble prediction
                  ensemble_prediction,        # across the sets of trained experts
                  expert_accuracies,          # List[ExpertAccuracy], oldest to youngest
-                 explanation,
                  feature_vector_for_actual,
                  feature_vector_for_query,
                  importances,                # Dict[model_spec.name, Dict[feature_name, weighted_importance]]
                  list_of_trained_experts,    # List[TrainedExpert], ordered from oldest to yougest
+                 normalized_weights,         # np.array 1D, weight of each set of trained experts
                  simulated_datetime,
                  standard_deviation,
                  ):
+        assert len(expert_accuracies) == len(list_of_trained_experts) == len(normalized_weights)
         self.action_identifier = action_identifier
         self.actual = actual
         self.creation_event = creation_event
         self.elapsed_wallclock_seconds = elapsed_wallclock_seconds
         self.ensemble_prediction = ensemble_prediction
         self.expert_accuracies = expert_accuracies
-        self.explanation = explanation
         self.feature_vector_for_actual = feature_vector_for_actual
         self.feature_vector_for_query = feature_vector_for_query
         self.importances = importances
         self.list_of_trained_experts = list_of_trained_experts
+        self.normalized_weights = normalized_weights
         self.simulated_datetime = simulated_datetime
         self.standard_deviation = standard_deviation
 
@@ -308,18 +445,37 @@ class EnsemblePrediction(object):
             self.standard_deviation,
             )
 
+    def explanation(self):
+        'return List[str] explaining how the sets of experts were blended'
+        lines = []
+        lines.append(
+            'tested with %d most-recnelty trained sets of experts' % len(self.list_of_trained_experts),
+        )
+        for i, trained_experts in enumerate(self.list_of_trained_experts):
+            lines.append(' experts %50s had overall weight %10.6f' % (
+                trained_experts,
+                self.normalized_weights[i],
+            ))
+        for i, trained_experts in enumerate(self.list_of_trained_experts):
+            lines.append('*** details on accuracy of %s' % trained_experts)
+            lines.extend(self.expert_accuracies[i].explanation())
+        return lines
+
 
 class TrainedExperts(object):
     def __init__(self,
                  creation_event,
                  elapsed_wallclock_seconds,
+                 scorer,
                  simulated_datetime,
                  trained_models,
                  training_features,
                  training_targets,
                  ):
+        assert isinstance(scorer, seven.ExpertScorer.ExpertScorer)
         self.creation_event = creation_event
         self.elapsed_wallclock_seconds = elapsed_wallclock_seconds
+        self.scorer = scorer  # predicts with all of the trained models at once
         self.simulated_datetime = simulated_datetime
         self.trained_models = trained_models
         self.training_features = training_features
@@ -379,14 +535,108 @@ class EnsembleHyperparameters(object):
         return 'EnsembleHyperparameters(...)'
 
 
+class EventRouter(object):
+    'build the attributes of each event and select the primary cusips that use it'
+    # The trace attribute makers are per cusip and the makers for the other sources are per source,
+    # except that the liq flow on the run makers are per primary cusip, as each primary cusip has its
+    # own OTR cusip. A trace print for an OTR cusip is used by each primary cusip that has that OTR cusip.
+    def __init__(self, control, primary_cusips, irregularity):
+        self._control = control
+        self._primary_cusips = primary_cusips  # key = cusip, value = PrimaryCusip
+        self._irregularity = irregularity
+
+        self._event_attribute_makers_trace = {}  # key = cusip
+        self._event_attribute_makers_liq_flow = {}  # key = primary cusip
+        self._event_attribute_makers_not_trace = {}  # key = source
+
+    def __repr__(self):
+        return 'EventRouter(%s)' % ','.join(self._primary_cusips.keys())
+
+    def route(self, event):
+        'return (event_attributes, List[PrimaryCusip]); the list is empty if the event is not used'
+        source = event.source
+        if True:  # lazily build the event_attribute_makers
+            if source == 'trace':
+                cusip = event.cusip()
+                if cusip not in self._event_attribute_makers_trace:
+                    self._event_attribute_makers_trace[cusip] = event.make_event_attributes_class(self._control.arg)
+                event_attribute_maker = self._event_attribute_makers_trace[cusip]
+            elif source == 'liq_flow_on_the_run':
+                primary_cusip = event.payload['primary_cusip']
+                if primary_cusip not in self._primary_cusips:
+                    self._irregularity.skipped_event(
+                        'liq flow on the run event for cusip %s, which is not primary (%s)' % (
+                            primary_cusip,
+                            ','.join(self._primary_cusips.keys()),
+                        ),
+                        event,
+                    )
+                    return None, []
+                if primary_cusip not in self._event_attribute_makers_liq_flow:
+                    self._event_attribute_makers_liq_flow[primary_cusip] = event.make_event_attributes_class(
+                        self._primary_cusips[primary_cusip].control.arg,
+                    )
+                event_attribute_maker = self._event_attribute_makers_liq_flow[primary_cusip]
+            else:
+                if source not in self._event_attribute_makers_not_trace:
+                    print(event.make_event_attributes_class)
+                    self._event_attribute_makers_not_trace[source] = event.make_event_attributes_class(
+                        self._control.arg,
+                    )
+                event_attribute_maker = self._event_attribute_makers_not_trace[source]
+            event_attributes, errs = event_attribute_maker.make_attributes(event)
+
+            if errs is not None:
+                for err in errs:
+                    self._irregularity.no_attribute_maker(err, event)
+                # continue for now
+                # later, once the event attribute makers are all running, stop with an error
+                return None, []
+
+        if True:  # determine which primary cusips use the event
+            if source == 'trace':
+                cusip = event.cusip()
+                receivers = [
+                    primary_cusip
+                    for primary_cusip in self._primary_cusips.values()
+                    if cusip == primary_cusip.cusip or cusip == primary_cusip.otr_cusip
+                ]
+                if len(receivers) == 0:
+                    self._irregularity.skipped_event(
+                        'trace event for cusips %s, which is not primary (%s) nor otr (%s)' % (
+                            cusip,
+                            ','.join(self._primary_cusips.keys()),
+                            ','.join(primary_cusip.otr_cusip for primary_cusip in self._primary_cusips.values()),
+                        ),
+                        event,
+                    )
+                return event_attributes, receivers
+            elif source == 'liq_flow_on_the_run':
+                primary_cusip = self._primary_cusips[event_attributes['id_liq_flow_on_the_run_primary_cusip']]
+                primary_cusip.otr_cusip = event_attributes['id_liq_flow_on_the_run_otr_cusip']
+                return event_attributes, [primary_cusip]
+            else:
+                # for now, skip all other event sources
+                # later, add these to the feature vector
+                pdb.set_trace()
+                self._irregularity.skipped_event(
+                    'event source %s not yet processed' % source,
+                    event,
+                )
+                return None, []
+
+
 class EventQueue(object):
     'maintain event timestamp-ordered queue of event'
+    # the heap items are (event.sort_key, reader_index, event, event_reader), so that the heap
+    # compares precomputed keys instead of calling the comparison methods of the events
     def __init__(self, event_reader_classes, control, exceptions):
         self._event_readers = []
         self._event_queue = []  # : heapq
         self._exceptions = exceptions
-        for event_reader_class in event_reader_classes:
+        for reader_index, event_reader_class in enumerate(event_reader_classes):
             event_reader = event_reader_class(control)
+            self._event_readers.append(event_reader)
             try:
                 while True:
                     event, err = next(event_reader)
@@ -396,12 +646,12 @@ class EventQueue(object):
                         self._exceptions.no_event(err, event)
             except StopIteration:
                 seven.logging.warning('event reader %s returned no events at all' % event_reader)
-            heapq.heappush(self._event_queue, (event, event_reader))
+            heapq.heappush(self._event_queue, (event.sort_key, reader_index, event, event_reader))
         print('initial event queue')
         q = copy.copy(self._event_queue)  # make a copy, becuase the heappop method mutates its argument
         while True:
             try:
-                event, event_reader = heapq.heappop(q)
+                sort_key, reader_index, event, event_reader = heapq.heappop(q)
                 print(event)
             except IndexError:
                 # q is empty
@@ -411,7 +661,7 @@ class EventQueue(object):
         'return the oldest event or raise StopIteration()'
         # get the oldest event (and delete it from the queue)
         try:
-            oldest_event, event_reader = heapq.heappop(self._event_queue)
+            sort_key, reader_index, oldest_event, event_reader = heapq.heappop(self._event_queue)
         except IndexError:
             raise StopIteration()
 
@@ -423,7 +673,7 @@ class EventQueue(object):
                     break
                 else:
                     self._exceptions.no_event(err, new_event)
-            heapq.heappush(self._event_queue, (new_event, event_reader))
+            heapq.heappush(self._event_queue, (new_event.sort_key, reader_index, new_event, event_reader))
         except StopIteration:
             event_reader.close()
 
@@ -435,46 +685,83 @@ class EventQueue(object):
             event_reader.close()
 
 
+class FeatureSchema(object):
+    'the layout of a feature vector, compiled once from the first event attributes for each tag'
+    # The non-id features are the columns of a 1D np.array, in sorted order of their output names
+    # (which is the order of the columns of TrainingMatrix). The id features are in a dict.
+    def __init__(self, tagged_event_attributes):
+        'tagged_event_attributes: List[(tag, EventAttributes)]'
+        self.layouts = {}  # key = tag, value = (List[(attribute name, column)], List[(attribute name, id name)])
+        columns = {}  # key = tag, value = List[(attribute name, output name)]
+        all_names = set()
+        for tag, event_attributes in tagged_event_attributes:
+            columns[tag] = []
+            ids = []
+            for k in event_attributes.value.keys():
+                if k.startswith('id_'):
+                    k_new = 'id_%s_%s' % (tag, k[3:])
+                    ids.append((k, k_new))
+                else:
+                    k_new = '%s_%s' % (tag, k)
+                    columns[tag].append((k, k_new))
+                assert k_new not in all_names
+                all_names.add(k_new)
+            self.layouts[tag] = ([], ids)
+        self.feature_names = sorted(
+            output_name
+            for tag_columns in columns.values()
+            for attribute_name, output_name in tag_columns
+        )
+        self.indices = {feature_name: i for i, feature_name in enumerate(self.feature_names)}
+        for tag, tag_columns in columns.items():
+            self.layouts[tag][0].extend(
+                (attribute_name, self.indices[output_name])
+                for attribute_name, output_name in tag_columns
+            )
+
+    def __repr__(self):
+        return 'FeatureSchema(%d features, tags=%s)' % (len(self.feature_names), sorted(self.layouts.keys()))
+
+
 class FeatureVector(object):
     def __init__(self,
                  creation_datetime,
                  creation_event,
-                 payload,
+                 schema,
+                 row,
+                 ids,
                  reclassified_trade_type,
                  ):
         assert isinstance(creation_datetime, datetime.datetime)
+        assert isinstance(schema, FeatureSchema)
         # these fields are part of the API
         self.creation_datetime = creation_datetime
         self.creation_event = copy.copy(creation_event)
-        self.payload = payload
+        self.schema = schema
+        self.row = row  # 1D np.array with the non-id features in the order of schema.feature_names
+        self.ids = ids  # Dict[id name, value]
         self.reclassified_trade_type = reclassified_trade_type
         # TODO: implement cross-product of the features from the events
         # for example, determine the debt to equity ratio
 
-    def _make_payload(self, primary_cusip_event_features, otr_cusip_event_features):
+    @property
+    def payload(self):
         'return dict with all the features'
-        # check that there are no duplicate feature names
-        def append(all_features, tag, new_features):
-            for k, v in new_features.items():
-                if k.startswith('id_'):
-                    k_new = 'id_%s_%s' % (tag, k[3:])
-                else:
-                    k_new = '%s_%s' % (tag, k)
-                assert k_new not in all_features
-                all_features[k_new] = v
+        result = dict(zip(self.schema.feature_names, self.row.tolist()))
+        result.update(self.ids)
+        return result
 
-        all_features = {}
-        append(all_features, 'p', primary_cusip_event_features.value)
-        append(all_features, 'otr', otr_cusip_event_features.value)
-        return all_features
+    def feature(self, name):
+        'return the value of the feature or id'
+        index = self.schema.indices.get(name)
+        return self.ids[name] if index is None else float(self.row[index])
 
     def __eq__(self, other):
-        'return True iff each payload non-id field is the same'
-        for k, v in self.payload.items():
-            if not k.startswith('id_'):
-                if other.payload[k] != v:
-                    return False
-        return True
+        'return True iff each non-id feature is the same'
+        return (
+            self.schema.feature_names == other.schema.feature_names and
+            np.array_equal(self.row, other.row)
+        )
 
     def __ne__(self, other):
         return not self == other
@@ -482,13 +769,17 @@ class FeatureVector(object):
     def __repr__(self):
         return 'FeatureVector(creation_event=%s, n features=%d, created=%s, rtt=%s)' % (
             self.creation_event,
-            len(self.payload),
+            len(self.row) + len(self.ids),
             self.creation_datetime,
             self.reclassified_trade_type,
         )
 
 
 class FeatureVectorMaker(object):
+    'maintain the features from the most recent primary and OTR cusip event attributes'
+    # The features are written in place into a preallocated row, using a schema that is
+    # compiled once both the primary and OTR cusip event attributes have been seen. Every
+    # later EventAttributes must have the same keys as the first one for its cusip.
     def __init__(self, invocation_args):
         self._invocation_args = invocation_args
 
@@ -496,22 +787,19 @@ class FeatureVectorMaker(object):
         self._event_attributes_cusip_primary = None
         self._reclassified_trade_type = None
 
+        self.schema = None  # FeatureSchema, set when we have all event attributes
+        self._row = None  # 1D np.array in the order of schema.feature_names
+        self._ids = {}
+
     def all_features(self):
         'return dict with all the features'
-        # check that there are no duplicate feature names
-        def append(all_features, tag, attributes):
-            for k, v in attributes.value.items():
-                if k.startswith('id_'):
-                    k_new = 'id_%s_%s' % (tag, k[3:])
-                else:
-                    k_new = '%s_%s' % (tag, k)
-                assert k_new not in all_features
-                all_features[k_new] = v
+        result = dict(zip(self.schema.feature_names, self._row.tolist()))
+        result.update(self._ids)
+        return result
 
-        all_features = {}
-        append(all_features, 'otr', self._event_attributes_cusip_otr)
-        append(all_features, 'p', self._event_attributes_cusip_primary)
-        return all_features
+    def feature_row(self):
+        'return (row, ids): copies of the current non-id features (1D np.array) and id features (dict)'
+        return self._row.copy(), dict(self._ids)
 
     def have_all_event_attributes(self):
         'return True or False'
@@ -534,11 +822,37 @@ class FeatureVectorMaker(object):
     def update_cusip_otr(self, event, event_attributes):
         assert isinstance(event_attributes, seven.EventAttributes.EventAttributes)
         self._event_attributes_cusip_otr = event_attributes
+        self._write('otr', event_attributes)
 
     def update_cusip_primary(self, event, event_attributes):
         assert isinstance(event_attributes, seven.EventAttributes.EventAttributes)
         self._reclassified_trade_type = event.reclassified_trade_type()
         self._event_attributes_cusip_primary = event_attributes
+        self._write('p', event_attributes)
+
+    def _write(self, tag, event_attributes):
+        'write the event attributes into the row and ids'
+        if self.schema is None:
+            if not self.have_all_event_attributes():
+                return
+            self.schema = FeatureSchema([
+                ('otr', self._event_attributes_cusip_otr),
+                ('p', self._event_attributes_cusip_primary),
+            ])
+            self._row = np.empty(len(self.schema.feature_names))
+            for tag_seen, event_attributes_seen in (
+                    ('otr', self._event_attributes_cusip_otr),
+                    ('p', self._event_attributes_cusip_primary)):
+                self._write(tag_seen, event_attributes_seen)
+            return
+        columns, ids = self.schema.layouts[tag]
+        values = event_attributes.value
+        assert len(values) == len(columns) + len(ids)
+        row = self._row
+        for attribute_name, column in columns:
+            row[column] = values[attribute_name]
+        for attribute_name, id_name in ids:
+            self._ids[id_name] = values[attribute_name]
 
 
 class Importances(object):
@@ -646,56 +960,34 @@ class Irregularities(object):
 
 class Output(object):
     'output to a CSV file using a dictionary writer'
-    # close and reopen file after every record, so that the file is not truncated
-    # if the program exits abnormally
-    def __init__(self, path, field_names):
-        self._path = path
-        self._field_names = field_names
-
-        self._dict_writer = None
-        self._file = None
-        self._n_rows_written = 0
+    # rows are buffered and flushed according to the flush policy, so that if the program
+    # exits abnormally, the file holds all but the most recently buffered rows
+    def __init__(self, path, field_names, flush_policy, tail_able=False):
+        'flush_policy: Dict[str, value] with optional keys flush_bytes, flush_rows, flush_seconds'
+        self._writer = seven.BufferedCsvWriter.BufferedCsvWriter(
+            path,
+            field_names,
+            tail_able=tail_able,
+            **flush_policy
+        )
 
-        self._silently_remove(path)
-        self._open()
+    def checkpoint(self):
+        'make the rows written so far durable'
+        self._writer.checkpoint()
 
     def close(self):
-        self._file.close()
-
-    def _open(self):
-        self._file = open(self._path, 'a')
-        self._dict_writer = csv.DictWriter(
-            self._file,
-            self._field_names,
-            lineterminator='\n',
-        )
-        if self._n_rows_written == 0:
-            self._dict_writer.writeheader()
-
-    def _silently_remove(self, path):
-        'remove file, if it exists'
-        # ref: https://stackoverflow.com/questions/10840533/most-pythonic-way-to-delete-a-file-which-may-not-exist
-        try:
-            os.remove(path)
-        except OSError as e:
-            if e.errno != errno.ENOENT:  # no such file or directory
-                raise                    # re-raise the exception
-            pass  # ignore file does not exist problem (and others)
+        self._writer.close()
 
     def _writerow(self, row):
         'write row'
-        self._dict_writer.writerow(row)
-        self._n_rows_written += 1
-
-        self.close()
-        self._open()
+        self._writer.writerow(row)
 
 
 class OutputActions(Output):
     'actions are outputs of the machine learning to upstream processes'
     # not the diagnostics, at least for now
     # the actions need to be in a file that an upstream process can tail
-    def __init__(self, path):
+    def __init__(self, path, flush_policy):
         super(OutputActions, self).__init__(
             path=path,
             field_names=[
@@ -703,6 +995,8 @@ class OutputActions(Output):
                 'action_type',
                 'action_value',
             ],
+            flush_policy=dict(flush_policy, flush_rows=1),  # upstream sees each action as soon as it is made
+            tail_able=True,
         )
 
     def ensemble_prediction(self, ep, trade_type):
@@ -720,7 +1014,7 @@ class OutputActions(Output):
 
 
 class OutputExperts(Output):
-    def __init__(self, path):
+    def __init__(self, path, flush_policy):
         super(OutputExperts, self).__init__(
             path=path,
             field_names=[
@@ -732,20 +1026,27 @@ class OutputExperts(Output):
                 'target_actual',
                 'target_predicted',
                 'absolute_error',
-            ]
+            ],
+            flush_policy=flush_policy,
         )
 
     def expert_accuracy(self, ensemble_prediction):
         assert isinstance(ensemble_prediction, EnsemblePrediction)
         expert_accuracies = ensemble_prediction.expert_accuracies[-1]  # report on the most recently created
-        normalized_weights = expert_accuracies.normalized_weights  # Dict[model_spec, normalized_weight]
+        normalized_weights = dict(zip(
+            expert_accuracies.model_specs,
+            expert_accuracies.normalized_weights.tolist(),
+        ))  # Dict[model_spec, normalized_weight]
+        predictions = dict(zip(
+            expert_accuracies.model_specs,
+            expert_accuracies.predictions.tolist(),
+        ))  # Dict[model_spec, prediction]
         sorted_normalized_weights = self._sorted_by_decreasing_value(normalized_weights)
         actual = expert_accuracies.actual
         for d in sorted_normalized_weights:
             model_spec = d['key']
             normalized_weight = d['value']
-            # for model_spec, normalized_weight in expert_accuracies.normalized_weights.iteritems():
-            predicted = expert_accuracies.predictions[model_spec]
+            predicted = predictions[model_spec]
             row = {
                 'event_datetime': ensemble_prediction.creation_event.datetime(),
                 'creation_event': '%s' % ensemble_prediction.creation_event,
@@ -771,7 +1072,7 @@ class OutputExperts(Output):
 
 
 class OutputImportances(Output):
-    def __init__(self, path, n_most_important_features):
+    def __init__(self, path, flush_policy, n_most_important_features):
         self._n_most_important_features = n_most_important_features
         super(OutputImportances, self).__init__(
             path=path,
@@ -781,6 +1082,7 @@ class OutputImportances(Output):
                 'importances_feature_name',
                 'importances_weight'
             ],
+            flush_policy=flush_policy,
         )
 
     def ensemble_prediction(self, ensemble_prediction, reclassified_trade_type):
@@ -819,7 +1121,7 @@ class OutputSignals(Output):
     'signals are the combined actual oasspreads and predictions'
     # these are for presentation purposes and to help diagnose accuracy
     # the signal needs to be in an easy-to-parse file
-    def __init__(self, path):
+    def __init__(self, path, flush_policy):
         self._last_simulated_datetime = datetime.datetime(1, 1, 1)
         super(OutputSignals, self).__init__(
             path=path,
@@ -831,6 +1133,7 @@ class OutputSignals(Output):
                 'standard_deviation_B', 'standard_deviation_S',
                 'actual_B', 'actual_S',
             ],
+            flush_policy=flush_policy,
         )
 
     def ensemble_prediction(self, ep, trade_type):
@@ -878,7 +1181,7 @@ class OutputSignals(Output):
 
 class OutputTrace(Output):
     'write complete log (a trace log)'
-    def __init__(self, path):
+    def __init__(self, path, flush_policy):
         super(OutputTrace, self).__init__(
             path=path,
             field_names=[
@@ -887,6 +1190,7 @@ class OutputTrace(Output):
                 'what_happened',
                 'info',
             ],
+            flush_policy=flush_policy,
         )
 
     def ensemble_prediction(self, ensemble_prediction, count, reclassified_trade_type):
@@ -1025,6 +1329,308 @@ class OutputTrace(Output):
         self._writerow(d)
 
 
+class PrimaryCusip(object):
+    'test and train for one primary cusip, from events that are read once for all the primary cusips'
+    def __init__(self, control, ensemble_hyperparameters, expert_fitter):
+        self.control = control
+        self.cusip = control.arg.cusip
+        self.counter = collections.Counter()
+        self.irregularity = Irregularities()
+        self.otr_cusip = ''  # set by the EventRouter from the liq flow on the run events for this cusip
+        self.simulated_clock = SimulatedClock()
+        self.total_wallclock_seconds = collections.Counter()
+
+        flush_policy = {
+            'flush_rows': control.arg.flush_rows,
+            'flush_seconds': control.arg.flush_seconds,
+        }
+        self.output_actions = OutputActions(
+            control.path['out_actions'],
+            flush_policy=flush_policy,
+        )
+        self.output_experts = OutputExperts(
+            control.path['out_experts'],
+            flush_policy=flush_policy,
+        )
+        self.output_importances = OutputImportances(
+            control.path['out_importances'],
+            flush_policy=flush_policy,
+            n_most_important_features=16,  # number of features in each feature vector
+        )
+        self.output_signals = OutputSignals(
+            path=control.path['out_signal'],
+            flush_policy=flush_policy,
+        )
+        self.output_trace = OutputTrace(
+            path=control.path['out_trace'],
+            flush_policy=flush_policy,
+        )
+        self._outputs = (
+            self.output_actions,
+            self.output_experts,
+            self.output_importances,
+            self.output_signals,
+            self.output_trace,
+        )
+        self._checkpoint_timedelta = datetime.timedelta(0, control.arg.checkpoint_seconds)
+        self._last_checkpoint_wallclock = datetime.datetime.now()
+
+        self._feature_vector_maker = FeatureVectorMaker(control.arg)
+        self._feature_vector = None
+
+        def select_target(feature_vector, reclassified_trade_type):
+            key = 'p_trace_%s_%s' % (reclassified_trade_type, control.arg.target)
+            return feature_vector.feature(key)
+
+        def select_target_B(feature_vector):
+            return select_target(feature_vector, 'B')
+
+        def select_target_S(feature_vector):
+            return select_target(feature_vector, 'S')
+
+        # construct a testing and training engine for each reclassified trade types
+        # Each engine sees feature vectors for only B or S trades
+        # the B and S engines share one pool of workers for fitting their experts
+        # Each engine has its own retrain scheduler, as each decides when to train from what it has seen
+        action_identifiers = ActionIdentifiers()
+
+        def make_retrain_scheduler():
+            return seven.RetrainScheduler.make_retrain_scheduler(
+                policy=control.arg.retrain,
+                min_timedelta=ensemble_hyperparameters.min_timedelta_between_training,
+                n_trades=control.arg.retrain_every,
+                drift_window=control.arg.retrain_drift_window,
+                drift_factor=control.arg.retrain_drift_factor,
+                max_lag=(
+                    None if control.arg.retrain_max_lag is None else
+                    datetime.timedelta(0, control.arg.retrain_max_lag)
+                ),
+            )
+
+        self.test_train = {
+            'B': TestTrain(
+                action_identifiers, control, ensemble_hyperparameters, expert_fitter,
+                make_retrain_scheduler(), select_target_B, self.simulated_clock,
+            ),
+            'S': TestTrain(
+                action_identifiers, control, ensemble_hyperparameters, expert_fitter,
+                make_retrain_scheduler(), select_target_S, self.simulated_clock,
+            ),
+        }
+        self._event_loop_wallclock_start = datetime.datetime.now()
+
+    def __repr__(self):
+        return 'PrimaryCusip(%s)' % self.cusip
+
+    def close(self):
+        for test_train in self.test_train.values():
+            test_train.close()
+        for output in self._outputs:
+            output.close()
+
+    def _maybe_checkpoint(self):
+        'sync the outputs to disk if checkpoint_seconds have passed since they were last synced'
+        now = datetime.datetime.now()
+        if now - self._last_checkpoint_wallclock < self._checkpoint_timedelta:
+            return
+        for output in self._outputs:
+            output.checkpoint()
+        self._last_checkpoint_wallclock = now
+
+    def handle_event(self, event, event_attributes):
+        'update features and maybe test and train; return True if the event loop should stop'
+        control = self.control
+        current_otr_cusip = self.otr_cusip
+        counter = self.counter
+        feature_vector_maker = self._feature_vector_maker
+        irregularity = self.irregularity
+        output_trace = self.output_trace
+        simulated_clock = self.simulated_clock
+        test_train = self.test_train
+
+        if True:  # build and accumulate feature vectors before we start predicting
+            if True:  # build attributes from the event
+                if event.source == 'trace':
+                    cusip = event.cusip()
+                    # a cusip can be both a primary cusip and an OTR cusip
+                    if cusip == control.arg.cusip:
+                        feature_vector_maker.update_cusip_primary(event, event_attributes)
+                        simulated_clock.handle_event()
+                        output_trace.update_features_cusip_primary(simulated_clock.datetime, event, event_attributes)
+                    if cusip == current_otr_cusip:
+                        feature_vector_maker.update_cusip_otr(event, event_attributes)
+                        simulated_clock.handle_event()
+                        output_trace.update_features_cusip_otr(simulated_clock.datetime, event, event_attributes)
+                elif event.source == 'liq_flow_on_the_run':
+                    simulated_clock.handle_event()
+                    output_trace.update_liq_flow_on_the_run(simulated_clock.datetime, event, event_attributes)
+
+            if True:  # trace cusip events for the primary and OTR cusips
+                def has_cusip(cusip):
+                    return event.is_trace_print_with_cusip(cusip)
+
+                if has_cusip(control.arg.cusip) or has_cusip(current_otr_cusip):
+                    self.output_signals.event_trace_print(event)
+
+            if True:  # accumulate feature vectors
+                if feature_vector_maker.have_all_event_attributes():
+                    simulated_clock.handle_event()
+                    row, ids = feature_vector_maker.feature_row()
+                    self._feature_vector = FeatureVector(
+                        creation_datetime=simulated_clock.datetime,
+                        creation_event=event,
+                        schema=feature_vector_maker.schema,
+                        row=row,
+                        ids=ids,
+                        reclassified_trade_type=feature_vector_maker.reclassified_trade_type(),
+                    )
+                    # print 'new feature vector', feature_vector
+                    output_trace.new_feature_vector_created(self._feature_vector)
+                    rtt = self._feature_vector.reclassified_trade_type
+                    test_train[rtt].accumulate_feature_vector(self._feature_vector)
+                    # print 'new feature vector accumulated', rtt, test_train[rtt]
+            seven.wallclock.end_lap('mutate feature vector using event attributes')
+
+        if counter['events processed'] % 100 == 0:
+            output_trace.event_loop(
+                counter['events processed'] + 1,
+                datetime.datetime.now() - self._event_loop_wallclock_start,
+                self.total_wallclock_seconds,
+            )
+
+        if event.date() < control.arg.start_predictions:
+            return False  # just accumulate feature vectors before the start date
+
+        print(str(test_train))
+        print('processed %d prior events in %0.2f wallclock minutes' % (
+            counter['events processed'] - 1,
+            control.timer.elapsed_wallclock_seconds() / 60.0,
+        ))
+
+        counter['events on or after start-predictions date'] += 1
+        if True:  # attempt to test and train
+            if not event.is_trace_print_with_cusip(control.arg.cusip):
+                irregularity.no_testing('event not trace print for primary cusip', event)
+                seven.wallclock.end_lap('decide if we have a feature vector')
+                return False
+            if self._feature_vector is None:
+                irregularity.no_feature_vector('missing attributes:' + feature_vector_maker.missing_attributes(), event)
+                seven.wallclock.end_lap('decide if we have a feature vector')
+                return False
+            # event was for the primary cusip
+            rtt = self._feature_vector.reclassified_trade_type
+            print('about to call maybe_test_and_train', rtt)
+            ensemble_prediction, errs_test, trained_experts, errs_train = (
+                test_train[rtt].maybe_test_and_train(
+                    current_event=event,
+                )
+            )
+            # seven.wallclock.end_lap('test and train attempt')
+            print('returned from test_train.maybe_test_and_train', rtt)
+            print('errs_test', errs_test)
+            print('errs_train', errs_train)
+            simulated_clock.handle_event()
+        if True:  # handle results from test and train (predictions, fitted models, errors)
+            if errs_test is None:
+                # write the testing results (the predictions)
+                print('processing an ensemble prediction', rtt)
+
+                counter['ensemble predictions made'] += 1
+                counter['ensemble predictions made %s' % rtt] += 1
+
+                self.total_wallclock_seconds['test'] += ensemble_prediction.elapsed_wallclock_seconds
+                self.output_actions.ensemble_prediction(ensemble_prediction, rtt)
+                self.output_experts.expert_accuracy(ensemble_prediction)
+                self.output_importances.ensemble_prediction(ensemble_prediction, rtt)
+                self.output_signals.ensemble_prediction(ensemble_prediction, rtt)
+                output_trace.ensemble_prediction(
+                    ensemble_prediction,
+                    counter['ensemble predictions made'],
+                    rtt,
+                    )
+
+                # write the explanation (which is lines of plain text), rendering it only if wanted
+                if is_explained(control.arg, counter['ensemble predictions made']):
+                    explanation_filename = ('%s.txt' % ensemble_prediction.action_identifier)
+                    explanation_path = os.path.join(
+                        control.path['dir_out'],
+                        'ensemble-predictions',
+                        explanation_filename,
+                    )
+                    with open(explanation_path, 'w') as f:
+                        for line in ensemble_prediction.explanation():
+                            f.write(line)
+                            f.write('\n')
+                seven.wallclock.end_lap('test write results')
+            else:
+                # write the errs from the test attempt
+                print('reclassified trade type', rtt)
+                for err in errs_test:
+                    irregularity.no_test(err, event)
+                    output_trace.no_test(simulated_clock.datetime, err, event)
+                seven.wallclock.end_lap('test write errors')
+
+            if errs_train is None:
+                # write the training results
+                print('processing trained experts', rtt)
+
+                counter['experts trained'] += 1
+                counter['experts trained %s' % rtt] += 1
+
+                self.total_wallclock_seconds['train'] += trained_experts.elapsed_wallclock_seconds
+                output_trace.trained_experts(
+                    trained_experts,
+                    rtt,
+                )
+                # a training is a checkpoint: make all the output so far durable, unless that was done recently
+                self._maybe_checkpoint()
+                seven.wallclock.end_lap('train write results')
+            else:
+                # write the errs from the training attempt
+                for err in errs_train:
+                    irregularity.no_train(err, event)
+                    output_trace.no_train(simulated_clock.datetime, err, event)
+                seven.wallclock.end_lap('train write errors')
+
+        if control.arg.dev and counter['ensemble predictions made'] >= 10:
+            print('for now, stopping early')
+            return True
+        return False
+
+    def report(self, shared_counter):
+        'write the counters file and print the ending state'
+        counter = shared_counter + self.counter
+        print('counters for primary cusip %s' % self.cusip)
+        with open(self.control.path['out_counters'], 'w') as f:
+            writer = csv.DictWriter(f, ['counter', 'value'], lineterminator='\n')
+            writer.writeheader()
+            for k in sorted(counter.keys()):
+                print('%-70s: %6d' % (k, counter[k]))
+                writer.writerow({
+                    'counter': k,
+                    'value': counter[k],
+                })
+
+        print()
+        print('**************************************')
+        print('exceptional conditions for primary cusip %s' % self.cusip)
+        for k in sorted(self.irregularity.counter.keys()):
+            print('%-40s: %6d' % (k, self.irregularity.counter[k]))
+        print()
+        print('************************************')
+        for reclassified_trade_type in ('B', 'S'):
+            print('test train', reclassified_trade_type, 'ending state:')
+            print('%s' % self.test_train[reclassified_trade_type])
+            self.test_train[reclassified_trade_type].report()
+
+    def see_event(self, event):
+        'note that an event was read and will be processed'
+        self.simulated_clock.see_event(event)  # remember current wallclock time
+        self.counter['events processed'] += 1
+        print('\nprocessing event # %d: %s' % (self.counter['events processed'], event))
+        print(self.control.arg.issuer, self.cusip, self.control.arg.start_predictions, self.control.arg.stop_predictions)
+
+
 class SimulatedClock(object):
     def __init__(self):
         self.datetime = datetime.datetime(1, 1, 1, 0, 0, 0)
@@ -1070,12 +1676,16 @@ class TestTrain(object):
                  action_identifiers,
                  control,
                  ensemble_hyperparameters,
+                 expert_fitter,
+                 retrain_scheduler,
                  select_target,
                  simulated_clock,
                  ):
         self._action_identifiers = action_identifiers
         self._control = control
         self._ensemble_hyperparameters = ensemble_hyperparameters
+        self._expert_fitter = expert_fitter
+        self._retrain_scheduler = retrain_scheduler
         self._select_target = select_target
         self._simulated_clock = simulated_clock
 
@@ -1083,11 +1693,20 @@ class TestTrain(object):
             [],
             self._ensemble_hyperparameters.max_n_feature_vectors,
         )
-        self._last_expert_training_time = datetime.datetime(1, 1, 1)
         self._list_of_trained_experts = collections.deque(
             [],
             self._ensemble_hyperparameters.max_n_trained_sets_of_experts,
         )
+        # the same feature vectors as in _all_feature_vectors, as np.arrays ready for training
+        self._training_matrix = seven.TrainingMatrix.TrainingMatrix(
+            self._ensemble_hyperparameters.max_n_feature_vectors,
+        )
+        # with --retrain-background, at most one set of experts is fitted at a time by the background thread
+        self._background_executor = (
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) if control.arg.retrain_background else
+            None
+        )
+        self._background_training = None  # Union[None, (TrainingJob, Future)]
 
     def __repr__(self):
         return 'TestTrain(%d feature vectors, %d sets of trained experts)' % (
@@ -1098,6 +1717,19 @@ class TestTrain(object):
     def accumulate_feature_vector(self, feature_vector):
         assert isinstance(feature_vector, FeatureVector)
         self._all_feature_vectors.append(feature_vector)
+        actual, err = self._make_actual(feature_vector)
+        self._training_matrix.append_row(
+            feature_names=feature_vector.schema.feature_names,
+            row=feature_vector.row,
+            actual=actual,  # None if err is not None
+            when=feature_vector.ids['id_p_trace_event'].datetime(),
+        )
+        self._retrain_scheduler.observe_feature_vector(self._simulated_clock.datetime)
+
+    def close(self):
+        'wait for any background training to finish'
+        if self._background_executor is not None:
+            self._background_executor.shutdown(wait=True)
 
     def maybe_test_and_train(self,
                              current_event,
@@ -1109,10 +1741,17 @@ class TestTrain(object):
 
         ensemble_prediction, errs_test = self._maybe_test(current_event)
         if errs_test is None:
+            self._retrain_scheduler.observe_test(
+                self._simulated_clock.datetime,
+                abs(ensemble_prediction.actual - ensemble_prediction.ensemble_prediction),
+            )
             seven.wallclock.end_lap('test successful')
         else:
             seven.wallclock.end_lap('test errs')
-        trained_experts, errs_train = self._maybe_train(current_event)
+        if self._background_executor is None:
+            trained_experts, errs_train = self._maybe_train(current_event)
+        else:
+            trained_experts, errs_train = self._maybe_train_in_background(current_event)
         if errs_train is None:
             seven.wallclock.end_lap('train successful')
         else:
@@ -1142,97 +1781,40 @@ class TestTrain(object):
 
     def _maybe_test(self, creation_event, verbose=False):
         'return (EnsemblePredicition, errs: List[str])'
-        def test_one_set_of_experts(actual, trained_experts, query_features, verbose=True):
+        def test_one_set_of_experts(actual, trained_experts, query):
             'return an ExpertAccuracy'
-            # determine unnormalized weights of experts (based on prediction accuracy)
-            expert_absolute_errors = {}
-            expert_predictions = {}
-            expert_unnormalized_weights = {}
-            sum_unnormalized_weights = 0.0
-            for model_spec, trained_expert in trained_experts.trained_models.items():
-                predictions = trained_expert.predict(query_features)
-                assert len(predictions) == 1
-                prediction = predictions[0]
-
-                absolute_error = abs(actual - prediction)
-                expert_predictions[model_spec] = prediction
-                expert_absolute_errors[model_spec] = absolute_error
-
-                unnormalized_weight = math.exp(-self._ensemble_hyperparameters.weight_temperature * absolute_error)
-                sum_unnormalized_weights += unnormalized_weight
-                expert_unnormalized_weights[model_spec] = unnormalized_weight
-
-            # determine normalized weights of experts
-            expert_normalized_weights = {}
-            for model_spec, unnormalized_weight in expert_unnormalized_weights.items():
-                expert_normalized_weights[model_spec] = unnormalized_weight / sum_unnormalized_weights
+            # determine weights of experts (based on prediction accuracy) for all experts at once
+            scorer = trained_experts.scorer
+            predictions = scorer.predict(query)
+            absolute_errors = np.abs(actual - predictions)
+            unnormalized_weights = np.exp(-self._ensemble_hyperparameters.weight_temperature * absolute_errors)
+            normalized_weights = unnormalized_weights / unnormalized_weights.sum()
 
             # make the ensemble prediction from these experts
-            ensemble_prediction = 0.0
-            for model_spec, expert_prediction in expert_predictions.items():
-                ensemble_prediction += expert_prediction * expert_normalized_weights[model_spec]
+            ensemble_prediction = float(normalized_weights.dot(predictions))
 
             # determine weighted standard deviation of the experts' predictions
-            variance = 0.0
-            for model_spec, expert_prediction in expert_predictions.items():
-                delta = ensemble_prediction - expert_prediction
-                variance += delta * delta * expert_normalized_weights[model_spec]
-            standard_deviation = math.sqrt(variance)
-
-            # determine weighted importances of features
-            weighted_importances = collections.defaultdict(lambda: collections.defaultdict(float))
-            for model_spec, trained_expert in trained_experts.trained_models.items():
-                weight = expert_normalized_weights[model_spec]
-                for feature_name, feature_importance in trained_expert.importances.items():
-                    weighted_importance = weight * feature_importance
-                    weighted_importances[model_spec][feature_name] += weighted_importance
-
-            # create the explanation lines for the ensemble predicton and standard deviation
-            lines = []
-            lines.append('ensemble prediction and standard deviation')
-            for model_spec in list(expert_normalized_weights.keys()):
-                lines.append(
-                    'expert %30s prediction %10.6f actual %10.6f absolute error %10.6f normalized weight %10.6f' % (
-                        model_spec,
-                        expert_predictions[model_spec],
-                        actual,
-                        expert_absolute_errors[model_spec],
-                        expert_normalized_weights[model_spec],
-                    ))
-            lines.append('ensemble_prediction=%f, standard_deviation=%f' % (
-                ensemble_prediction,
-                standard_deviation,
-            ))
-            # create the explanation lines for the weighted feature importances
-            lines.append(' ')
-            lines.append('start of weighted feature importance when not zero')
-            for model_spec, feature_importance in weighted_importances.items():
-                for feature_name, weighted_importance in feature_importance.items():
-                    if weighted_importance > 0.0:
-                        weight = expert_normalized_weights[model_spec]
-                        lines.append('model_spec %30s weight %10.6f feature %60s weighted importance %10.6f' % (
-                            model_spec,
-                            weight,
-                            feature_name,
-                            weighted_importance,
-                        ))
-            lines.append('end of weighted feature importance when not zero')
+            deltas = ensemble_prediction - predictions
+            standard_deviation = math.sqrt(normalized_weights.dot(deltas * deltas))
 
-            if verbose:
-                print('explanation of trained experts %s' % trained_experts)
-                for line in lines:
-                    print(line)
+            # determine weighted importances of features; the naive models have all-zero importances
+            weighted_importances = normalized_weights[:, np.newaxis] * scorer.importances
 
             expert_accuracy = ExpertAccuracy(
                 actual=actual,
-                absolute_errors=expert_absolute_errors,
+                absolute_errors=absolute_errors,
                 ensemble_prediction=ensemble_prediction,
-                explanation=lines,
-                importances=weighted_importances,
-                normalized_weights=expert_normalized_weights,
-                predictions=expert_predictions,
+                feature_names=scorer.feature_names,
+                model_specs=scorer.model_specs,
+                normalized_weights=normalized_weights,
+                predictions=predictions,
                 standard_deviation=standard_deviation,
+                weighted_importances=weighted_importances,
             )
+            if verbose:
+                print('explanation of trained experts %s' % trained_experts)
+                for line in expert_accuracy.explanation():
+                    print(line)
 
             return expert_accuracy
 
@@ -1252,7 +1834,7 @@ class TestTrain(object):
 
         actual_feature_vector = self._all_feature_vectors[-1]
         query_feature_vector = self._all_feature_vectors[-2]
-        query_features = [query_feature_vector.payload]  # must be a List[Dict]
+        query = self._training_matrix.features()[-2]  # the query_feature_vector as a row of features
 
         actual, err = self._make_actual(actual_feature_vector)
         if err is not None:
@@ -1261,75 +1843,49 @@ class TestTrain(object):
         print('testing %d sets of experts ...' % len(self._list_of_trained_experts))
 
         # test each of the sets of experts
-        # detemine their unnormalized weights
-        sum_unnormalized_weight = 0.0
-        experts_accuracies_list = []
-        trained_experts_accuracies = {}
-        unnormalized_weights = {}
-        testing_datetime = actual_feature_vector.creation_event.datetime()
-        for trained_experts in self._list_of_trained_experts:
-            # unnormalized weight
-            training_datetime = trained_experts.creation_event.datetime()
-            age_timedelta = testing_datetime - training_datetime
-            assert self._ensemble_hyperparameters.weight_units == 'days'
-            age_days = age_timedelta.total_seconds() / (60.0 * 60.0 * 24.0)
-            unnormalized_weight = math.exp(
-                -self._ensemble_hyperparameters.weight_temperature * age_days
-            )
-            unnormalized_weights[trained_experts] = unnormalized_weight
-            sum_unnormalized_weight += unnormalized_weight
-
-            # accuracy of these experts
-            expert_accuracy = test_one_set_of_experts(
+        list_of_trained_experts = list(self._list_of_trained_experts)  # the deque is mutated by training
+        experts_accuracies_list = [
+            test_one_set_of_experts(
                 actual=actual,
                 trained_experts=trained_experts,
-                query_features=query_features,
+                query=query,
             )
-            trained_experts_accuracies[trained_experts] = expert_accuracy
-            experts_accuracies_list.append(expert_accuracy)
+            for trained_experts in list_of_trained_experts
+        ]
+
+        # detemine the unnormalized weights of the sets of experts from their ages
+        testing_datetime = actual_feature_vector.creation_event.datetime()
+        assert self._ensemble_hyperparameters.weight_units == 'days'
+        age_days = np.array([
+            (testing_datetime - trained_experts.creation_event.datetime()).total_seconds()
+            for trained_experts in list_of_trained_experts
+        ]) / (60.0 * 60.0 * 24.0)
+        unnormalized_weights = np.exp(-self._ensemble_hyperparameters.weight_temperature * age_days)
+        normalized_weights = unnormalized_weights / unnormalized_weights.sum()
+        for trained_experts, normalized_weight in zip(list_of_trained_experts, normalized_weights):
+            print(trained_experts, normalized_weight)
 
         # just above, we determined the accuracies of each of the sets of experts
         # As part of that, we computed their ensemble prediction and standard deviation
         # Now we blend these sets of experts together to form the final ensemble prediction and standard deviation
-        ensemble_prediction = 0.0
-        ensemble_standard_deviation = 0.0
-        normalized_weights = {}
-        for trained_experts in self._list_of_trained_experts:
-            normalized_weight = unnormalized_weights[trained_experts] / sum_unnormalized_weight
-            print(trained_experts, normalized_weight)
-            normalized_weights[trained_experts] = normalized_weight
-
-            trained_experts_accuracy = trained_experts_accuracies[trained_experts]
-            ensemble_prediction += normalized_weight * trained_experts_accuracy.ensemble_prediction
-            ensemble_standard_deviation += normalized_weight * trained_experts_accuracy.standard_deviation
+        ensemble_prediction = float(normalized_weights.dot(
+            [expert_accuracy.ensemble_prediction for expert_accuracy in experts_accuracies_list]
+        ))
+        ensemble_standard_deviation = float(normalized_weights.dot(
+            [expert_accuracy.standard_deviation for expert_accuracy in experts_accuracies_list]
+        ))
 
-        # aggregate the importances (using the normalized_weights)
+        # aggregate the importances by model family (using the normalized_weights)
         aggregate_importances = collections.defaultdict(lambda: collections.defaultdict(float))
-        for trained_expert, normalized_weight in normalized_weights.items():
-            expert_accuracy = trained_experts_accuracies[trained_expert]
-            for model_spec, feature_importance in expert_accuracy.importances.items():
-                for feature_name, feature_importance in feature_importance.items():
-                    aggregate_importances[model_spec.name][feature_name] += normalized_weight * feature_importance
-
-        # build the overall explanation (List[str])
-        lines = []
-        lines.append(
-            'tested with %d most-recnelty trained sets of experts' % len(self._list_of_trained_experts),
-        )
-        for trained_experts in self._list_of_trained_experts:
-            lines.append(' experts %50s had overall weight %10.6f' % (
-                trained_experts,
-                normalized_weights[trained_expert],
-            )
-            )
-        for trained_expert in self._list_of_trained_experts:
-            lines.append('*** details on accuracy of %s' % trained_expert)
-            for line in trained_experts_accuracies[trained_expert].explanation:
-                lines.append(line)
-        for expert_accuracy in experts_accuracies_list:
-            lines.append('**** detail')
-            for line in expert_accuracy.explanation:
-                lines.append(line)
+        for i, expert_accuracy in enumerate(experts_accuracies_list):
+            model_families = list_of_trained_experts[i].scorer.model_families
+            for model_family in ('en', 'rf'):
+                in_family = model_families == model_family
+                if not in_family.any():
+                    continue
+                family_importances = normalized_weights[i] * expert_accuracy.weighted_importances[in_family].sum(axis=0)
+                for feature_name, importance in zip(expert_accuracy.feature_names, family_importances.tolist()):
+                    aggregate_importances[model_family][feature_name] += importance
 
         # build return value
         self._simulated_clock.handle_event()
@@ -1342,11 +1898,11 @@ class TestTrain(object):
             elapsed_wallclock_seconds=(datetime.datetime.now() - start_wallclock).total_seconds(),
             ensemble_prediction=ensemble_prediction,
             expert_accuracies=experts_accuracies_list,
-            explanation=lines,
             feature_vector_for_actual=actual_feature_vector,
             feature_vector_for_query=query_feature_vector,
             importances=aggregate_importances,
-            list_of_trained_experts=self._list_of_trained_experts,
+            list_of_trained_experts=list_of_trained_experts,
+            normalized_weights=normalized_weights,
             simulated_datetime=self._simulated_clock.datetime,
             standard_deviation=ensemble_standard_deviation,
         )
@@ -1355,12 +1911,41 @@ class TestTrain(object):
     def _maybe_train(self, creation_event, verbose=False):
         'return (Union[TrainedExperts, None], errs: Union[None,List[str]])'
         start_wallclock = datetime.datetime.now()
+        training_job, errs = self._maybe_make_training_job(creation_event, verbose)
+        if errs is not None:
+            return None, errs
+        fitted = self._fit(training_job)
+        # the event loop waited for the fit, so the simulated clock advances by the time it took
+        self._simulated_clock.handle_event()
+        return self._make_trained_experts(training_job, fitted, start_wallclock), None
+
+    def _maybe_train_in_background(self, creation_event, verbose=False):
+        'return (Union[TrainedExperts, None], errs: Union[None,List[str]]); maybe start a background training'
+        # the TrainedExperts returned are those fitted in the background since the previous call
+        # They are appended to _list_of_trained_experts by the caller, so that every test sees either the
+        # old sets of experts or the old sets plus the new set, never a partially-trained set
+        trained_experts = None
+        if self._background_training is not None:
+            training_job, future = self._background_training
+            if not future.done():
+                return None, ['previous training still running in the background']
+            self._background_training = None
+            trained_experts = self._make_trained_experts(training_job, future.result(), training_job.start_wallclock)
+
+        training_job, errs = self._maybe_make_training_job(creation_event, verbose)
+        if errs is None:
+            self._background_training = (training_job, self._background_executor.submit(self._fit, training_job))
+        if trained_experts is not None:
+            return trained_experts, None
+        return None, ['started training in the background'] if errs is None else errs
+
+    def _maybe_make_training_job(self, creation_event, verbose=False):
+        'return (TrainingJob, None) or (None, errs: List[str])'
+        start_wallclock = datetime.datetime.now()
 
         errs = []
-        time_since_last_training = self._simulated_clock.datetime - self._last_expert_training_time
-        min_time = self._ensemble_hyperparameters.min_timedelta_between_training
-        if time_since_last_training < min_time:
-            err = '%s had not passed since last training' % min_time
+        err = self._retrain_scheduler.reason_not_to_train(self._simulated_clock.datetime)
+        if err is not None:
             errs.append(err)
 
         if len(self._all_feature_vectors) < 2:
@@ -1370,77 +1955,102 @@ class TestTrain(object):
         if len(errs) > 0:
             return None, errs
 
-        def dt(index):
-            'return datetime of the trace event for the primary cusip'
-            return self._all_feature_vectors[index].payload['id_p_trace_event'].datetime()
-
-        if verbose:
-            print('in _maybe_train: selecting training data')
-            print('all feature vectors')
-            pp(self._all_feature_vectors)
-        training_features = []
-        training_targets = []
-        err = None
         if verbose:
-            print('in _maybe_train: creating training data')
-        for i in range(0, len(self._all_feature_vectors) - 1):
-            training_features.append(self._all_feature_vectors[i].payload)
-            features_datetime = dt(i)
-            next_index = i + 1
-            while (next_index < len(self._all_feature_vectors)) and dt(next_index) <= features_datetime:
-                next_index += 1
-            if next_index == len(self._all_feature_vectors):
-                err = 'no future trade in same primary cusip to find target value'
-                return None, [err]
-                break
-            target_feature_vector = self._all_feature_vectors[next_index]
-            training_targets.append(self._select_target(target_feature_vector))
-        if len(training_targets) == 0:
-            err = 'no training targets were found for the feature vectors'
+            print('in _maybe_make_training_job: selecting training data')
+            print('training matrix', self._training_matrix)
+        # each training target is the actual value from the next later trade in the primary cusip
+        # the arrays are views of the training matrix that remain valid while a background thread fits them
+        training_features, training_targets, err = self._training_matrix.training_data()
+        if err is not None:
             return None, [err]
 
         assert len(training_features) == len(training_targets)
 
-        print('training experts on %d training samples ...' % len(training_features))
         grid = seven.HpGrids.construct_HpGridN(self._control.arg.hpset)
-        trained_models = {}  # Dict[model_spec, trained model]
-        for model_spec in grid.iter_model_specs():
+        model_specs = self._retrain_scheduler.select_model_specs(
+            grid.iter_model_specs(),
+            self._simulated_clock.datetime - creation_event.datetime(),  # how far we are behind real time
+        )
+        for model_spec in model_specs:
             if model_spec.transform_y is not None:
                 # this code does no transform say oasspread in the features
                 # that needs to be done if the y values are transformed
                 seven.logging.critical('I did not transform the y values in the features')
                 sys.exit(1)
-            model_constructor = (
-                seven.models2.ModelNaive if model_spec.name == 'n' else
-                seven.models2.ModelElasticNet if model_spec.name == 'en' else
-                seven.models2.ModelRandomForests if model_spec.name == 'rf' else
-                None
-            )
-            model = model_constructor(model_spec, self._control.random_seed)
-            try:
-                if verbose:
-                    print('training expert', model.model_spec)
-                model.fit(training_features, training_targets)
-            except seven.models2.ExceptionFit as e:
-                seven.logging.warning('could not fit %s: %s' % (model_spec, e))
+        previous_models = {}  # the experts to warm start from
+        if len(grid.warm_start_model_names) > 0 and len(self._list_of_trained_experts) > 0:
+            previous_models = {
+                model_spec: model
+                for model_spec, model in self._list_of_trained_experts[-1].trained_models.items()
+                if model_spec.name in grid.warm_start_model_names
+            }
+        if verbose:
+            print('training %d experts (%d warm started) using %s' % (
+                len(model_specs),
+                len(previous_models),
+                self._expert_fitter,
+            ))
+        training_job = TrainingJob(
+            creation_event=creation_event,
+            feature_names=self._training_matrix.feature_names,
+            model_specs=model_specs,
+            previous_models=previous_models,
+            start_wallclock=start_wallclock,
+            training_features=training_features,
+            training_targets=training_targets,
+            tree_replacement_fraction=grid.tree_replacement_fraction,
+        )
+        return training_job, None
+
+    def _fit(self, training_job):
+        'return List[(model_spec, fitted model or None, err or None)]; may run in the background thread'
+        print('training %d experts on %d training samples ...' % (
+            len(training_job.model_specs),
+            len(training_job.training_features),
+        ))
+        return self._expert_fitter.fit(
+            training_job.model_specs,
+            self._control.random_seed,
+            training_job.feature_names,
+            training_job.training_features,
+            training_job.training_targets,
+            previous_models=training_job.previous_models,
+            tree_replacement_fraction=training_job.tree_replacement_fraction,
+        )
+
+    def _make_trained_experts(self, training_job, fitted, start_wallclock):
+        'return TrainedExperts made at the current simulated datetime'
+        trained_models = {}  # Dict[model_spec, trained model], inserted in the order of the grid
+        for model_spec, model, err in fitted:
+            if err is not None:
+                seven.logging.warning('could not fit %s: %s' % (model_spec, err))
                 continue
             trained_models[model_spec] = model  # the fitted model
-        self._simulated_clock.handle_event()
+        self._retrain_scheduler.observe_training(self._simulated_clock.datetime)
+        creation_event = training_job.creation_event
         result = TrainedExperts(
             creation_event=creation_event,
             elapsed_wallclock_seconds=(datetime.datetime.now() - start_wallclock).total_seconds(),
+            scorer=seven.ExpertScorer.ExpertScorer(trained_models, training_job.feature_names),
             simulated_datetime=self._simulated_clock.datetime,
             trained_models=trained_models,
-            training_features=training_features,
-            training_targets=training_targets,
+            training_features=training_job.training_features,
+            training_targets=training_job.training_targets,
         )
         print('trained %s experts on %d training samples in %f wallclock seconds; creation event=%s' % (
             len(trained_models),
-            len(training_features),
+            len(training_job.training_features),
             (datetime.datetime.now() - start_wallclock).total_seconds(),
             creation_event,
         ))
-        return result, None
+        return result
+
+
+TrainingJob = collections.namedtuple(
+    'TrainingJob',
+    'creation_event feature_names model_specs previous_models start_wallclock '
+    'training_features training_targets tree_replacement_fraction',
+)
 
 
 class TypedDequeDict(object):
@@ -1512,6 +2122,18 @@ def ensemble_prediction_write_explanation(control, ensemble_prediction):
             f.write(' %s' % line)
 
 
+def is_explained(arg, n_ensemble_predictions_made):
+    'return True if the explanation of the n-th ensemble prediction (counting from 1) is to be written'
+    if arg.explain == 'all':
+        return True
+    elif arg.explain == 'none':
+        return False
+    elif arg.explain == 'sampled':
+        return (n_ensemble_predictions_made - 1) % arg.explain_every == 0
+    else:
+        assert False, 'explain %s is not one of all, none, sampled' % arg.explain
+
+
 def make_max_n_trades_back(hpset):
     'return the maximum number of historic trades a model uses'
     grid = seven.HpGrids.construct_HpGridN(hpset)
@@ -1564,7 +2186,7 @@ def test_event_readers(event_reader_classes, control):
 def do_work(control):
     'write predictions from fitted models to file system'
     seven.lower_priority.lower_priority()
-    irregularity = Irregularities()
+    irregularity = Irregularities()  # for irregularities in the events shared by the primary cusips
 
     ensemble_hyperparameters = EnsembleHyperparameters()  # for now, take defaults
     event_reader_classes = (
@@ -1597,296 +2219,91 @@ def do_work(control):
     event_queue = EventQueue(event_reader_classes, control, irregularity)
 
     # repeatedly process the youngest event
-    counter = collections.Counter()
-
-    current_otr_cusip = ''
-
-    output_actions = OutputActions(
-        control.path['out_actions'],
-    )
-    output_experts = OutputExperts(
-        control.path['out_experts'],
-    )
-    output_importances = OutputImportances(
-        control.path['out_importances'],
-        n_most_important_features=16,  # number of features in each feature vector
-    )
-    output_signals = OutputSignals(
-        path=control.path['out_signal'],
-    )
-    output_trace = OutputTrace(
-        path=control.path['out_trace'],
-    )
+    counter = collections.Counter()  # for the events shared by the primary cusips
 
     seven.logging.verbose_info = False
     seven.logging.verbose_warning = False
-    simulated_clock = SimulatedClock()
-    action_identifiers = ActionIdentifiers()
     events_at = collections.Counter()
-    event_attribute_makers_trace = {}
-    event_attribute_makers_not_trace = {}
-    feature_vector_maker = FeatureVectorMaker(control.arg)
-    total_wallclock_seconds = collections.Counter()
-
-    def select_target(feature_vector, reclassified_trade_type):
-        key = 'p_trace_%s_%s' % (reclassified_trade_type, control.arg.target)
-        return feature_vector.payload[key]
-
-    def select_target_B(feature_vector):
-        return select_target(feature_vector, 'B')
-
-    def select_target_S(feature_vector):
-        return select_target(feature_vector, 'S')
-
-    # construct a testing and training engine for each reclassified trade types
-    # Each engine sees feature vectors for only B or S trades
-    test_train = {
-        'B': TestTrain(action_identifiers, control, ensemble_hyperparameters, select_target_B, simulated_clock),
-        'S': TestTrain(action_identifiers, control, ensemble_hyperparameters, select_target_S, simulated_clock),
-    }
-    event_loop_wallclock_start = datetime.datetime.now()
-    feature_vector = None
-    print('pretending that events before %s never happened' % control.arg.start_events)
-    seven.wallclock.end_lap('start up')
-    while True:
-        try:
-            event = next(event_queue)
-            counter['events read'] += 1
-        except StopIteration:
-            break  # all the event readers are empty
-
-        events_at[event.datetime()] += 1
-
-        if event.date() > control.arg.stop_predictions:
-            print('stopping event loop, because beyond stop predictions date of %s' % control.arg.stop_predictions)
-            print('event=', event)
-            break
-
-        if event.date() < control.arg.start_events:  # skip events before our simulated world starts
-            counter['events ignored'] += 1
-            continue
-
-        # track events that occured at the exact same moment
-        # In the future, such events need to be treated as a cluster and process together
-
-        simulated_clock.see_event(event)  # remember current wallclock time
-        seven.logging.verbose_info = True
-        seven.logging.verbose_warning = True
-        counter['events processed'] += 1
-        print('\nprocessing event # %d: %s' % (counter['events processed'], event))
-        print(control.arg.issuer, control.arg.cusip, control.arg.start_predictions, control.arg.stop_predictions)
-        # if counter['events processed'] > 12779:
-        #     print 'near to it'
-        #     pdb.set_trace()
-        seven.wallclock.end_lap('event obtain from queus')
-
-        if True:  # build and accumulate feature vectors before we start predicting
-            # if we waited to build feature vectors until we started predicting, the initial
-            # predictions would have little training data
-            source = event.source
-
-            if True:  # lazily build the event_attribute_makers
-                if source == 'trace':
-                    cusip = event.cusip()
-                    if cusip not in event_attribute_makers_trace:
-                        event_attribute_makers_trace[cusip] = event.make_event_attributes_class(control.arg)
-                    event_attributes, errs = event_attribute_makers_trace[cusip].make_attributes(event)
-                else:
-                    if source not in event_attribute_makers_not_trace:
-                        print(event.make_event_attributes_class)
-                        event_attribute_makers_not_trace[source] = event.make_event_attributes_class(control.arg)
-                    event_attributes, errs = event_attribute_makers_not_trace[source].make_attributes(event)
-
-                if errs is not None:
-                    for err in errs:
-                        irregularity.no_attribute_maker(err, event)
-                    # continue for now
-                    # later, once the event attribute makers are all running, stop with an error
-                    continue
-
-            if True:  # build attributes from the event
-                if event.source == 'trace':
-                    cusip = event.cusip()
-                    if cusip == control.arg.cusip or cusip == current_otr_cusip:
-                        # a cusip can be both a primary cusip and an OTR cusip
-                        if cusip == control.arg.cusip:
-                            feature_vector_maker.update_cusip_primary(event, event_attributes)
-                            simulated_clock.handle_event()
-                            output_trace.update_features_cusip_primary(simulated_clock.datetime, event, event_attributes)
-                        if cusip == current_otr_cusip:
-                            feature_vector_maker.update_cusip_otr(event, event_attributes)
-                            simulated_clock.handle_event()
-                            output_trace.update_features_cusip_otr(simulated_clock.datetime, event, event_attributes)
-                    else:
-                        irregularity.skipped_event(
-                            'trace event for cusips %s, which is not primary (%s) nor otr (%s)' % (
-                                cusip,
-                                control.arg.cusip,
-                                current_otr_cusip,
-                            ),
-                            event,
-                        )
-                        continue
-                elif event.source == 'liq_flow_on_the_run':
-                    current_otr_cusip = event_attributes['id_liq_flow_on_the_run_otr_cusip']
-                    simulated_clock.handle_event()
-                    output_trace.update_liq_flow_on_the_run(simulated_clock.datetime, event, event_attributes)
-                else:
-                    # for now, skip all other event sources
-                    # later, add these to the feature vector
-                    pdb.set_trace()
-                    irregularity.skipped_event(
-                        'event source %s not yet processed' % event.source,
-                        event,
-                    )
-                    continue
-
-            if True:  # trace cusip events for the primary and OTR cusips
-                def has_cusip(cusip):
-                    return event.is_trace_print_with_cusip(cusip)
-
-                if has_cusip(control.arg.cusip) or has_cusip(current_otr_cusip):
-                    output_signals.event_trace_print(event)
 
-            if True:  # accumulate feature vectors
-                if feature_vector_maker.have_all_event_attributes():
-                    simulated_clock.handle_event()
-                    feature_vector = FeatureVector(
-                        creation_datetime=simulated_clock.datetime,
-                        creation_event=event,
-                        payload=feature_vector_maker.all_features(),
-                        reclassified_trade_type=feature_vector_maker.reclassified_trade_type(),
-                    )
-                    # print 'new feature vector', feature_vector
-                    output_trace.new_feature_vector_created(feature_vector)
-                    rtt = feature_vector.reclassified_trade_type
-                    test_train[rtt].accumulate_feature_vector(feature_vector)
-                    # print 'new feature vector accumulated', rtt, test_train[rtt]
-            seven.wallclock.end_lap('mutate feature vector using event attributes')
-
-        if counter['events processed'] % 100 == 0:
-            output_trace.event_loop(
-                counter['events processed'] + 1,
-                datetime.datetime.now() - event_loop_wallclock_start,
-                total_wallclock_seconds,
+    # construct the testing and training engines for each primary cusip
+    # they share one pool of workers for fitting their experts
+    # the trace events are routed to the primary cusips through the dict primary_cusips
+    expert_fitter = seven.ExpertFitter.make_expert_fitter(control.arg.fit_executor, control.arg.fit_workers)
+    primary_cusips = collections.OrderedDict()  # key = cusip, value = PrimaryCusip
+    try:
+        for cusip in [control.arg.cusip] + control.arg.more_cusips:
+            primary_cusips[cusip] = PrimaryCusip(
+                control if cusip == control.arg.cusip else make_control_for_cusip(control, cusip),
+                ensemble_hyperparameters,
+                expert_fitter,
             )
+        all_primary_cusips = list(primary_cusips.values())
+        event_router = EventRouter(control, primary_cusips, irregularity)
+        print('pretending that events before %s never happened' % control.arg.start_events)
+        seven.wallclock.end_lap('start up')
+        while True:
+            try:
+                event = next(event_queue)
+                counter['events read'] += 1
+            except StopIteration:
+                break  # all the event readers are empty
 
-        if event.date() < control.arg.start_predictions:
-            continue  # just accumulate feature vectors before the start date
+            events_at[event.datetime()] += 1
 
-        print(str(test_train))
-        print('processed %d prior events in %0.2f wallclock minutes' % (
-            counter['events processed'] - 1,
-            control.timer.elapsed_wallclock_seconds() / 60.0,
-        ))
+            if event.date() > control.arg.stop_predictions:
+                print('stopping event loop, because beyond stop predictions date of %s' % control.arg.stop_predictions)
+                print('event=', event)
+                break
 
-        counter['events on or after start-predictions date'] += 1
-        if True:  # attempt to test and train
-            if not event.is_trace_print_with_cusip(control.arg.cusip):
-                irregularity.no_testing('event not trace print for primary cusip', event)
-                seven.wallclock.end_lap('decide if we have a feature vector')
-                continue
-            if feature_vector is None:
-                irregularity.no_feature_vector('missing attributes:' + feature_vector_maker.missing_attributes(), event)
-                seven.wallclock.end_lap('decide if we have a feature vector')
+            if event.date() < control.arg.start_events:  # skip events before our simulated world starts
+                counter['events ignored'] += 1
                 continue
-            # event was for the primary cusip
-            rtt = feature_vector.reclassified_trade_type
-            print('about to call maybe_test_and_train', rtt)
-            ensemble_prediction, errs_test, trained_experts, errs_train = (
-                test_train[rtt].maybe_test_and_train(
-                    current_event=event,
-                )
-            )
-            # seven.wallclock.end_lap('test and train attempt')
-            print('returned from test_train.maybe_test_and_train', rtt)
-            print('errs_test', errs_test)
-            print('errs_train', errs_train)
-            simulated_clock.handle_event()
-        if True:  # handle results from test and train (predictions, fitted models, errors)
-            if errs_test is None:
-                # write the testing results (the predictions)
-                print('processing an ensemble prediction', rtt)
 
-                counter['ensemble predictions made'] += 1
-                counter['ensemble predictions made %s' % rtt] += 1
+            # track events that occured at the exact same moment
+            # In the future, such events need to be treated as a cluster and process together
 
-                total_wallclock_seconds['test'] += ensemble_prediction.elapsed_wallclock_seconds
-                output_actions.ensemble_prediction(ensemble_prediction, rtt)
-                output_experts.expert_accuracy(ensemble_prediction)
-                output_importances.ensemble_prediction(ensemble_prediction, rtt)
-                output_signals.ensemble_prediction(ensemble_prediction, rtt)
-                output_trace.ensemble_prediction(
-                    ensemble_prediction,
-                    counter['ensemble predictions made'],
-                    rtt,
-                    )
+            for primary_cusip in all_primary_cusips:
+                primary_cusip.see_event(event)
+            seven.logging.verbose_info = True
+            seven.logging.verbose_warning = True
+            # if counter['events processed'] > 12779:
+            #     print 'near to it'
+            #     pdb.set_trace()
+            seven.wallclock.end_lap('event obtain from queus')
 
-                # write the explanation (which is lines of plain text)
-                explanation_filename = ('%s.txt' % ensemble_prediction.action_identifier)
-                explanation_path = os.path.join(
-                    control.path['dir_out'],
-                    'ensemble-predictions',
-                    explanation_filename,
-                )
-                with open(explanation_path, 'w') as f:
-                    for line in ensemble_prediction.explanation:
-                        f.write(line)
-                        f.write('\n')
-                seven.wallclock.end_lap('test write results')
-            else:
-                # write the errs from the test attempt
-                print('reclassified trade type', rtt)
-                for err in errs_test:
-                    irregularity.no_test(err, event)
-                    output_trace.no_test(simulated_clock.datetime, err, event)
-                seven.wallclock.end_lap('test write errors')
-
-            if errs_train is None:
-                # write the training results
-                print('processing trained experts', rtt)
-
-                counter['experts trained'] += 1
-                counter['experts trained %s' % rtt] += 1
+            # build the event attributes once for all the primary cusips that use the event
+            # if we waited to build feature vectors until we started predicting, the initial
+            # predictions would have little training data
+            event_attributes, receivers = event_router.route(event)
+            if len(receivers) == 0:
+                continue
 
-                total_wallclock_seconds['train'] += trained_experts.elapsed_wallclock_seconds
-                output_trace.trained_experts(
-                    trained_experts,
-                    rtt,
-                )
-                seven.wallclock.end_lap('train write results')
-            else:
-                # write the errs from the training attempt
-                for err in errs_train:
-                    irregularity.no_train(err, event)
-                    output_trace.no_train(simulated_clock.datetime, err, event)
-                seven.wallclock.end_lap('train write errors')
+            stop = False
+            for primary_cusip in receivers:
+                if primary_cusip.handle_event(event, event_attributes):
+                    stop = True
+            if stop:
+                break
+            gc.collect()
+            continue
 
-        if control.arg.dev and counter['ensemble predictions made'] >= 10:
-            print('for now, stopping early')
-            break
-        gc.collect()
-        continue
-
-    seven.wallclock.end_lap('end event loop')
-    output_actions.close()
-    output_signals.close()
-    output_trace.close()
-    event_queue.close()
-    print('counters')
-    with open(control.path['out_counters'], 'w') as f:
-        writer = csv.DictWriter(f, ['counter', 'value'], lineterminator='\n')
-        writer.writeheader()
-        for k in sorted(counter.keys()):
-            print('%-70s: %6d' % (k, counter[k]))
-            writer.writerow({
-                'counter': k,
-                'value': counter[k],
-            })
+        seven.wallclock.end_lap('end event loop')
+    finally:
+        # close even if the event loop failed, as the workers and open files would otherwise outlive the task
+        try:
+            for primary_cusip in primary_cusips.values():
+                primary_cusip.close()
+        finally:
+            try:
+                event_queue.close()
+            finally:
+                expert_fitter.close()
+    for primary_cusip in all_primary_cusips:
+        primary_cusip.report(counter)
 
     print()
     print('**************************************')
-    print('exceptional conditions')
+    print('exceptional conditions in the events')
     for k in sorted(irregularity.counter.keys()):
         print('%-40s: %6d' % (k, irregularity.counter[k]))
     print()
@@ -1899,12 +2316,6 @@ def do_work(control):
         else:
             if v > 1:
                 print('%30s: %d' % (k, v))
-    print()
-    print('************************************')
-    for reclassified_trade_type in ('B', 'S'):
-        print('test train', reclassified_trade_type, 'ending state:')
-        print('%s' % test_train[reclassified_trade_type])
-        test_train[reclassified_trade_type].report()
     seven.wallclock.end_lap('report results')
     seven.wallclock.write_csv(control.path['out_wallclock'])
     return None
@@ -1927,5 +2338,153 @@ def main(argv):
     return
 
 
+class FakeExpertFitter(object):
+    'fit no experts, after waiting until released'
+    def __init__(self):
+        self.released = threading.Event()
+
+    def fit(self, model_specs, random_seed, feature_names, training_features, training_targets, **kwds):
+        self.released.wait()
+        return []
+
+
+class TestTestTrain(unittest.TestCase):
+    def test_background_training(self):
+        control = types.SimpleNamespace(arg=types.SimpleNamespace(retrain_background=True), random_seed=123)
+        ensemble_hyperparameters = types.SimpleNamespace(max_n_feature_vectors=10, max_n_trained_sets_of_experts=2)
+        expert_fitter = FakeExpertFitter()
+        simulated_clock = SimulatedClock()
+        simulated_datetime = datetime.datetime(2017, 7, 1, 10, 0, 0)
+        simulated_clock.datetime = simulated_datetime
+        test_train = TestTrain(
+            None, control, ensemble_hyperparameters, expert_fitter,
+            seven.RetrainScheduler.EveryNTradesScheduler(1), None, simulated_clock,
+        )
+        training_job = TrainingJob(
+            creation_event='creation event',
+            feature_names=['f'],
+            model_specs=[],
+            previous_models={},
+            start_wallclock=datetime.datetime.now(),
+            training_features=np.zeros((2, 1)),
+            training_targets=np.zeros(2),
+            tree_replacement_fraction=None,
+        )
+        test_train._maybe_make_training_job = lambda creation_event, verbose=False: (training_job, None)
+        try:
+            self.assertEqual(
+                test_train._maybe_train_in_background('event 1'),
+                (None, ['started training in the background']),
+            )
+            self.assertEqual(
+                test_train._maybe_train_in_background('event 2'),
+                (None, ['previous training still running in the background']),
+            )
+            expert_fitter.released.set()
+            test_train._background_training[1].result()  # wait for the fit to complete
+            trained_experts, errs = test_train._maybe_train_in_background('event 3')
+            self.assertTrue(errs is None)
+            self.assertEqual(trained_experts.creation_event, 'creation event')
+            # the event loop did not wait for the fit, so the simulated clock did not advance
+            self.assertEqual(trained_experts.simulated_datetime, simulated_datetime)
+            self.assertEqual(simulated_clock.datetime, simulated_datetime)
+        finally:
+            expert_fitter.released.set()
+            test_train.close()
+
+
+class FakeTraceAttributeMaker(object):
+    def __init__(self, invocation_arg):
+        pass
+
+    def make_attributes(self, event):
+        return {'cusip': event.cusip()}, None
+
+
+class FakeEventReader(object):
+    'read the events at the seconds in the class attribute seconds'
+    seconds = ()
+    opened = []  # the readers constructed, in order
+
+    def __init__(self, control):
+        self._events = iter([
+            seven.Event.Event(2017, 7, 1, 10, 0, second, 0, 'fake', str(second), {}, None)
+            for second in self.seconds
+        ])
+        self.closed = False
+        FakeEventReader.opened.append(self)
+
+    def __next__(self):
+        return next(self._events), None
+
+    def close(self):
+        self.closed = True
+
+
+class TestEventQueue(unittest.TestCase):
+    def test_close_closes_every_reader(self):
+        class Reader1(FakeEventReader):
+            seconds = (1, 3)
+
+        class Reader2(FakeEventReader):
+            seconds = (2, 4)
+
+        FakeEventReader.opened = []
+        event_queue = EventQueue([Reader1, Reader2], None, Irregularities())
+        self.assertEqual([next(event_queue).second for i in range(2)], [1, 2])
+        self.assertEqual([reader.closed for reader in FakeEventReader.opened], [False, False])
+        event_queue.close()  # as when the event loop stops at stop_predictions
+        self.assertEqual([reader.closed for reader in FakeEventReader.opened], [True, True])
+
+
+class TestEventRouter(unittest.TestCase):
+    def _event(self, second, source, payload, make_event_attributes_class):
+        return seven.Event.Event(2017, 7, 1, 10, 0, second, 0, source, str(second), payload, make_event_attributes_class)
+
+    def _liq_flow(self, second, primary_cusip, otr_cusip):
+        return self._event(
+            second,
+            'liq_flow_on_the_run',
+            {'primary_cusip': primary_cusip, 'otr_cusip': otr_cusip},
+            seven.make_event_attributes.LiqFlowOnTheRun,
+        )
+
+    def _trace(self, second, cusip):
+        return self._event(second, 'trace', {'cusip': cusip, 'reclassified_trade_type': 'B'}, FakeTraceAttributeMaker)
+
+    def test_primary_cusips_with_different_otr_cusips(self):
+        def make_primary_cusip(cusip):
+            return types.SimpleNamespace(
+                cusip=cusip,
+                otr_cusip='',
+                control=types.SimpleNamespace(arg=types.SimpleNamespace(cusip=cusip)),
+            )
+
+        primary_cusips = collections.OrderedDict(
+            (cusip, make_primary_cusip(cusip))
+            for cusip in ('P1', 'P2')
+        )
+        a, b = primary_cusips['P1'], primary_cusips['P2']
+        irregularity = Irregularities()
+        router = EventRouter(primary_cusips['P1'].control, primary_cusips, irregularity)
+
+        event_attributes, receivers = router.route(self._liq_flow(1, 'P1', 'O1'))
+        self.assertEqual(receivers, [a])
+        self.assertEqual(event_attributes['id_liq_flow_on_the_run_otr_cusip'], 'O1')
+        self.assertEqual(router.route(self._liq_flow(2, 'P2', 'O2'))[1], [b])
+        self.assertEqual((a.otr_cusip, b.otr_cusip), ('O1', 'O2'))
+        self.assertEqual(router.route(self._liq_flow(3, 'X', 'O3'))[1], [])  # not a primary cusip
+
+        self.assertEqual(router.route(self._trace(4, 'P1'))[1], [a])
+        self.assertEqual(router.route(self._trace(5, 'O1'))[1], [a])
+        self.assertEqual(router.route(self._trace(6, 'O2'))[1], [b])
+        self.assertEqual(router.route(self._trace(7, 'O3'))[1], [])
+
+        # both primary cusips can have the same OTR cusip
+        router.route(self._liq_flow(8, 'P2', 'O1'))
+        self.assertEqual(router.route(self._trace(9, 'O1'))[1], [a, b])
+        self.assertEqual(sum(irregularity.counter.values()), 2)  # the events for X and O3 were skipped
+
+
 if __name__ == '__main__':
     main(sys.argv)
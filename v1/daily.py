@@ -17,6 +17,23 @@ where
    The feature_version could be a git tag, but that requires the developer to make it so.
   {--secmasst path]  specifies the path to the security master
                      default value is: ~/Dropbox/MidPredictor/automatic_feeds/secmaster.csv
+  [--max-tasks-per-worker n] replace each worker process after it has run n tasks (default: never)
+  [--event-cache]     build a memory-mapped columnar cache of each input file before running test_train,
+                      and have test_train read its events from the caches (test_train --event-cache)
+
+The tasks are run in a pool of long-lived worker processes. Each worker imports test_train and the
+analysis programs once and then runs the main() function of a program for each task it is given.
+The test_train tasks are started in decreasing order of their estimated cost (the size of the trace
+file of the issuer), and each idle worker takes the next task, so that a slow cusip does not delay
+the other tasks.
+
+With --event-cache, the input files of all the issuers are converted to columnar caches once, in
+parallel, before any test_train task starts. The workers then memory map the same cache files, so
+that the operating system holds one copy of each input in memory however many cusips of an issuer are
+run at once, and no worker parses a CSV input file.
+
+The file manifest.csv in the output directory has one row for each task, with its program, arguments,
+exit status, wallclock seconds, worker process, and output directory.
 
 EXAMPLES OF INVOCATIONS
   python daily.py 2017-08-24 1 1 1 # one job
@@ -27,23 +44,31 @@ Copyright 2017 Roy E. Lowrance, roy.lowrance@gmail.com
 You may not use this file except in compliance with a license.
 '''
 import argparse
+import collections
 import copy
 import csv
+import importlib
 import multiprocessing
 import os
 import pdb
 import pprint
 import random
 import sys
+import time
+import traceback
 
 import seven.arg_type
+import seven.BufferedCsvWriter
 import seven.build
+import seven.ColumnarCache
 import seven.debug
 import seven.dirutility
+import seven.event_readers
 import seven.Logger
 import seven.logging
 import seven.path
 import seven.Timer
+import seven.wallclock
 
 pp = pprint.pprint
 
@@ -79,6 +104,8 @@ class Control:
         parser.add_argument('--secmaster', action='store')
         parser.add_argument('--debug', action='store_true')
         parser.add_argument('--debugtesttrain', action='store_true')
+        parser.add_argument('--event-cache', action='store_true')
+        parser.add_argument('--max-tasks-per-worker', type=seven.arg_type.positive_int, default=None)
         parser.add_argument('--test', action='store_true')
         parser.add_argument('--trace', action='store_true')
 
@@ -115,39 +142,82 @@ class Control:
         return control
 
 
-def handle_return_codes(return_codes, commands, what):
-    print('all %s workers returned 0 return codes except these' % what)
-    max_return_code = report_non_zero_return_codes(return_codes, commands)
-    if max_return_code > 0:
-        print('stopping because max return code (%d) is positive' % max_return_code)
-        sys.exit(max_return_code)
+# program: the name of a module with a main(argv) function
+# inputs: Dict[logical_name, path] of the input files
+Task = collections.namedtuple(
+    'Task',
+    'index program argv estimated_cost dir_out inputs',
+)
+
+manifest_field_names = (
+    'task_index', 'program', 'argv', 'estimated_cost',
+    'exit_status', 'wallclock_seconds', 'worker', 'dir_out',
+)
+
+
+def handle_exit_statuses(results, what):
+    'stop if any task had a non-zero exit status'
+    print('all %s tasks had 0 exit statuses except these' % what)
+    max_exit_status = 0
+    for task, exit_status, wallclock_seconds, worker_name in results:
+        max_exit_status = max(max_exit_status, exit_status)
+        if exit_status != 0:
+            print(' exit status: %5d program: %s argv: %s' % (
+                exit_status,
+                task.program,
+                ' '.join(task.argv[1:]),
+            ))
+    if max_exit_status > 0:
+        print('stopping because max exit status (%d) is positive' % max_exit_status)
+        sys.exit(max_exit_status)
 
 
-def make_commands_analysis(trade_date, whats, upstream_version, feature_version):
-    'return List[command:str]'
+def make_tasks_analysis(trade_date, whats, upstream_version, feature_version, first_index):
+    'return List[Task]'
     result = []
     for what in whats:
-        result.append('python3.6 analysis_%s.py dev %s %s %s %s --debug' % (
-            what,
-            trade_date,
-            trade_date,
-            upstream_version,
-            feature_version,
+        program = 'analysis_%s' % what
+        result.append(Task(
+            index=first_index + len(result),
+            program=program,
+            argv=[
+                '%s.py' % program,
+                'dev',
+                str(trade_date),
+                str(trade_date),
+                upstream_version,
+                feature_version,
+                '--debug',
+            ],
+            estimated_cost=0,
+            dir_out='',
+            inputs={},
         ))
     return result
 
 
-def make_commands_test_train(arg_secmaster, trade_date, debug_test_train, upstream_version, feature_version):
-    'return List[command: str]'
+def make_tasks_test_train(arg_secmaster, trade_date, debug_test_train, event_cache, upstream_version, feature_version):
+    'return List[Task], most costly first'
     path_secmaster = (
         seven.path.input(issuer=None, logical_name='security master') if arg_secmaster is None else
         arg_secmaster
     )
+    trace_file_sizes = {}  # key = issuer, value = size of the issuer's trace file in bytes
+
+    def estimated_cost(issuer):
+        if issuer not in trace_file_sizes:
+            try:
+                trace_file_sizes[issuer] = os.path.getsize(seven.path.input(issuer=issuer, logical_name='trace'))
+            except OSError:
+                trace_file_sizes[issuer] = 0
+        return trace_file_sizes[issuer]
+
     result = []
     with open(path_secmaster) as f:
         dict_reader = csv.DictReader(f)
         for row in dict_reader:
-            result.append('python3.6 test_train.py %s %s %s %s %s %s %s %s %s %s' % (
+            argv = [
+                'test_train.py',
                 row['ticker'],
                 row['CUSIP'],
                 'oasspread',
@@ -157,72 +227,166 @@ def make_commands_test_train(arg_secmaster, trade_date, debug_test_train, upstre
                 str(trade_date),
                 upstream_version,
                 feature_version,
-                '--debug' if debug_test_train else ''
+            ]
+            paths = seven.build.test_train(*argv[1:])
+            if debug_test_train:
+                argv.append('--debug')
+            if event_cache:
+                argv.append('--event-cache')
+            result.append(Task(
+                index=len(result),
+                program='test_train',
+                argv=argv,
+                estimated_cost=estimated_cost(row['ticker']),
+                dir_out=paths['dir_out'],
+                inputs={
+                    logical_name: path
+                    for logical_name, path in paths.items()
+                    if logical_name.startswith('in_')
+                },
             ))
-    return result
+    return sorted(result, key=lambda task: task.estimated_cost, reverse=True)
+
+
+def build_event_cache(path_and_datetime_column_names):
+    'return (path, err or None) after building or refreshing the columnar cache of the file'
+    path, datetime_column_names = path_and_datetime_column_names
+    cache, err = seven.ColumnarCache.open_or_build(path, datetime_column_names)
+    return path, err
+
+
+def build_event_caches(pool, tasks):
+    'build the columnar cache of every input file of the tasks, each file once'
+    inputs = {}  # key = path, value = datetime column names
+    for task in tasks:
+        for logical_name, path in task.inputs.items():
+            if os.path.exists(path):
+                inputs[path] = seven.event_readers.datetime_column_names_of(logical_name)
+    print('building columnar caches for %d input files' % len(inputs))
+    for path, err in pool.imap_unordered(build_event_cache, sorted(inputs.items()), chunksize=1):
+        if err is not None:
+            # test_train reads the CSV file instead
+            print('no columnar cache for %s: %s' % (path, err))
+
+
+def initialize_worker(programs):
+    'import each program once, in each worker process'
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())  # the programs are in the current working directory
+    for program in programs:
+        importlib.import_module(program)
+    print('worker %20s %4s %4s imported %s' % (
+        multiprocessing.current_process().name,
+        os.getppid(),  # parent process id
+        os.getpid(),   # process id
+        ', '.join(programs),
+    ))
 
 
-def report_non_zero_return_codes(return_codes, commands):
-    'return max non-zero return code or zero; print all non-zero rc and command'
-    max_return_code = 0
-    for index, return_code in enumerate(return_codes):
-        max_return_code = max(max_return_code, return_code)
-        if return_code != 0:
-            print(' rc: %5d command: %s' % (
-                return_code,
-                commands[index],
-            ))
-    return max_return_code
+# module-level settings of seven.logging that a program may change
+logging_setting_names = ('invoke_pdb', 'verbose_info', 'verbose_warning', 'verbose_error', 'verbose_critical')
 
 
-def worker(command):
+def run_task(task):
+    'return (task, exit_status, wallclock_seconds, worker name) after running the task in this process'
     debug = True
     debug = False
-    print('worker %20s %4s %4s' % (
-        multiprocessing.current_process().name,
-        os.getppid(),  # parent process id
-        os.getpid(),   # process id
-    ))
+    worker_name = multiprocessing.current_process().name
     if debug:
-        print('pretending to execute: %s' % command)
-        return 0
-    else:
-        print('executing: %s' % command)
-        return os.system(command)
+        print('pretending to run: %s %s' % (task.program, task.argv))
+        return task, 0, 0.0, worker_name
+    print('%s running: %s' % (worker_name, ' '.join(task.argv)))
+    stdout = sys.stdout
+    # the worker runs many tasks, so the state of the modules they share must not carry over between them
+    logging_settings = {name: getattr(seven.logging, name) for name in logging_setting_names}
+    seven.wallclock.reset()
+    start = time.time()
+    try:
+        importlib.import_module(task.program).main(task.argv)
+        exit_status = 0
+    except SystemExit as e:
+        exit_status = (
+            0 if e.code is None else
+            e.code if isinstance(e.code, int) else
+            1
+        )
+    except Exception:
+        traceback.print_exc()
+        exit_status = 1
+    finally:
+        if sys.stdout is not stdout:
+            # the program replaced sys.stdout with a seven.Logger
+            if isinstance(sys.stdout, seven.Logger.Logger):
+                sys.stdout.log.close()
+            sys.stdout = stdout
+        for name, value in logging_settings.items():
+            setattr(seven.logging, name, value)
+    return task, exit_status, time.time() - start, worker_name
+
+
+def run_tasks(pool, tasks, manifest):
+    'return List[(task, exit_status, wallclock_seconds, worker name)], in order of completion'
+    result = []
+    for task, exit_status, wallclock_seconds, worker_name in pool.imap_unordered(run_task, tasks, chunksize=1):
+        manifest.writerow({
+            'task_index': task.index,
+            'program': task.program,
+            'argv': ' '.join(task.argv[1:]),
+            'estimated_cost': task.estimated_cost,
+            'exit_status': exit_status,
+            'wallclock_seconds': '%0.3f' % wallclock_seconds,
+            'worker': worker_name,
+            'dir_out': task.dir_out,
+        })
+        result.append((task, exit_status, wallclock_seconds, worker_name))
+    manifest.checkpoint()
+    return result
 
 
 def do_work(control):
     # applied_data_science.lower_priority.lower_priority()
-    p = multiprocessing.Pool(control.arg.jobs)
-
-    # run the test_train program for each cusip (for now, about 250 of them)
-    test_train_commands = make_commands_test_train(
-        arg_secmaster=control.arg.secmaster,
-        trade_date=control.arg.trade_date,
-        debug_test_train=control.arg.debugtesttrain,
-        upstream_version=control.arg.upstream_version,
-        feature_version=control.arg.feature_version,
-        )
-    test_train_return_codes = p.map(worker, test_train_commands)
-    handle_return_codes(
-        test_train_return_codes,
-        test_train_commands,
-        'test_train'
+    analysis_whats = ('accuracy', 'experts', 'importances')
+    p = multiprocessing.Pool(
+        control.arg.jobs,
+        initializer=initialize_worker,
+        initargs=(['test_train'] + ['analysis_%s' % what for what in analysis_whats],),
+        maxtasksperchild=control.arg.max_tasks_per_worker,
     )
-
-    # run the analysis programs
-    analysis_commands = make_commands_analysis(
-        control.arg.trade_date,
-        ('accuracy', 'experts', 'importances'),
-        control.arg.upstream_version,
-        control.arg.feature_version,
-        )
-    analysis_return_codes = p.map(worker, analysis_commands)
-    handle_return_codes(
-        analysis_return_codes,
-        analysis_commands,
-        'analysis'
+    manifest = seven.BufferedCsvWriter.BufferedCsvWriter(
+        os.path.join(control.path['dir_out'], 'manifest.csv'),
+        manifest_field_names,
+        flush_rows=1,
     )
+
+    try:
+        # run the test_train program for each cusip (for now, about 250 of them)
+        test_train_tasks = make_tasks_test_train(
+            arg_secmaster=control.arg.secmaster,
+            trade_date=control.arg.trade_date,
+            debug_test_train=control.arg.debugtesttrain,
+            event_cache=control.arg.event_cache,
+            upstream_version=control.arg.upstream_version,
+            feature_version=control.arg.feature_version,
+            )
+        if control.arg.event_cache:
+            build_event_caches(p, test_train_tasks)
+        test_train_results = run_tasks(p, test_train_tasks, manifest)
+        handle_exit_statuses(test_train_results, 'test_train')
+
+        # run the analysis programs
+        analysis_tasks = make_tasks_analysis(
+            control.arg.trade_date,
+            analysis_whats,
+            control.arg.upstream_version,
+            control.arg.feature_version,
+            first_index=len(test_train_tasks),
+            )
+        analysis_results = run_tasks(p, analysis_tasks, manifest)
+        handle_exit_statuses(analysis_results, 'analysis')
+    finally:
+        manifest.close()
+        p.close()
+        p.join()
     return None
 
 